@@ -0,0 +1,168 @@
+import bz2
+import gzip
+import io
+import luigi
+import luigi.format
+
+'''
+Block compression for the files written and read by ra2mr.
+
+Local and mock targets are compressed in blocks: the output is cut into
+blocks of about block_size bytes, each ending on a line boundary, and each
+block is compressed into an independent gzip member (or bzip2 stream).
+The concatenation is a valid .gz (or .bz2) file. The offsets of the
+blocks are not recorded, so a compressed file is read by a single mapper.
+
+On HDFS, files are written by Hadoop, so the codec is passed to the job
+as Hadoop codec classes instead. Intermediate results are only compressed
+with bzip2 there, which Hadoop can split across mappers: a gzip file is
+read by a single mapper, however large it is. The map output (shuffle),
+which is never split, can additionally be compressed with a fast codec
+like gzip, lz4, snappy or zstd.
+'''
+
+
+class compression(luigi.Config):
+    local = luigi.ChoiceParameter(choices=["none", "gzip", "bzip2"], default="none",
+                                  description='Codec for intermediate results in the LOCAL and PARALLEL environments')
+    mock = luigi.ChoiceParameter(choices=["none", "gzip", "bzip2"], default="none",
+                                 description='Codec for intermediate results in the MOCK environment')
+    hdfs = luigi.ChoiceParameter(choices=["none", "bzip2"], default="none",
+                                 description='Splittable codec for intermediate results on HDFS')
+    shuffle = luigi.ChoiceParameter(choices=["none", "gzip", "bzip2", "lz4", "snappy", "zstd"], default="none",
+                                    description='Codec for the map output on HDFS')
+    block_size = luigi.IntParameter(default=1024 * 1024, description='Uncompressed size of a block in bytes')
+
+
+CODECS = {
+    "gzip": gzip,
+    "bzip2": bz2,
+}
+
+EXTENSIONS = {
+    "gzip": ".gz",
+    "bzip2": ".bz2",
+}
+
+HADOOP_CODECS = {
+    "gzip": "org.apache.hadoop.io.compress.GzipCodec",
+    "bzip2": "org.apache.hadoop.io.compress.BZip2Codec",
+    "lz4": "org.apache.hadoop.io.compress.Lz4Codec",
+    "snappy": "org.apache.hadoop.io.compress.SnappyCodec",
+    "zstd": "org.apache.hadoop.io.compress.ZStandardCodec",
+}
+
+
+def codec_for_path(path):
+    for codec, extension in EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+'''
+Hadoop configuration for compressing the output, and the map output, of
+a streaming job.
+'''
+
+
+def hadoop_jobconfs(output_codec, shuffle_codec):
+    jcs = []
+    if output_codec is not None:
+        jcs.append('mapreduce.output.fileoutputformat.compress=true')
+        jcs.append('mapreduce.output.fileoutputformat.compress.codec=' + HADOOP_CODECS[output_codec])
+    if shuffle_codec is not None:
+        jcs.append('mapreduce.map.output.compress=true')
+        jcs.append('mapreduce.map.output.compress.codec=' + HADOOP_CODECS[shuffle_codec])
+    return jcs
+
+
+class BlockWriter(object):
+
+    def __init__(self, stream, codec, block_size):
+        self.stream = stream
+        self.codec = CODECS[codec]
+        self.block_size = block_size
+        self.buffer = bytearray()
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while len(self.buffer) >= self.block_size:
+            # End the block after the last line that fits, or after the first line if none fits.
+            end = self.buffer.rfind(b'\n', 0, self.block_size) + 1 or self.buffer.find(b'\n', self.block_size) + 1
+            if end == 0:
+                break
+            self.stream.write(self.codec.compress(bytes(self.buffer[:end])))
+            del self.buffer[:end]
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.stream.write(self.codec.compress(bytes(self.buffer)))
+            del self.buffer[:]
+        self.stream.close()
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.stream.__exit__(exc_type, exc_val, exc_tb)
+        else:
+            self.close()
+
+
+class BlockReader(io.BufferedReader):
+    '''
+    Decompresses a stream of blocks. Both gzip and bzip2 decompress a
+    concatenation of members (streams) as one.
+    '''
+
+    def __init__(self, stream, codec):
+        self.stream = stream
+        super(BlockReader, self).__init__(CODECS[codec].open(stream, 'rb'))
+
+    def close(self):
+        super(BlockReader, self).close()
+        self.stream.close()
+
+
+class BlockCompressionFormat(luigi.format.Format):
+
+    input = 'bytes'
+    output = 'bytes'
+
+    def __init__(self, codec, block_size=None):
+        self.codec = codec
+        self.block_size = block_size or compression().block_size
+
+    def pipe_reader(self, input_pipe):
+        return BlockReader(input_pipe, self.codec)
+
+    def pipe_writer(self, output_pipe):
+        return BlockWriter(output_pipe, self.codec, self.block_size)
+
+
+def text_format(codec):
+    if codec is None:
+        return None
+    return luigi.format.Text >> BlockCompressionFormat(codec)
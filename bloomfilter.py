@@ -0,0 +1,61 @@
+import hashlib
+import json
+import math
+
+'''
+A Bloom filter over the join keys of a relation, for the semi-join
+reduction of ra2mr.JoinTask: the filter is built over the keys of the
+smaller input and shipped with the job, so the mappers of the larger
+input can drop the tuples whose key is certainly not in the smaller one.
+
+A key that was added is always found. A key that was not added is found
+with probability error_rate, if the filter was sized for the number of
+keys added, so some tuples without a join partner still get through,
+and the join drops them.
+'''
+
+
+def optimal_bits(keys, error_rate):
+    return max(8, int(math.ceil(-max(keys, 1) * math.log(error_rate) / (math.log(2) ** 2))))
+
+
+def optimal_hashes(bits, keys):
+    return max(1, int(round(float(bits) / max(keys, 1) * math.log(2))))
+
+
+class BloomFilter(object):
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    @staticmethod
+    def for_keys(keys, error_rate=0.01, bits=0):
+        '''
+        Returns a filter holding the given keys. Unless the number of bits
+        is given, the filter is sized for the error rate.
+        '''
+        keys = set(keys)
+        bits = bits or optimal_bits(len(keys), error_rate)
+        bloom = BloomFilter(bits, optimal_hashes(bits, len(keys)))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def positions(self, key):
+        # Double hashing: the i-th position is h1 + i * h2.
+        digest = hashlib.blake2b(json.dumps(key).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -0,0 +1,78 @@
+import json
+import sys
+import luigi
+import radb.ast
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+Bucketed storage for input relations, for joins without a shuffle.
+
+The tuples of <Relation>.json are hash-partitioned on a key attribute
+into the bucket files <Relation>.bucket-00000.json, ..., and sorted on
+the key within each bucket. The manifest <Relation>.buckets.json records
+the key, the number of buckets, the bucket files, and the version of
+<Relation>.json they were written for; <Relation>.json itself is kept.
+
+When both inputs of an equi-join are relations bucketed on their join
+attributes into the same number of buckets, ra2mr.task_factory plans a
+BucketJoinTask, which merges bucket i of one relation with bucket i of
+the other, in a map-only job. Once <Relation>.json changes, its buckets
+are ignored until they are written again.
+'''
+
+
+class bucketing(luigi.Config):
+    buckets = luigi.IntParameter(default=8, description='Number of buckets per relation')
+
+
+def bucket_filename(relation, bucket):
+    return "%s.bucket-%05d.json" % (relation, bucket)
+
+
+def key_attribute(key):
+    rel, _, name = key.rpartition('.')
+    return radb.ast.AttrRef(rel or None, name)
+
+
+def write_buckets(relation, key, buckets=None, env=ExecEnv.LOCAL):
+    '''
+    Writes the buckets of <relation>.json, hashed on the attribute key
+    (e.g. "name" or "Person.name"), and returns the manifest.
+    '''
+    buckets = buckets or bucketing().buckets
+    source = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+
+    contents = [[] for _ in range(buckets)]
+    attribute = None
+    for line in ra2mr.read_target(source):
+        json_tuple = json.loads(line.split('\t')[1])
+        if attribute is None:
+            attribute = ra2mr.resolve_attribute(key_attribute(key), json_tuple)
+        value = json_tuple[attribute]
+        contents[ra2mr.bucket_of(value, buckets)].append((ra2mr.bucket_sort_key(value), line))
+
+    files = []
+    for bucket in range(buckets):
+        files.append(bucket_filename(relation, bucket))
+        with ra2mr.InputData(filename=files[-1], exec_environment=env).output().open('w') as f:
+            for _, line in sorted(contents[bucket], key=lambda entry: entry[0]):
+                f.write(line + '\n')
+
+    manifest = {
+        "relation": relation,
+        "key": attribute if attribute is not None else key,
+        "buckets": buckets,
+        "files": files,
+        "version": ra2mr.target_version(source),
+    }
+    with ra2mr.InputData(filename=relation + ".buckets.json", exec_environment=env).output().open('w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+if __name__ == '__main__':
+    # python3 buckets.py Person name 8
+    manifest = write_buckets(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print(manifest["relation"], manifest["key"], manifest["buckets"])
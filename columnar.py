@@ -0,0 +1,247 @@
+import json
+import operator
+import numpy as np
+import radb
+import radb.ast
+import radb.parse
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+Vectorized, columnar evaluation of relational algebra queries with NumPy,
+for analytical queries over data that fits into memory.
+
+Each input relation is loaded once into one typed array per attribute,
+using the types of the data dictionary dd (as passed to raopt). Selections
+become boolean masks, projections select columns, renamings only change
+attribute names, and joins are sort-merge joins on integer-coded keys.
+'''
+
+NUMERIC_TYPES = ("integer", "int", "float", "number", "real")
+
+
+class Relation(object):
+    '''
+    A relation in columnar form: the relation name, the fully qualified
+    attribute names in order, and one array of equal length per attribute.
+    '''
+
+    def __init__(self, name, attrs, columns):
+        self.name = name
+        self.attrs = attrs
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[self.attrs[0]]) if self.attrs else 0
+
+    def take(self, index):
+        return Relation(self.name, self.attrs, dict((attr, self.columns[attr][index]) for attr in self.attrs))
+
+    def tuples(self):
+        values = [self.columns[attr].tolist() for attr in self.attrs]
+        for row in zip(*values):
+            yield dict(zip(self.attrs, row))
+
+
+def column(values, type):
+    if type is not None and type.lower() in NUMERIC_TYPES:
+        return np.array(values)
+    if None in values:
+        # Keep NULLs, instead of turning them into the string 'None'.
+        return np.array(values, dtype=object)
+    return np.array(values, dtype=str)
+
+
+'''
+Loads <relation>.json into columns. Loaded relations are cached per
+execution environment, and kept while the version of the file (see
+ra2mr.target_version) and the relation's schema stay the same, so every
+relation is only read and parsed once, unless it changes.
+'''
+loaded = {}
+
+
+def load(relation, dd, env=ExecEnv.LOCAL):
+    target = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+    version = (ra2mr.target_version(target), list(dd[relation].items()))
+    cached = loaded.get((env, relation))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    schema = dd[relation]
+    attrs = [relation + "." + attr for attr in schema]
+    values = dict((attr, []) for attr in attrs)
+
+    for line in ra2mr.read_target(target):
+        json_tuple = json.loads(line.split('\t')[1])
+        for attr in attrs:
+            values[attr].append(json_tuple.get(attr))
+
+    result = Relation(relation, attrs, dict(
+        (relation + "." + attr, column(values[relation + "." + attr], type)) for attr, type in schema.items()))
+    loaded[(env, relation)] = (version, result)
+    return result
+
+
+'''
+Compiles a condition into a vectorized expression over the columns of a
+relation: attribute references evaluate to columns, literals to scalars,
+comparisons and connectives to boolean masks. Columns with NULLs hold
+Python objects, and are compared element by element, with the NULL
+semantics of ra2mr.COMPARISONS.
+'''
+
+CONNECTIVES = {
+    radb.ast.sym.AND: operator.and_,
+    radb.ast.sym.OR: operator.or_,
+}
+
+
+def evaluate_condition(cond, relation):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        left = evaluate_condition(cond.inputs[0], relation)
+        right = evaluate_condition(cond.inputs[1], relation)
+        if cond.op in CONNECTIVES:
+            return CONNECTIVES[cond.op](left, right)
+        elif cond.op in ra2mr.COMPARISONS:
+            return np.asarray(apply(ra2mr.COMPARISONS[cond.op], left, right), dtype=bool)
+        elif cond.op in ra2mr.ARITHMETICS and cond.op != radb.ast.sym.CONCAT:
+            return apply(ra2mr.ARITHMETICS[cond.op], left, right)
+
+    elif isinstance(cond, radb.ast.ValExprUnaryOp) and cond.op == radb.ast.sym.NOT:
+        return ~evaluate_condition(cond.inputs[0], relation)
+
+    elif isinstance(cond, radb.ast.AttrRef):
+        return relation.columns[ra2mr.resolve_attribute(cond, relation.attrs)]
+
+    elif isinstance(cond, radb.ast.Literal):
+        return ra2mr.literal_value(cond)
+
+    raise Exception("evaluate_condition: Cannot handle " + str(cond) + ".")
+
+
+def apply(op, left, right):
+    if any(isinstance(side, np.ndarray) and side.dtype == object for side in (left, right)):
+        return np.frompyfunc(op, 2, 1)(left, right)
+    return op(left, right)
+
+
+'''
+Maps the rows of one or more key columns to integer codes, such that
+rows with equal keys get equal codes. Used to deduplicate and to join
+on composite keys of any type.
+'''
+
+
+def factorize(columns):
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    for values in columns:
+        if values.dtype == object:
+            # NULLs cannot be sorted with other values, so code by first occurrence.
+            uniques = {}
+            inverse = np.array([uniques.setdefault(value, len(uniques)) for value in values], dtype=np.int64)
+        else:
+            uniques, inverse = np.unique(values, return_inverse=True)
+        codes = codes * len(uniques) + inverse.reshape(-1)
+        # Keep the codes dense, so that they cannot overflow.
+        _, codes = np.unique(codes, return_inverse=True)
+        codes = codes.reshape(-1)
+    return codes
+
+
+def select(raquery, relation):
+    mask = evaluate_condition(raquery.cond, relation)
+    if np.ndim(mask) == 0:
+        mask = np.full(len(relation), bool(mask))
+    return relation.take(mask)
+
+
+def project(raquery, relation):
+    attrs = [ra2mr.resolve_attribute(attr, relation.attrs) for attr in raquery.attrs]
+    projected = Relation(relation.name, attrs, dict((attr, relation.columns[attr]) for attr in attrs))
+    if len(projected) == 0:
+        return projected
+
+    _, first = np.unique(factorize([projected.columns[attr] for attr in attrs]), return_index=True)
+    return projected.take(np.sort(first))
+
+
+def rename(raquery, relation):
+    name, attrs, _ = ra2mr.compile_unary(raquery, relation.name, relation.attrs)
+    return Relation(name, attrs, dict((new, relation.columns[old]) for old, new in zip(relation.attrs, attrs)))
+
+
+'''
+Sort-merge join: both sides are coded jointly, the right side is sorted
+by code, and each left row is matched with its range of equal codes in
+the sorted right side, found by binary search.
+'''
+
+
+def join_column(pair, relation):
+    attr1, attr2 = pair
+    key = ra2mr.find_attribute(attr1, relation.attrs)
+    if key is None:
+        key = ra2mr.resolve_attribute(attr2, relation.attrs)
+    return relation.columns[key]
+
+
+def join(raquery, left, right):
+    pairs = ra2mr.join_attributes(raquery.cond)
+    attrs = left.attrs + right.attrs
+    if len(left) == 0 or len(right) == 0:
+        return Relation(left.name, attrs, dict((attr, np.array([])) for attr in attrs))
+
+    left_keys = [join_column(pair, left) for pair in pairs]
+    right_keys = [join_column(pair, right) for pair in pairs]
+
+    codes = factorize([np.concatenate([l, r]) for l, r in zip(left_keys, right_keys)])
+    left_codes, right_codes = codes[:len(left)], codes[len(left):]
+
+    order = np.argsort(right_codes, kind='stable')
+    sorted_codes = right_codes[order]
+    lo = np.searchsorted(sorted_codes, left_codes, side='left')
+    hi = np.searchsorted(sorted_codes, left_codes, side='right')
+    counts = hi - lo
+
+    left_index = np.repeat(np.arange(len(left)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_index = order[np.repeat(lo, counts) + within]
+
+    columns = dict((attr, left.columns[attr][left_index]) for attr in left.attrs)
+    columns.update((attr, right.columns[attr][right_index]) for attr in right.attrs)
+    return Relation(left.name, attrs, columns)
+
+
+def evaluate(raquery, dd, env=ExecEnv.LOCAL):
+    assert (isinstance(raquery, radb.ast.Node))
+
+    if isinstance(raquery, radb.ast.RelRef):
+        return load(raquery.rel, dd, env)
+
+    elif isinstance(raquery, radb.ast.Select):
+        return select(raquery, evaluate(raquery.inputs[0], dd, env))
+
+    elif isinstance(raquery, radb.ast.Project):
+        return project(raquery, evaluate(raquery.inputs[0], dd, env))
+
+    elif isinstance(raquery, radb.ast.Rename):
+        return rename(raquery, evaluate(raquery.inputs[0], dd, env))
+
+    elif isinstance(raquery, radb.ast.Join):
+        return join(raquery, evaluate(raquery.inputs[0], dd, env), evaluate(raquery.inputs[1], dd, env))
+
+    else:
+        raise Exception("Operator " + str(type(raquery)) + " not implemented (yet).")
+
+
+'''
+Evaluates a relational algebra query and returns the result lines,
+formatted like the output files of the MapReduce jobs.
+'''
+
+
+def execute(raquery, dd, env=ExecEnv.LOCAL):
+    relation = evaluate(raquery, dd, env)
+    return [relation.name + '\t' + json.dumps(json_tuple) for json_tuple in relation.tuples()]
@@ -1,10 +1,9 @@
-import luigi
 import radb
 import ra2mr
 # Take a relational algebra query...
 
 raquery = radb.parse.one_statement_from_string("\project_{name} Person;")
-# ... translate it into a luigi task encoding a MapReduce workflow...
-task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.HDFS)
-# ... and run the task on Hadoop, using HDFS for input and output: # (for now, we are happy working with luigi's local scheduler).
-luigi.build([task], local_scheduler=True)
+# ... translate it into a luigi task encoding a MapReduce workflow,
+# and run the task on Hadoop, using HDFS for input and output, with one
+# worker per independent job (for now, we are happy working with luigi's local scheduler).
+task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.HDFS)
@@ -0,0 +1,56 @@
+import json
+import sys
+import radb.ast
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+Builds secondary indexes on attributes of input relations, for
+selections with an equality on the attribute, e.g.
+\\select_{name = 'Amy'} Person.
+
+The index <Relation>.<attribute>.index maps the values of the attribute
+to the byte offsets of the tuples in <Relation>.json, sorted by value
+(see ra2mr.index_lookup for the format). A SelectTask for such a
+selection directly on the relation, or a FusedTask for a chain of
+operators starting with it, only reads the tuples at these offsets (see
+ra2mr.ScanMixin). Once <Relation>.json changes, the index is
+ignored until it is built again. Indexes are not used on HDFS.
+'''
+
+
+def build_index(relation, attribute, env=ExecEnv.LOCAL):
+    '''
+    Builds the index on the attribute (e.g. "name" or "Person.name") of
+    <relation>.json, and returns its header.
+    '''
+    source = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+
+    entries = []
+    key = None
+    with ra2mr.MappedTarget(source) as data:
+        offset = 0
+        while offset < len(data.data):
+            line = data.line(offset)
+            if line.strip():
+                json_tuple = json.loads(line.decode('utf-8').split('\t')[1])
+                if key is None:
+                    rel, _, name = attribute.rpartition('.')
+                    key = ra2mr.resolve_attribute(radb.ast.AttrRef(rel or None, name), json_tuple)
+                entries.append((ra2mr.index_key(json_tuple.get(key)).encode('utf-8'), offset))
+            offset += len(line) + 1
+
+    header = {"relation": relation, "key": key, "version": ra2mr.target_version(source)}
+    target = ra2mr.InputData(filename=ra2mr.index_filename(relation, attribute), exec_environment=env).output()
+    with target.open('w') as f:
+        f.write(json.dumps(header) + '\n')
+        for value, offset in sorted(entries):
+            f.write(value.decode('utf-8') + '\t' + str(offset) + '\n')
+    return header
+
+
+if __name__ == '__main__':
+    # python3 indexes.py Person name
+    header = build_index(sys.argv[1], sys.argv[2])
+    print(header["relation"], header["key"])
@@ -0,0 +1,88 @@
+import concurrent.futures
+import io
+import os
+import zlib
+import luigi
+import luigi.contrib.hadoop
+
+'''
+Runs the map and reduce functions of a luigi.contrib.hadoop.JobTask on a
+pool of local processes, for data that is too large for a single core
+but does not justify a Hadoop cluster.
+
+Mirrors Hadoop streaming like luigi's LocalJobRunner does: the input is
+split into one chunk per process, each map task sorts and combines its
+output and hash-partitions it on the first key field, and each reduce
+task sorts its partition on all key fields before running the reducer.
+The job's mapper, combiner and reducer run unchanged.
+'''
+
+
+class pool(luigi.Config):
+    processes = luigi.IntParameter(default=0, description='Number of processes, 0 for one per core')
+
+
+def partition(line, partitions):
+    # zlib.crc32 rather than hash(), which differs between processes.
+    return zlib.crc32(line.split('\t', 1)[0].encode('utf-8')) % partitions
+
+
+def sort_lines(lines):
+    return sorted(lines, key=lambda line: line.rstrip('\n').split('\t')[:-1])
+
+
+def run_map_task(job, lines, partitions):
+    map_output = io.StringIO()
+    job.run_mapper(io.StringIO(''.join(lines)), map_output)
+
+    if job.reducer == NotImplemented:
+        return map_output.getvalue()
+
+    map_output = io.StringIO(map_output.getvalue())
+    if job.combiner != NotImplemented:
+        combine_output = io.StringIO()
+        job.run_combiner(io.StringIO(''.join(sort_lines(map_output))), combine_output)
+        map_output = io.StringIO(combine_output.getvalue())
+
+    outputs = [[] for _ in range(partitions)]
+    for line in map_output:
+        outputs[partition(line, partitions)].append(line)
+    return outputs
+
+
+def run_reduce_task(job, lines):
+    reduce_output = io.StringIO()
+    job.run_reducer(io.StringIO(''.join(sort_lines(lines))), reduce_output)
+    return reduce_output.getvalue()
+
+
+class PoolJobRunner(luigi.contrib.hadoop.JobRunner):
+
+    def __init__(self, processes=None):
+        self.processes = processes or pool().processes or os.cpu_count() or 1
+
+    def run_job(self, job):
+        lines = []
+        for target in luigi.task.flatten(job.input_hadoop()):
+            with target.open('r') as f:
+                lines.extend(line if line.endswith('\n') else line + '\n' for line in f)
+
+        chunk_size = max(1, -(-len(lines) // self.processes))
+        chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+
+        with job.no_unpicklable_properties():
+            with concurrent.futures.ProcessPoolExecutor(self.processes) as pool:
+                map_outputs = list(pool.map(run_map_task, [job] * len(chunks), chunks,
+                                            [self.processes] * len(chunks)))
+
+                if job.reducer == NotImplemented:
+                    outputs = map_outputs
+                else:
+                    partitions = [[line for map_output in map_outputs for line in map_output[i]]
+                                  for i in range(self.processes)]
+                    outputs = list(pool.map(run_reduce_task, [job] * len(partitions), partitions))
+
+        output = job.output().open('w')
+        for text in outputs:
+            output.write(text)
+        output.close()
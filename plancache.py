@@ -0,0 +1,153 @@
+import collections
+import copy
+import json
+import re
+import luigi
+import radb.ast
+import sqlparse
+
+import ra2mr
+import raopt
+import sql2ra
+from ra2mr import ExecEnv
+
+'''
+A cache of compiled query plans, for applications that send queries of
+the same shape over and over again.
+
+The SQL text is normalized: runs of whitespace become one space, keywords
+are lower-cased (as sql2ra expects), and string and number literals are
+replaced by parameters. Queries that only differ in these respects share
+one cache entry, which holds the optimized relational algebra query, with the
+parameters still in it. A lookup binds the literals of the query to a
+copy of it, and builds the physical plan with ra2mr.task_factory.
+
+The plan is optimized once per query shape, not per literal value, like
+a prepared statement. The cache is cleared when the data dictionary or
+the statistics catalog change.
+'''
+
+
+class plancache(luigi.Config):
+    size = luigi.IntParameter(default=256, description='Maximum number of cached query shapes')
+
+
+KEYWORDS = {"SELECT", "DISTINCT", "FROM", "WHERE", "AND"}
+
+TOKENS = re.compile(r"(?P<space>\s+)|(?P<string>'(?:[^']|'')*')|(?P<number>(?<![\w.])\d+(?:\.\d+)?(?![\w.]))|"
+                    r"(?P<word>\w+)|(?P<other>.)", re.DOTALL)
+
+'''
+Parameters are translated and optimized as string literals with these
+names, which cannot clash with the literals of a query, because all
+those are parameters, too.
+'''
+
+
+def parameter(i):
+    return "'__parameter_" + str(i) + "__'"
+
+
+def normalize(sql):
+    '''
+    Returns the normalized SQL text, with the i-th literal replaced by
+    parameter(i), and the list of literals.
+    '''
+    template = []
+    literals = []
+    for match in TOKENS.finditer(sql.strip().rstrip(';').strip()):
+        kind, token = match.lastgroup, match.group()
+        if kind == "space":
+            template.append(" ")
+        elif kind == "string" or kind == "number":
+            template.append(parameter(len(literals)))
+            literals.append(token)
+        elif kind == "word" and token.upper() in KEYWORDS:
+            template.append(token.lower())
+        else:
+            template.append(token)
+    return "".join(template), literals
+
+
+def bind(ra, literals):
+    '''
+    Replaces the parameters in a (copy of an) optimized query by literals.
+    sql2ra translates literals to attribute references, which are printed
+    like literals, so both are replaced.
+    '''
+    values = dict((parameter(i), literal) for i, literal in enumerate(literals))
+
+    def bind_value(value):
+        if isinstance(value, radb.ast.AttrRef) and value.rel is None and value.name in values:
+            value.name = values[value.name]
+        elif isinstance(value, radb.ast.RAString) and value.val in values:
+            literal = values[value.val]
+            return radb.ast.RAString(literal) if literal.startswith("'") else radb.ast.RANumber(literal)
+        elif isinstance(value, radb.ast.ValExpr):
+            value.inputs = [bind_value(input) for input in value.inputs or []]
+        return value
+
+    def bind_node(node):
+        if getattr(node, "cond", None) is not None:
+            node.cond = bind_value(node.cond)
+        for statement in node.inputs or []:
+            bind_node(statement)
+        return node
+
+    return bind_node(ra)
+
+
+'''
+The parts of the data dictionary and the statistics that plans depend
+on. Catalog entries of the stats module have a fingerprint of their
+input file, which stands for the whole entry.
+'''
+
+
+def dependencies(dd, stats):
+    if stats is not None:
+        stats = dict((relation, entry.get("fingerprint", entry)) for relation, entry in stats.items())
+    return json.dumps([dd, stats], sort_keys=True, default=str)
+
+
+class PlanCache(object):
+
+    def __init__(self, size=None):
+        self.size = size if size is not None else plancache().size
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def optimize(self, sql, dd, stats=None):
+        '''
+        Returns the optimized relational algebra query for sql.
+        '''
+        version = dependencies(dd, stats)
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+        template, literals = normalize(sql)
+        if template in self.entries:
+            self.entries.move_to_end(template)
+            self.hits += 1
+        else:
+            self.misses += 1
+            ra = sql2ra.translate(sqlparse.parse(template)[0])
+            if not isinstance(ra, radb.ast.Node):
+                raise Exception("PlanCache: Cannot translate " + sql + ": " + str(ra))
+            self.entries[template] = raopt.optimize(ra, dd, stats)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return bind(copy.deepcopy(self.entries[template]), literals)
+
+    def plan(self, sql, dd, stats=None, env=ExecEnv.HDFS):
+        '''
+        Returns the physical plan for sql, i.e. the luigi task computing it.
+        '''
+        return ra2mr.task_factory(self.optimize(sql, dd, stats), env=env)
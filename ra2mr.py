@@ -1,5 +1,17 @@
+import collections
 from enum import Enum
+import hashlib
+import io
+import itertools
 import json
+import logging
+import mmap
+import operator
+import os
+import random
+import re
+import time
+import zlib
 import luigi
 import luigi.contrib.hadoop
 import luigi.contrib.hdfs
@@ -7,9 +19,14 @@ from luigi.mock import MockTarget
 import radb
 import radb.ast
 import radb.parse
+import blockcompress
+import bloomfilter
+import mrpool
 #import raopt
 #import sqlparse
 
+logger = logging.getLogger('luigi-interface')
+
 '''
 Control where the input data comes from, and where output data should go.
 '''
@@ -19,43 +36,39 @@ class ExecEnv(Enum):
     LOCAL = 1  # read/write local files
     HDFS = 2  # read/write HDFS
     MOCK = 3  # read/write mock data to an in-memory file system.
+    PARALLEL = 4  # read/write local files, run map and reduce tasks on a local process pool.
 
 
 '''
 Switches between different execution environments and file systems.
 '''
-parts = []
-
-
-def split_recursivee(ra):
-    if ra is not None:
-        parts.append(ra)
-        if isinstance(ra, radb.ast.Select):
-            split_recursivee(ra.cond)
-        for item in ra.inputs:
-            split_recursivee(item)
-
-
-def remove_duplicates(values):
-    output = []
-    seen = set()
-    for value in values:
-        if value not in seen:
-            output.append(value)
-            seen.add(value)
-    return output
 
 
 class OutputMixin(luigi.Task):
     exec_environment = luigi.EnumParameter(enum=ExecEnv, default=ExecEnv.HDFS)
 
-    def get_output(self, fn):
+    '''
+    Files are (de)compressed transparently with the given codec, or by
+    their extension (.gz, .bz2).
+    '''
+
+    def get_output(self, fn, codec=None):
+        format = blockcompress.text_format(codec or blockcompress.codec_for_path(fn))
         if self.exec_environment == ExecEnv.HDFS:
-            return luigi.contrib.hdfs.HdfsTarget(fn)
+            return luigi.contrib.hdfs.HdfsTarget(fn, format=format)
         elif self.exec_environment == ExecEnv.MOCK:
-            return MockTarget(fn)
+            return MockTarget(fn, format=format)
         else:
-            return luigi.LocalTarget(fn)
+            return luigi.LocalTarget(fn, format=format)
+
+    def codec(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            codec = blockcompress.compression().hdfs
+        elif self.exec_environment == ExecEnv.MOCK:
+            codec = blockcompress.compression().mock
+        else:
+            codec = blockcompress.compression().local
+        return codec if codec != "none" else None
 
 
 class InputData(OutputMixin):
@@ -65,6 +78,220 @@ class InputData(OutputMixin):
         return self.get_output(self.filename)
 
 
+'''
+Helpers for inspecting the targets written by other tasks. On HDFS, the
+output of a MapReduce job is a folder of part files.
+'''
+
+
+def open_target(target):
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget) and target.fs.isdir(target.path):
+        target = luigi.contrib.hdfs.HdfsTarget(target.path.rstrip("/") + "/part-*", format=target.format)
+    return target.open('r')
+
+
+def read_target(target):
+    with open_target(target) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line:
+                yield line
+
+
+'''
+Intermediate results can be written in a compact, schema-aware format:
+the relation name and attribute names of a file are stored once, in a
+sidecar file next to it, and each line only holds the relation name and
+a JSON array of the attribute values in schema order. The lines stay
+newline-delimited text, as Hadoop streaming requires. Input relations
+and the final query result always use JSON objects.
+'''
+
+
+class intermediate(luigi.Config):
+    format = luigi.ChoiceParameter(choices=["json", "packed"], default="json")
+
+
+def schema_target(target):
+    return type(target)(target.path.rstrip("/") + ".schema")
+
+
+'''
+Returns the relation name and attribute names of the tuples in a
+target, or None if it holds no tuples.
+'''
+
+
+def read_schema(target):
+    sidecar = schema_target(target)
+    if sidecar.exists():
+        with sidecar.open('r') as f:
+            schema = json.load(f)
+        return (schema["relation"], schema["attrs"]) if schema is not None else None
+
+    for line in read_target(target):
+        relation, tuple = line.split('\t')
+        return relation, list(json.loads(tuple))
+    return None
+
+
+def write_schema(target, schema):
+    with schema_target(target).open('w') as f:
+        json.dump({"relation": schema[0], "attrs": schema[1]} if schema is not None else None, f)
+
+
+def target_size(target):
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget):
+        return target.fs.count(target.path)['content_size']
+    elif isinstance(target, MockTarget):
+        return len(target.fs.get_data(target.path))
+    else:
+        return os.path.getsize(target.path)
+
+
+'''
+A cheap version of a file, to tell whether it changed: its size, and its
+modification time (local files), its checksum (mock files) or its number
+of part files and the latest modification time of a part file (HDFS), or
+None if it does not exist. On HDFS, versions take calls to the cluster,
+so they are cached for version_ttl seconds.
+'''
+
+versions = {}
+
+
+def target_version(target):
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget):
+        cached = versions.get(target.path)
+        if cached is not None and time.time() - cached[0] < resultcache().version_ttl:
+            return cached[1]
+        version = None
+        if target.exists():
+            count = target.fs.count(target.path)
+            version = [int(count['content_size']), int(count['file_count']), hdfs_modification_time(target)]
+        versions[target.path] = (time.time(), version)
+        return version
+    elif isinstance(target, MockTarget):
+        if not target.exists():
+            return None
+        data = target.fs.get_data(target.path)
+        return [len(data), zlib.crc32(data)]
+    else:
+        if not target.exists():
+            return None
+        stat = os.stat(target.path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+
+def hdfs_modification_time(target):
+    # In milliseconds; the times listed by "hadoop fs -ls" only have minutes.
+    path = target.path.rstrip("/") + "/*" if target.fs.isdir(target.path) else target.path
+    output = luigi.contrib.hdfs.hadoopcli_clients.HdfsClient.call_check(
+        luigi.contrib.hdfs.load_hadoop_cmd() + ['fs', '-stat', '%Y', path])
+    return max([int(line) for line in output.split('\n') if line.strip().isdigit()] or [0])
+
+
+'''
+Intermediate results are named by a hash of their (canonical) query and
+the versions of the input relations it reads, so queries that share a
+subquery share its result, and luigi's complete() check skips computing
+it again, as long as the inputs do not change.
+
+The results are kept in the cache directory. Once the root task of a
+query has finished, the least recently used results are removed until
+the results take at most max_size bytes (if max_size is positive).
+'''
+
+
+class resultcache(luigi.Config):
+    directory = luigi.Parameter(default="", description='Directory of the intermediate results')
+    max_size = luigi.IntParameter(default=0, description='Maximum total size of the results in bytes, 0 for no limit')
+    version_ttl = luigi.FloatParameter(default=60.0, description='Seconds to cache the versions of files on HDFS')
+
+
+RESULT_NAME = re.compile(r"^tmp[0-9a-f]{16}(\.tmp(\.[a-z0-9]+)?)?$")
+
+
+def base_relations(raquery):
+    if isinstance(raquery, radb.ast.RelRef):
+        return {raquery.rel}
+    result = set()
+    for input in raquery.inputs or []:
+        result |= base_relations(input)
+    return result
+
+
+def has_projection(raquery):
+    return isinstance(raquery, radb.ast.Project) or any(has_projection(input) for input in raquery.inputs or [])
+
+
+def result_path(filename):
+    directory = resultcache().directory
+    return os.path.join(directory, filename) if directory else filename
+
+
+def touch_result(target):
+    '''
+    Marks an intermediate result as used, for the eviction order.
+    '''
+    if not RESULT_NAME.match(os.path.basename(target.path)) or not target.exists():
+        return
+    if isinstance(target, MockTarget):
+        data = target.fs.get_all_data()
+        data[target.path] = data.pop(target.path)
+    elif not isinstance(target, luigi.contrib.hdfs.HdfsTarget):
+        os.utime(target.path)
+
+
+def list_results(env):
+    '''
+    Returns the intermediate results in the cache directory, least recently
+    used first, as lists of the paths that make up a result (the result
+    and its schema file) and their total size.
+    '''
+    directory = resultcache().directory
+    entries = []
+    if env == ExecEnv.MOCK:
+        data = MockTarget.fs.get_all_data()
+        for index, path in enumerate(data.keys()):
+            if os.path.dirname(path) == directory.rstrip("/"):
+                entries.append((index, path, len(data[path])))
+    elif env == ExecEnv.HDFS:
+        client = luigi.contrib.hdfs.get_autoconfig_client()
+        for path, size, modified in client.listdir(directory, include_size=True, include_time=True):
+            if RESULT_NAME.match(os.path.basename(path)):
+                # Results are folders of part files.
+                size = int(client.count(path)['content_size'])
+            entries.append((modified, path, size))
+    else:
+        for name in os.listdir(directory or "."):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                entries.append((os.stat(path).st_mtime_ns, path, os.path.getsize(path)))
+
+    results = collections.OrderedDict()
+    for used, path, size in sorted(entries, key=lambda entry: entry[0]):
+        name = path[:-len(".schema")] if path.endswith(".schema") else path
+        if RESULT_NAME.match(os.path.basename(name)):
+            paths, total = results.get(name, ([], 0))
+            results[name] = (paths + [path], total + size)
+    return list(results.values())
+
+
+def evict_results(env, max_size, keep=()):
+    results = list_results(env)
+    total = sum(size for _, size in results)
+    for paths, size in results:
+        if total <= max_size:
+            break
+        if any(path in keep for path in paths):
+            continue
+        for path in paths:
+            OutputMixin(exec_environment=env).get_output(path).remove()
+        total -= size
+    return total
+
+
 '''
 Counts the number of steps / luigi tasks that we need for evaluating this query.
 '''
@@ -87,6 +314,358 @@ def count_steps(raquery):
         raise Exception("count_steps: Cannot handle operator " + str(type(raquery)) + ".")
 
 
+'''
+Counts the MapReduce jobs of this query that can run at the same time:
+the jobs of the two inputs of a join are independent of each other, so
+the query has as many independent jobs as it has jobs reading only
+input relations.
+'''
+
+
+def count_parallel_steps(raquery):
+    assert (isinstance(raquery, radb.ast.Node))
+
+    if (isinstance(raquery, radb.ast.Select) or isinstance(raquery, radb.ast.Project) or
+            isinstance(raquery, radb.ast.Rename)):
+        return max(1, count_parallel_steps(raquery.inputs[0]))
+
+    elif isinstance(raquery, radb.ast.Join):
+        return max(1, count_parallel_steps(raquery.inputs[0]) + count_parallel_steps(raquery.inputs[1]))
+
+    elif isinstance(raquery, radb.ast.RelRef):
+        return 0
+
+    else:
+        raise Exception("count_parallel_steps: Cannot handle operator " + str(type(raquery)) + ".")
+
+
+class runner(luigi.Config):
+    max_workers = luigi.IntParameter(default=0, description='Maximum number of luigi workers, 0 for one per core')
+
+
+'''
+Evaluates a query, with one luigi worker per independent job (up to
+max_workers), so the inputs of joins are computed at the same time.
+Returns the task, whose output is the result of the query, and whether
+luigi could evaluate it.
+'''
+
+
+def run_query(raquery, env=ExecEnv.HDFS, workers=None):
+    task = task_factory(raquery, env=env)
+    if workers is None:
+        workers = min(max(1, count_parallel_steps(raquery)), runner().max_workers or os.cpu_count() or 1)
+    ok = luigi.build([task], local_scheduler=True, workers=workers)
+    if not ok:
+        logger.error('run_query: Cannot evaluate %s', raquery)
+    return task, ok
+
+
+'''
+Resolves an attribute reference against the (fully qualified) attribute
+names of a tuple, e.g. "gender" or "Person.gender" -> "Person.gender".
+'''
+
+
+def resolve_attribute(attr, keys):
+    key = find_attribute(attr, keys)
+    if key is None:
+        raise Exception("resolve_attribute: Invalid attribute reference " + str(attr) + ".")
+    return key
+
+
+def find_attribute(attr, keys):
+    assert (isinstance(attr, radb.ast.AttrRef))
+
+    if attr.rel is not None:
+        key = attr.rel + "." + attr.name
+        return key if key in keys else None
+
+    matches = [key for key in keys if key.rsplit(".", 1)[-1] == attr.name]
+    if len(matches) > 1:
+        raise Exception("find_attribute: Ambiguous attribute reference " + str(attr) + ".")
+    return matches[0] if matches else None
+
+
+'''
+Orders two values. As in SQL, a comparison with NULL (None) is unknown,
+and so does not hold; neither does a comparison of values that cannot be
+ordered, e.g. a string and a number. Arithmetic on NULL yields NULL.
+'''
+
+
+def ordering(op):
+    def compare(left, right):
+        if left is None or right is None:
+            return False
+        try:
+            return op(left, right)
+        except TypeError:
+            return False
+    return compare
+
+
+def nullable(op):
+    return lambda left, right: None if left is None or right is None else op(left, right)
+
+
+'''
+Compiles a condition into a single Python closure over a tuple.
+Attribute references are resolved against the attribute names in keys
+once, so evaluating the closure costs one dict lookup per referenced
+attribute and no further work on the syntax tree.
+'''
+
+COMPARISONS = {
+    radb.ast.sym.EQ: operator.eq,
+    radb.ast.sym.NE: operator.ne,
+    radb.ast.sym.LT: ordering(operator.lt),
+    radb.ast.sym.LE: ordering(operator.le),
+    radb.ast.sym.GT: ordering(operator.gt),
+    radb.ast.sym.GE: ordering(operator.ge),
+}
+
+ARITHMETICS = {
+    radb.ast.sym.PLUS: nullable(operator.add),
+    radb.ast.sym.MINUS: nullable(operator.sub),
+    radb.ast.sym.STAR: nullable(operator.mul),
+    radb.ast.sym.SLASH: nullable(operator.truediv),
+    radb.ast.sym.CONCAT: lambda left, right: str(left) + str(right),
+}
+
+
+def literal_value(literal):
+    if isinstance(literal, radb.ast.RAString):
+        return radb.ast.sqlstr_to_str(literal.val)
+    elif isinstance(literal, radb.ast.RANumber):
+        try:
+            return int(literal.val)
+        except ValueError:
+            return float(literal.val)
+    else:
+        raise Exception("literal_value: Cannot handle literal " + str(type(literal)) + ".")
+
+
+def compile_condition(cond, keys):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        op = cond.op
+        if op == radb.ast.sym.AND:
+            left = compile_condition(cond.inputs[0], keys)
+            right = compile_condition(cond.inputs[1], keys)
+            return lambda t: left(t) and right(t)
+        elif op == radb.ast.sym.OR:
+            left = compile_condition(cond.inputs[0], keys)
+            right = compile_condition(cond.inputs[1], keys)
+            return lambda t: left(t) or right(t)
+        elif op in COMPARISONS:
+            return compile_binary(COMPARISONS[op], cond.inputs[0], cond.inputs[1], keys)
+        elif op in ARITHMETICS:
+            return compile_binary(ARITHMETICS[op], cond.inputs[0], cond.inputs[1], keys)
+
+    elif isinstance(cond, radb.ast.ValExprUnaryOp):
+        inner = compile_condition(cond.inputs[0], keys)
+        if cond.op == radb.ast.sym.NOT:
+            return lambda t: not inner(t)
+        elif cond.op == radb.ast.sym.IS_NULL:
+            return lambda t: inner(t) is None
+        elif cond.op == radb.ast.sym.IS_NOT_NULL:
+            return lambda t: inner(t) is not None
+
+    elif isinstance(cond, radb.ast.AttrRef):
+        return operator.itemgetter(resolve_attribute(cond, keys))
+
+    elif isinstance(cond, radb.ast.Literal):
+        value = literal_value(cond)
+        return lambda t: value
+
+    raise Exception("compile_condition: Cannot handle " + str(cond) + ".")
+
+
+'''
+Specializes the common shapes "attribute op literal" and
+"attribute op attribute", so that they do not pay for nested closures.
+'''
+
+
+def compile_binary(op, left, right, keys):
+    if isinstance(left, radb.ast.AttrRef) and isinstance(right, radb.ast.Literal):
+        key, value = resolve_attribute(left, keys), literal_value(right)
+        return lambda t: op(t[key], value)
+    elif isinstance(left, radb.ast.Literal) and isinstance(right, radb.ast.AttrRef):
+        value, key = literal_value(left), resolve_attribute(right, keys)
+        return lambda t: op(value, t[key])
+    elif isinstance(left, radb.ast.AttrRef) and isinstance(right, radb.ast.AttrRef):
+        key1, key2 = resolve_attribute(left, keys), resolve_attribute(right, keys)
+        return lambda t: op(t[key1], t[key2])
+
+    left = compile_condition(left, keys)
+    right = compile_condition(right, keys)
+    return lambda t: op(left(t), right(t))
+
+
+
+'''
+Splits a join condition into the pairs of attributes that must be equal.
+Only equi-joins, i.e. conjunctions of equalities between attributes,
+can be evaluated by partitioning or hashing on the join key.
+'''
+
+
+def join_attributes(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.AND:
+        return join_attributes(cond.inputs[0]) + join_attributes(cond.inputs[1])
+
+    elif isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.EQ and\
+            isinstance(cond.inputs[0], radb.ast.AttrRef) and isinstance(cond.inputs[1], radb.ast.AttrRef):
+        return [(cond.inputs[0], cond.inputs[1])]
+
+    raise Exception("join_attributes: Cannot handle join condition " + str(cond) + ".")
+
+
+'''
+Compiles a function that extracts the join key from the tuples of one
+join input, given its attribute names. Each pair of join attributes
+contributes the attribute that belongs to this input.
+'''
+
+
+def compile_join_key(pairs, keys):
+    join_keys = []
+    for attr1, attr2 in pairs:
+        key = find_attribute(attr1, keys)
+        if key is None:
+            key = resolve_attribute(attr2, keys)
+        join_keys.append(key)
+    return operator.itemgetter(*join_keys)
+
+
+'''
+Compiles one unary operator (selection, projection or renaming) for an
+input relation with the given attribute names. Returns the relation name
+and attribute names of the output, together with a function that maps an
+input tuple to its output tuple, or to None if the tuple is filtered out.
+'''
+
+
+def compile_unary(raquery, relation, keys):
+    if isinstance(raquery, radb.ast.Select):
+        predicate = compile_condition(raquery.cond, keys)
+        return relation, keys, lambda t: t if predicate(t) else None
+
+    elif isinstance(raquery, radb.ast.Project):
+        for attr in raquery.attrs:
+            if not isinstance(attr, radb.ast.AttrRef):
+                raise Exception("compile_unary: Cannot project on expression " + str(attr) + ".")
+        projected = [resolve_attribute(attr, keys) for attr in raquery.attrs]
+        return relation, projected, lambda t: {key: t[key] for key in projected}
+
+    elif isinstance(raquery, radb.ast.Rename):
+        renamed = []
+        for i, key in enumerate(keys):
+            rel, name = key.rsplit(".", 1)
+            if raquery.relname is not None:
+                rel = raquery.relname
+            if raquery.attrnames is not None:
+                name = raquery.attrnames[i]
+            renamed.append(rel + "." + name)
+        pairs = list(zip(keys, renamed))
+        if raquery.relname is not None:
+            relation = raquery.relname
+        return relation, renamed, lambda t: {new: t[old] for old, new in pairs}
+
+    else:
+        raise Exception("compile_unary: Cannot handle operator " + str(type(raquery)) + ".")
+
+
+'''
+Operator fusion: splits off the chain of consecutive unary operators at
+the top of a query. Returns the operators in evaluation order (innermost
+first) and the input of the chain, i.e. a join or a relation.
+'''
+
+UNARY_OPERATORS = (radb.ast.Select, radb.ast.Project, radb.ast.Rename)
+
+
+def unary_chain(raquery):
+    operators = []
+    while isinstance(raquery, UNARY_OPERATORS):
+        operators.insert(0, raquery)
+        raquery = raquery.inputs[0]
+    return operators, raquery
+
+
+def compile_pipeline(operators, relation, keys):
+    functions = []
+    for raquery in operators:
+        relation, keys, function = compile_unary(raquery, relation, keys)
+        functions.append(function)
+
+    def pipeline(t):
+        for function in functions:
+            t = function(t)
+            if t is None:
+                return None
+        return t
+
+    return relation, keys, pipeline
+
+
+'''
+The attributes of its input tuples that a chain of selections and
+projections reads: those in the conditions, and those projected on.
+Returns None if the chain reads all of them, i.e. if it renames them
+or has no projection.
+'''
+
+
+def condition_attributes(cond):
+    if isinstance(cond, radb.ast.AttrRef):
+        return [cond]
+    return [attr for input in getattr(cond, 'inputs', []) for attr in condition_attributes(input)]
+
+
+def pipeline_attributes(operators, keys):
+    if any(isinstance(raquery, radb.ast.Rename) for raquery in operators) or\
+            not any(isinstance(raquery, radb.ast.Project) for raquery in operators):
+        return None
+
+    needed, output = set(), keys
+    for raquery in operators:
+        if isinstance(raquery, radb.ast.Select):
+            needed.update(resolve_attribute(attr, output) for attr in condition_attributes(raquery.cond))
+        else:
+            output = compile_unary(raquery, None, output)[1]
+    needed.update(output)
+    return [key for key in keys if key in needed]
+
+
+'''
+Parses only the given attributes of a tuple encoded as a JSON object:
+the value of each attribute is decoded where its name occurs as a key
+in the line, and the values of the others are not parsed. Attribute
+values are scalars, and quotes within JSON strings are escaped, so a
+quoted name followed by a colon can only be a key. Returns None if an
+attribute is not found (e.g. since its name was written with escapes).
+'''
+
+DECODER = json.JSONDecoder()
+
+
+def attribute_parser(keys):
+    patterns = [(key, re.compile(re.escape(json.dumps(key)) + r'\s*:\s*')) for key in keys]
+
+    def parse(tuple):
+        json_tuple = {}
+        for key, pattern in patterns:
+            match = pattern.search(tuple)
+            if match is None:
+                return None
+            json_tuple[key] = DECODER.raw_decode(tuple, match.end())[0]
+        return json_tuple
+
+    return parse
+
+
 class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
     '''
     Each physical operator knows its (partial) query string.
@@ -97,22 +676,481 @@ class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
 
     '''
     Each physical operator within a query has its own step-id.
-    This is used to rename the temporary files for exhanging
-    data between chained MapReduce jobs.
+    The root of the query has step 1, its output is always
+    written as JSON objects.
     '''
     step = luigi.IntParameter(default=1)
 
     '''
-    In HDFS, we call the folders for temporary data tmp1, tmp2, ...
-    In the local or mock file system, we call the files tmp1.tmp...
+    Whether an operator above this one eliminates duplicates. Under set
+    semantics, duplicates in the output of this operator then do not
+    change the result of the query, so it need not eliminate them.
+    '''
+    distinct_above = luigi.BoolParameter(default=False)
+
+    '''
+    In HDFS, we call the folders for temporary data tmp<key>, in the local
+    or mock file system, we call the files tmp<key>.tmp, where key is the
+    hash of the query, its input versions and the output format.
     '''
 
     def output(self):
+        codec = self.codec()
         if self.exec_environment == ExecEnv.HDFS:
-            filename = "tmp" + str(self.step)
+            # Hadoop names the compressed part files in this folder.
+            filename = "tmp" + self.result_key()
+        else:
+            filename = "tmp" + self.result_key() + ".tmp" + blockcompress.EXTENSIONS.get(codec, "")
+        return self.get_output(result_path(filename), codec)
+
+    def result_key(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        inputs = [(relation, target_version(InputData(filename=relation + ".json",
+                                                      exec_environment=self.exec_environment).output()))
+                  for relation in sorted(base_relations(raquery))]
+        packed = self.step > 1 and intermediate().format == "packed"
+        # Projections below an operator that eliminates duplicates keep them, so their results differ.
+        duplicates = [True] if self.distinct_above and has_projection(raquery) else []
+        key = json.dumps([str(raquery), inputs, packed, self.codec()] + duplicates)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def jobconfs(self):
+        jcs = super(RelAlgQueryTask, self).jobconfs()
+        shuffle = blockcompress.compression().shuffle
+        jcs.extend(blockcompress.hadoop_jobconfs(self.codec(), shuffle if shuffle != "none" else None))
+        return jcs
+
+    '''
+    The query string is parsed once per map (or reduce) task, instead of
+    once per input record. Subclasses extend compile() to precompute
+    whatever else their mapper and reducer need from the parsed query.
+    '''
+
+    def init_mapper(self):
+        self.compile()
+
+    def init_combiner(self):
+        self.compile()
+
+    def init_reducer(self):
+        self.compile()
+
+    def compile(self):
+        self.raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.parsers = {}
+
+    '''
+    Before the job is launched, the schemas of all inputs are read on the
+    client and shipped with the job, as is the output schema if the output
+    is an intermediate result in the packed format. The root of the plan
+    (step 1) always writes JSON objects.
+    '''
+    output_attrs = None
+
+    def init_local(self):
+        super(RelAlgQueryTask, self).init_local()
+        self.input_schemas = [read_schema(target) for target in luigi.task.flatten(self.input())]
+        self.schemas = dict(schema for schema in self.input_schemas if schema is not None)
+
+        self.output_attrs = None
+        if self.step > 1 and intermediate().format == "packed":
+            schema = self.output_schema()
+            self.output_attrs = schema[1] if schema is not None else []
+
+    def run(self):
+        for target in luigi.task.flatten(self.input()):
+            touch_result(target)
+
+        super(RelAlgQueryTask, self).run()
+        if self.output_attrs is not None:
+            write_schema(self.output(), self.output_schema())
+
+        if self.step == 1 and resultcache().max_size > 0:
+            evict_results(self.exec_environment, resultcache().max_size, keep=[self.output().path])
+
+    def output_schema(self):
+        operators, _ = unary_chain(radb.parse.one_statement_from_string(self.querystring))
+        if self.input_schemas[0] is None:
+            return None
+        relation, keys, _ = compile_pipeline(operators, *self.input_schemas[0])
+        return relation, keys
+
+    '''
+    Reader and writer for the tuples in input and output lines, in either
+    format.
+    '''
+
+    def read_tuple(self, line):
+        relation, tuple = self.split_line(line)
+        return relation, self.decode_tuple(relation, tuple)
+
+    def split_line(self, line):
+        if isinstance(line, bytes):
+            # A line of an input relation, as cut out of the memory map (see MappedJobRunner).
+            tab = line.find(b'\t')
+            return line[:tab].decode('utf-8'), line[tab + 1:].decode('utf-8')
+        return line.split('\t')
+
+    def decode_tuple(self, relation, tuple):
+        if tuple.startswith('['):
+            return dict(zip(self.schemas[relation], json.loads(tuple)))
+        return json.loads(tuple)
+
+    def encode_tuple(self, json_tuple, separators=None):
+        if self.output_attrs is not None:
+            return json.dumps([json_tuple[attr] for attr in self.output_attrs], separators=(',', ':'))
+        return json.dumps(json_tuple, separators=separators)
+
+    '''
+    Mappers that only need some attributes of their input tuples only
+    parse those (see attribute_parser). Given the attribute names of the
+    first tuple of a relation, which is parsed as a whole, attributes
+    returns the names of the attributes needed, or None for all of them.
+    Packed tuples, and tuples in which not all of the attributes are
+    found, are parsed as a whole.
+    '''
+
+    def read_attributes(self, relation, tuple, attributes):
+        parser = self.parsers.get(relation)
+        if parser is None:
+            json_tuple = self.decode_tuple(relation, tuple)
+            keys = None if tuple.startswith('[') else attributes(list(json_tuple))
+            self.parsers[relation] = attribute_parser(keys) if keys else (lambda tuple: None)
+            return json_tuple
+        return parser(tuple) or self.decode_tuple(relation, tuple)
+
+    def job_runner(self):
+        if self.exec_environment == ExecEnv.PARALLEL:
+            return mrpool.PoolJobRunner()
+        elif self.exec_environment != ExecEnv.HDFS:
+            return MappedJobRunner()
+        return super(RelAlgQueryTask, self).job_runner()
+
+    '''
+    Outside of HDFS, the job runners read input relations through a memory
+    map (see MappedInput), not through a text file object. Intermediate
+    results are still read as text. The local runner hands the lines of
+    input relations to the mappers as bytes (see MappedJobRunner), and
+    the mappers only parse the attributes they need (see read_attributes).
+    '''
+
+    def input_hadoop(self):
+        targets = []
+        for task in luigi.task.flatten(self.requires_hadoop()):
+            for target in luigi.task.flatten(task.output()):
+                if isinstance(task, InputData) and self.exec_environment != ExecEnv.HDFS and mappable(target):
+                    target = MappedInput(target)
+                targets.append(target)
+        return targets
+
+
+'''
+Relations can additionally be stored in buckets (see buckets.py): the
+tuples of <Relation>.json are hash-partitioned on a key attribute into
+a number of bucket files, each sorted on the key, and described by the
+manifest <Relation>.buckets.json. A manifest is only used while the
+version of <Relation>.json it was written for is current.
+'''
+
+
+def bucket_manifest(relation, env):
+    target = InputData(filename=relation + ".buckets.json", exec_environment=env).output()
+    if not target.exists():
+        return None
+    with target.open('r') as f:
+        manifest = json.load(f)
+    if manifest["version"] != target_version(InputData(filename=relation + ".json", exec_environment=env).output()):
+        return None
+    return manifest
+
+
+def bucket_of(value, buckets):
+    return zlib.crc32(json.dumps(value).encode('utf-8')) % buckets
+
+
+'''
+The order of the tuples within a bucket. Any order works for the merge
+join, as long as both inputs use the same one.
+'''
+
+
+def bucket_sort_key(value):
+    return json.dumps(value, sort_keys=True)
+
+
+'''
+Returns the manifests of both inputs of a join if they are relations
+bucketed the same way on the join key, so the join can run bucket by
+bucket without a shuffle, or None.
+'''
+
+
+def bucketed_join(raquery, env):
+    if not all(isinstance(input, radb.ast.RelRef) for input in raquery.inputs):
+        return None
+    manifests = [bucket_manifest(input.rel, env) for input in raquery.inputs]
+    if None in manifests or manifests[0]["buckets"] != manifests[1]["buckets"]:
+        return None
+
+    pairs = join_attributes(raquery.cond)
+    if len(pairs) != 1:
+        return None
+    keys = [[manifest["key"]] for manifest in manifests]
+    attr1, attr2 = pairs[0]
+    for first, second in [(attr1, attr2), (attr2, attr1)]:
+        if find_attribute(first, keys[0]) is not None and find_attribute(second, keys[1]) is not None:
+            return manifests
+    return None
+
+
+'''
+Secondary indexes on attributes of input relations (see indexes.py).
+The index <Relation>.<attribute>.index starts with a JSON header line
+(relation, key attribute, and the version of <Relation>.json it was
+built for), followed by one line "<key>\t<offset>" per tuple, sorted on
+the key, where offset is the byte offset of the tuple's line in
+<Relation>.json. Keys are bucket_sort_key(value), so the index is
+searched for a value by binary search over the raw bytes, without
+reading or decoding the whole index.
+
+Indexes are only used in the LOCAL, PARALLEL and MOCK environments,
+where files can be read at arbitrary offsets: local files are memory
+mapped, mock files are in memory anyway.
+'''
+
+
+def index_filename(relation, attribute):
+    return relation + "." + attribute.rsplit(".", 1)[-1] + ".index"
+
+
+def mappable(target):
+    return isinstance(target, (MockTarget, luigi.LocalTarget)) and blockcompress.codec_for_path(target.path) is None
+
+
+class MappedTarget(object):
+    '''
+    The raw bytes of a (local or mock) file, to be read by offsets, or
+    line by line without going through a text file object: lines are
+    found with find() over the bytes, and only the lines returned are
+    copied out of the memory map.
+    '''
+
+    def __init__(self, target):
+        self.file = None
+        if isinstance(target, MockTarget):
+            self.data = target.fs.get_data(target.path)
         else:
-            filename = "tmp" + str(self.step) + ".tmp"
-        return self.get_output(filename)
+            self.file = open(target.path, 'rb')
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(target.path) else b''
+
+    def line(self, offset):
+        end = self.data.find(b'\n', offset)
+        return self.data[offset:end if end >= 0 else len(self.data)]
+
+    def lines(self, needles=()):
+        '''
+        Yields the non-empty lines. With needles, only the lines that
+        contain all of them: the data is searched for the first needle,
+        so the lines in between are skipped without being looked at.
+        '''
+        data = self.data
+        if not needles:
+            start = 0
+            while start < len(data):
+                end = data.find(b'\n', start)
+                end = end if end >= 0 else len(data)
+                if end > start:
+                    yield data[start:end]
+                start = end + 1
+            return
+
+        position = data.find(needles[0])
+        while position >= 0:
+            start = data.rfind(b'\n', 0, position) + 1
+            end = data.find(b'\n', position)
+            end = end if end >= 0 else len(data)
+            if all(data.find(needle, start, end) >= 0 for needle in needles[1:]):
+                yield data[start:end]
+            position = data.find(needles[0], end)
+
+    def close(self):
+        if self.file is not None:
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def index_header(relation, attribute, env):
+    if env == ExecEnv.HDFS:
+        return None
+    target = InputData(filename=index_filename(relation, attribute), exec_environment=env).output()
+    if not target.exists():
+        return None
+    with target.open('r') as f:
+        header = json.loads(f.readline())
+    if header["version"] != target_version(InputData(filename=relation + ".json", exec_environment=env).output()):
+        return None
+    return header
+
+
+'''
+The key of a value in an index. A selection finds 7 = 7.0, so numbers
+that are integers are stored as such, whether they were written as
+integers or as floats.
+'''
+
+
+def index_key(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return bucket_sort_key(value)
+
+
+'''
+Returns the byte offsets of the tuples of a relation whose attribute
+has the given value, from the index.
+'''
+
+
+def index_lookup(relation, attribute, value, env):
+    target = InputData(filename=index_filename(relation, attribute), exec_environment=env).output()
+    key = index_key(value).encode('utf-8') + b'\t'
+    offsets = []
+    with MappedTarget(target) as index:
+        data = index.data
+        start = data.find(b'\n') + 1
+
+        # Find the first line whose key is not smaller than the value.
+        lo, hi = start, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = max(data.rfind(b'\n', start, mid) + 1, start)
+            line = index.line(line_start)
+            if line[:line.rfind(b'\t') + 1] < key:
+                lo = line_start + len(line) + 1
+            else:
+                hi = line_start
+
+        while lo < len(data):
+            line = index.line(lo)
+            if not line.startswith(key) or b'\t' in line[len(key):]:
+                break
+            offsets.append(int(line[len(key):]))
+            lo += len(line) + 1
+    return offsets
+
+
+'''
+Returns the attribute and value of an equality "attribute = literal" in
+the condition of a selection on an input relation, for which there is a
+usable index, or None.
+'''
+
+
+def indexed_equality(raquery, env):
+    if not isinstance(raquery.inputs[0], radb.ast.RelRef):
+        return None
+    relation = raquery.inputs[0].rel
+
+    conditions = [raquery.cond]
+    while conditions:
+        cond = conditions.pop(0)
+        if not isinstance(cond, radb.ast.ValExprBinaryOp):
+            continue
+        if cond.op == radb.ast.sym.AND:
+            conditions.extend(cond.inputs)
+        elif cond.op == radb.ast.sym.EQ:
+            for attr, literal in [cond.inputs, reversed(cond.inputs)]:
+                if isinstance(attr, radb.ast.AttrRef) and isinstance(literal, radb.ast.Literal) and\
+                        attr.rel in (None, relation):
+                    header = index_header(relation, attr.name, env)
+                    if header is not None:
+                        return header["key"], literal_value(literal)
+    return None
+
+
+'''
+Zone maps (see zonemaps.py): an input relation can additionally be
+stored in blocks of about block_size bytes, <Relation>.block-00000.json,
+..., described by the sidecar <Relation>.zonemap.json, which records the
+minimum, maximum and number of NULLs of every attribute in every block.
+A selection on the relation only reads the blocks whose ranges can
+satisfy its condition. A zone map is only used while the version of
+<Relation>.json it was built for is current.
+'''
+
+
+def zone_map(relation, env):
+    target = InputData(filename=relation + ".zonemap.json", exec_environment=env).output()
+    if not target.exists():
+        return None
+    with target.open('r') as f:
+        zonemap = json.load(f)
+    if zonemap["version"] != target_version(InputData(filename=relation + ".json", exec_environment=env).output()):
+        return None
+    return zonemap
+
+
+MIRRORED_COMPARISONS = {
+    radb.ast.sym.EQ: radb.ast.sym.EQ,
+    radb.ast.sym.LT: radb.ast.sym.GT,
+    radb.ast.sym.LE: radb.ast.sym.GE,
+    radb.ast.sym.GT: radb.ast.sym.LT,
+    radb.ast.sym.GE: radb.ast.sym.LE,
+}
+
+'''
+Whether some value in [low, high] can satisfy "value op literal".
+'''
+
+RANGE_OVERLAPS = {
+    radb.ast.sym.EQ: lambda low, high, value: low <= value <= high,
+    radb.ast.sym.LT: lambda low, high, value: low < value,
+    radb.ast.sym.LE: lambda low, high, value: low <= value,
+    radb.ast.sym.GT: lambda low, high, value: high > value,
+    radb.ast.sym.GE: lambda low, high, value: high >= value,
+}
+
+
+def block_may_match(cond, block, relation):
+    '''
+    Returns False if no tuple of the block can satisfy the condition,
+    judging by the comparisons of attributes with literals in its
+    conjunction, and True otherwise.
+    '''
+    if not isinstance(cond, radb.ast.ValExprBinaryOp):
+        return True
+    if cond.op == radb.ast.sym.AND:
+        return block_may_match(cond.inputs[0], block, relation) and block_may_match(cond.inputs[1], block, relation)
+    if cond.op not in MIRRORED_COMPARISONS:
+        return True
+
+    left, right = cond.inputs
+    op = cond.op
+    if isinstance(left, radb.ast.Literal) and isinstance(right, radb.ast.AttrRef):
+        left, right, op = right, left, MIRRORED_COMPARISONS[op]
+    if not isinstance(left, radb.ast.AttrRef) or not isinstance(right, radb.ast.Literal) or\
+            left.rel not in (None, relation):
+        return True
+
+    attribute = block["attributes"].get(relation + "." + left.name)
+    if attribute is None:
+        return True
+    if attribute["nulls"] == block["rows"]:
+        # NULL satisfies no comparison.
+        return False
+    if attribute["min"] is None or attribute["max"] is None:
+        return True
+    try:
+        return RANGE_OVERLAPS[op](attribute["min"], attribute["max"], literal_value(right))
+    except TypeError:
+        return True
 
 
 '''
@@ -121,24 +1159,37 @@ this produces a tree of luigi tasks with the physical query operators.
 '''
 
 
-def task_factory(raquery, step=1, env=ExecEnv.HDFS):
+def task_factory(raquery, step=1, env=ExecEnv.HDFS, distinct_above=False):
     assert (isinstance(raquery, radb.ast.Node))
 
-    if isinstance(raquery, radb.ast.Select):
-        return SelectTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+    if isinstance(raquery, UNARY_OPERATORS) and isinstance(raquery.inputs[0], UNARY_OPERATORS):
+        # Evaluate a chain of unary operators within a single MapReduce job.
+        return FusedTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                         distinct_above=distinct_above)
+
+    elif isinstance(raquery, radb.ast.Select):
+        return SelectTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                          distinct_above=distinct_above)
 
     elif isinstance(raquery, radb.ast.RelRef):
         filename = raquery.rel + ".json"
         return InputData(filename=filename, exec_environment=env)
 
+    elif isinstance(raquery, radb.ast.Join) and bucketed_join(raquery, env) is not None:
+        return BucketJoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                              distinct_above=distinct_above)
+
     elif isinstance(raquery, radb.ast.Join):
-        return JoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+        return JoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                        distinct_above=distinct_above)
 
     elif isinstance(raquery, radb.ast.Project):
-        return ProjectTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+        return ProjectTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                           distinct_above=distinct_above)
 
     elif isinstance(raquery, radb.ast.Rename):
-        return RenameTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+        return RenameTask(querystring=str(raquery) + ";", step=step, exec_environment=env,
+                          distinct_above=distinct_above)
 
     else:
         # We will not evaluate the Cross product on Hadoop, too expensive.
@@ -146,126 +1197,629 @@ def task_factory(raquery, step=1, env=ExecEnv.HDFS):
 
 
 class JoinTask(RelAlgQueryTask):
+    '''
+    By default, a join input of at most broadcast_threshold bytes is not
+    shuffled: it is shipped to all mappers with the job instead, which load
+    it into a hash table and probe it with the tuples of the other input,
+    in a map-only job. Otherwise both inputs are repartitioned on the join
+    key. join_strategy forces one of the two strategies.
+    '''
+    join_strategy = luigi.ChoiceParameter(choices=["auto", "broadcast", "repartition"], default="auto",
+                                          significant=False)
+    broadcast_threshold = luigi.IntParameter(default=16 * 1024 * 1024, significant=False)
+
+    '''
+    Skew handling for the repartition join: skew_sample_size tuples of
+    each input are sampled in skew_sample_runs runs of consecutive tuples
+    (see sample_target), and every join key that makes up at least
+    skew_threshold of the sample is split across skew_partitions reducers.
+    Probe tuples of such a key are spread round-robin over the partitions,
+    build tuples are replicated to all of them. A value of skew_partitions
+    below 2 disables skew handling.
+    '''
+    skew_sample_size = luigi.IntParameter(default=10000, significant=False)
+    skew_sample_runs = luigi.IntParameter(default=16, significant=False)
+    skew_threshold = luigi.FloatParameter(default=0.1, significant=False)
+    skew_partitions = luigi.IntParameter(default=8, significant=False)
+
+    '''
+    Semi-join reduction for the repartition join: with bloom_filter set, a
+    Bloom filter over the join keys of the build input is shipped to the
+    mappers, which drop the probe tuples whose key is not in it before the
+    shuffle. The filter has bloom_bits bits, or as many as it needs for a
+    false positive rate of bloom_error_rate if bloom_bits is 0. The number
+    of dropped tuples is reported in the "JoinTask" counter group.
+    '''
+    bloom_filter = luigi.BoolParameter(default=False, significant=False)
+    bloom_bits = luigi.IntParameter(default=0, significant=False)
+    bloom_error_rate = luigi.FloatParameter(default=0.01, significant=False)
+
+    '''
+    Index of the broadcast input, if any, and of the build input of the
+    repartition join. Decided when the job is run, since only then the
+    sizes of both inputs are known.
+    '''
+    broadcast = None
+    build = 0
+    skewed_keys = ()
+    bloom = None
+
+    '''
+    Projections directly below the join, as inserted by projection
+    pushdown (see raopt), are evaluated by the mappers of the join as they
+    read the input, instead of in a job of their own, which would shuffle
+    the whole input to eliminate duplicates. Only if an operator above
+    eliminates duplicates, since the join does not.
+    '''
+
+    def join_inputs(self, raquery):
+        projections = []
+        inputs = []
+        for input in raquery.inputs:
+            if self.distinct_above and isinstance(input, radb.ast.Project):
+                projections.append(input)
+                inputs.append(input.inputs[0])
+            else:
+                projections.append(None)
+                inputs.append(input)
+        return projections, inputs
+
+    def project(self, relation, json_tuple):
+        projection = self.projections.get(relation)
+        if projection is None:
+            return json_tuple
+        project = self.projectors.get(relation)
+        if project is None:
+            _, _, project = compile_unary(projection, relation, list(json_tuple))
+            self.projectors[relation] = project
+        return project(json_tuple)
+
+    def init_local(self):
+        # Luigi reuses task instances, so forget the decisions of earlier runs.
+        self.broadcast = None
+        self.skewed_keys = ()
+        self.bloom = None
+        vars(self).pop('reducer', None)
+        super(JoinTask, self).init_local()
+
+        inputs = self.input()
+        sizes = [target_size(target) for target in inputs]
+        smaller = sizes.index(min(sizes))
+
+        # Each input holds the tuples of one relation name, which tells the mappers their side.
+        self.relations = [schema[0] if schema is not None else None for schema in self.input_schemas]
+        self.build = smaller
+
+        if self.join_strategy == "broadcast" or\
+                (self.join_strategy == "auto" and sizes[smaller] <= self.broadcast_threshold):
+            self.broadcast = smaller
+            self.broadcast_lines = list(read_target(inputs[smaller]))
+            self.reducer = NotImplemented
+        else:
+            if self.bloom_filter:
+                self.bloom = self.build_bloom_filter(inputs[self.build])
+            if self.skew_partitions > 1:
+                self.skewed_keys = self.sample_skewed_keys(inputs)
+                if self.skewed_keys:
+                    logger.info('%s: splitting skewed join keys %s', self, ', '.join(map(repr, self.skewed_keys)))
+
+    def output_schema(self):
+        if None in self.input_schemas:
+            return None
+        projections, _ = self.join_inputs(radb.parse.one_statement_from_string(self.querystring))
+        (relation, left), (_, right) = [compile_unary(projection, *schema)[:2] if projection is not None else schema
+                                        for projection, schema in zip(projections, self.input_schemas)]
+        return relation, left + right
+
+    def sample_skewed_keys(self, inputs):
+        pairs = join_attributes(radb.parse.one_statement_from_string(self.querystring).cond)
+        counts = {}
+        total = 0
+        for target in inputs:
+            join_key = None
+            for line in sample_target(target, self.skew_sample_size, self.skew_sample_runs):
+                relation, json_tuple = self.read_tuple(line)
+                if join_key is None:
+                    join_key = compile_join_key(pairs, json_tuple)
+                key = join_key(json_tuple)
+                counts[key] = counts.get(key, 0) + 1
+                total += 1
+
+        return sorted((key for key, count in counts.items() if count >= self.skew_threshold * total), key=repr)
+
+    def build_bloom_filter(self, target):
+        pairs = join_attributes(radb.parse.one_statement_from_string(self.querystring).cond)
+        keys = set()
+        join_key = None
+        for line in read_target(target):
+            relation, json_tuple = self.read_tuple(line)
+            if join_key is None:
+                join_key = compile_join_key(pairs, json_tuple)
+            keys.add(join_key(json_tuple))
+
+        bloom = bloomfilter.BloomFilter.for_keys(keys, self.bloom_error_rate, self.bloom_bits)
+        logger.info('%s: Bloom filter of %d bits over %d join keys', self, bloom.bits, len(keys))
+        return bloom
+
+    def requires_hadoop(self):
+        tasks = self.requires()
+        if self.broadcast is not None:
+            return [tasks[1 - self.broadcast]]
+        return tasks
+
+    def deps(self):
+        # The broadcast input is not read by the mappers, but must be there.
+        return luigi.task.flatten(self.requires())
 
     def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Join))
 
-        task1 = task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)
-        task2 = task_factory(raquery.inputs[1], step=self.step + count_steps(raquery.inputs[0]) + 1,
-                             env=self.exec_environment)
+        _, inputs = self.join_inputs(raquery)
+        task1 = task_factory(inputs[0], step=self.step + 1, env=self.exec_environment,
+                             distinct_above=self.distinct_above)
+        task2 = task_factory(inputs[1], step=self.step + count_steps(raquery.inputs[0]) + 1,
+                             env=self.exec_environment, distinct_above=self.distinct_above)
 
         return [task1, task2]
 
+    def compile(self):
+        super(JoinTask, self).compile()
+        self.pairs = join_attributes(self.raquery.cond)
+        self.join_keys = {}
+        self.salts = dict((key, 0) for key in self.skewed_keys)
+        projections, _ = self.join_inputs(self.raquery)
+        self.projections = dict((relation, projection) for relation, projection in zip(self.relations, projections)
+                                if projection is not None)
+        self.projectors = {}
+
+        if self.broadcast is not None:
+            self.table = {}
+            self.broadcast_relation = None
+            for line in self.broadcast_lines:
+                relation, json_tuple = self.read_tuple(line)
+                key = self.join_key(relation, json_tuple)(json_tuple)
+                self.table.setdefault(key, []).append(self.project(relation, json_tuple))
+                self.broadcast_relation = relation
+
+    '''
+    The join key is extracted by a function compiled once per relation.
+    '''
+
+    def join_key(self, relation, json_tuple):
+        join_key = self.join_keys.get(relation)
+        if join_key is None:
+            join_key = compile_join_key(self.pairs, json_tuple)
+            self.join_keys[relation] = join_key
+        return join_key
+
     def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        if self.broadcast is not None:
+            return self.probe(line)
+        return self.repartition(line)
+
+    def probe(self, line):
+        relation, json_tuple = self.read_tuple(line)
+
+        matches = self.table.get(self.join_key(relation, json_tuple)(json_tuple), ())
+        if matches:
+            json_tuple = self.project(relation, json_tuple)
+        for match in matches:
+            if self.broadcast == 0:
+                solution = dict(match)
+                solution.update(json_tuple)
+                yield (self.broadcast_relation, self.encode_tuple(solution))
+            else:
+                solution = dict(json_tuple)
+                solution.update(match)
+                yield (relation, self.encode_tuple(solution))
 
-        raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-        ''' ...................... fill in your code below ........................'''
-        if isinstance(condition.inputs[0], radb.ast.AttrRef) and isinstance(condition.inputs[1], radb.ast.AttrRef):
-            rel1 = condition.inputs[0].rel
-            rel2 = condition.inputs[1].rel
-            if condition.inputs[0].name == condition.inputs[1].name:
-                yield (json_tuple[relation + "." + str(condition.inputs[0].name)], (relation, json_tuple))
-        elif isinstance(condition.inputs[0], radb.ast.ValExprBinaryOp) and isinstance(condition.inputs[1], radb.ast.ValExprBinaryOp):
-            if condition.inputs[0].inputs[0].name == condition.inputs[0].inputs[1].name\
-                    and condition.inputs[1].inputs[0].name == condition.inputs[1].inputs[1].name:
-                yield ([json_tuple[relation + "." + str(condition.inputs[0].inputs[0].name)],
-                        json_tuple[relation + "." + str(condition.inputs[1].inputs[0].name)]], (relation, json_tuple))
-
-        ''' ...................... fill in your code above ........................'''
+    '''
+    Repartition join with a secondary sort: tuples are partitioned on the
+    join key, and within a key the tuples of the smaller (build) input are
+    sorted before those of the other (probe) input. The reducer buffers
+    only the build tuples of a key and streams the probe tuples past them.
+    '''
+
+    def repartition(self, line):
+        relation, tuple = self.split_line(line)
+        json_tuple = self.decode_tuple(relation, tuple)
+
+        side = 0 if (relation == self.relations[self.build]) else 1
+        key = self.join_key(relation, json_tuple)(json_tuple)
+
+        if side == 1 and self.bloom is not None and key not in self.bloom:
+            self.incr_counter('JoinTask', 'Bloom filter eliminated tuples', 1, threshold=1000)
+            return
+        if relation in self.projections:
+            tuple = json.dumps(self.project(relation, json_tuple), separators=(',', ':'))
+
+        # Map output keys are (join key, salt). Only skewed join keys use salts other than 0.
+        if key not in self.salts:
+            yield ((key, 0), side, tuple)
+        elif side == 0:
+            self.incr_counter('JoinTask skewed keys', repr(key), 1, threshold=1000)
+            for salt in range(self.skew_partitions):
+                yield ((key, salt), side, tuple)
+        else:
+            self.incr_counter('JoinTask skewed keys', repr(key), 1, threshold=1000)
+            salt = self.salts[key]
+            self.salts[key] = (salt + 1) % self.skew_partitions
+            yield ((key, salt), side, tuple)
 
     def reducer(self, key, values):
+        relations = [self.relations[self.build], self.relations[1 - self.build]]
+        build = []
+        for side, tuple in values:
+            json_tuple = self.decode_tuple(relations[side], tuple)
+            if side == 0:
+                build.append(json_tuple)
+                continue
+
+            for match in build:
+                if self.build == 0:
+                    solution = dict(match)
+                    solution.update(json_tuple)
+                else:
+                    solution = dict(json_tuple)
+                    solution.update(match)
+                yield (self.relations[0], self.encode_tuple(solution))
+
+    '''
+    Map output records are (join key, side, tuple). Both the join key and
+    the side are sorted on, but records are only partitioned and grouped
+    by the join key.
+    '''
+
+    def internal_reader(self, input_stream):
+        for input_line in input_stream:
+            key, side, value = input_line.split("\t")
+            yield [self.deserialize(key), (self.deserialize(side), self.deserialize(value))]
+
+    def jobconfs(self):
+        jcs = super(JoinTask, self).jobconfs()
+        if self.reducer != NotImplemented:
+            jcs.append('stream.num.map.output.key.fields=2')
+            jcs.append('mapreduce.partition.keypartitioner.options=-k1,1')
+        return jcs
+
+    def extra_streaming_arguments(self):
+        if self.reducer != NotImplemented:
+            return [('-partitioner', 'org.apache.hadoop.mapred.lib.KeyFieldBasedPartitioner')]
+        return []
+
+
+class BucketJoinTask(RelAlgQueryTask):
+    '''
+    Joins two relations bucketed the same way on the join key, in a
+    map-only job. Its input is a list of bucket numbers, one per line and
+    one line per map task, and each map task merges the two (sorted)
+    buckets with its number.
+    '''
+    reducer = NotImplemented
+
+    def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-        if not isinstance(key, list):
-            rel1 = condition.inputs[0].rel
-            rel2 = condition.inputs[1].rel
+        assert (isinstance(raquery, radb.ast.Join))
+
+        return [task_factory(input, env=self.exec_environment) for input in raquery.inputs]
+
+    def init_local(self):
+        super(BucketJoinTask, self).init_local()
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.manifests = bucketed_join(raquery, self.exec_environment)
+        if self.manifests is None:
+            raise Exception("BucketJoinTask: Cannot join " + str(raquery) + " bucket by bucket.")
+
+        self.bucket_index = self.get_output(self.output().path.rstrip("/") + ".buckets")
+        with self.bucket_index.open('w') as f:
+            for bucket in range(self.manifests[0]["buckets"]):
+                f.write(str(bucket) + '\n')
+
+    def run(self):
+        try:
+            super(BucketJoinTask, self).run()
+        finally:
+            self.bucket_index.remove()
+
+    def input_hadoop(self):
+        return [self.bucket_index]
+
+    def output_schema(self):
+        if None in self.input_schemas:
+            return None
+        (relation, left), (_, right) = self.input_schemas
+        return relation, left + right
+
+    def read_bucket(self, manifest, bucket):
+        key = manifest["key"]
+        for line in read_target(self.get_output(manifest["files"][bucket])):
+            relation, json_tuple = self.read_tuple(line)
+            yield bucket_sort_key(json_tuple[key]), relation, json_tuple
+
+    def mapper(self, line):
+        bucket = int(line)
+        left, right = [itertools.groupby(self.read_bucket(manifest, bucket), key=operator.itemgetter(0))
+                       for manifest in self.manifests]
+
+        # Merge the runs of equal keys of both buckets.
+        left_key, left_run = next(left, (None, None))
+        right_key, right_run = next(right, (None, None))
+        while left_run is not None and right_run is not None:
+            if left_key < right_key:
+                left_key, left_run = next(left, (None, None))
+            elif left_key > right_key:
+                right_key, right_run = next(right, (None, None))
+            else:
+                matches = [json_tuple for _, _, json_tuple in right_run]
+                for _, relation, json_tuple in left_run:
+                    for match in matches:
+                        solution = dict(json_tuple)
+                        solution.update(match)
+                        yield (relation, self.encode_tuple(solution))
+                left_key, left_run = next(left, (None, None))
+                right_key, right_run = next(right, (None, None))
+
+    def extra_streaming_arguments(self):
+        # One bucket number per map task.
+        return [('-inputformat', 'org.apache.hadoop.mapred.lib.NLineInputFormat')]
+
+
+'''
+Returns a sample of about size lines of a target, read as runs of
+consecutive lines at places spread over it, so sampling costs as much
+as the sample and not as the whole input. Memory-mapped files are read
+at random offsets, HDFS folders from the start of random part files, and
+other targets (e.g. compressed files) from their start. The random
+generator is seeded, so a plan does not change between runs.
+'''
+
+
+def sample_target(target, size, runs):
+    generator = random.Random(0)
+    sample = []
+    if mappable(target):
+        with MappedTarget(target) as data:
+            length = len(data.data)
+            end = 0
+            # The first run starts at the beginning, so small files are read whole.
+            for offset in [0] + sorted(generator.randrange(length) for _ in range(runs - 1)) if length else []:
+                # Start at the line the offset falls into, without reading a line twice.
+                start = max(data.data.rfind(b'\n', 0, offset) + 1 if offset else 0, end)
+                for _ in range(max(1, size // runs)):
+                    if start >= length:
+                        break
+                    line = data.line(start)
+                    start += len(line) + 1
+                    if line.strip():
+                        sample.append(line.decode('utf-8'))
+                end = start
+        return sample
+
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget) and target.fs.isdir(target.path):
+        parts = sorted(path for path in target.fs.listdir(target.path) if os.path.basename(path).startswith("part-"))
+        parts = generator.sample(parts, min(runs, len(parts)))
+        targets = [luigi.contrib.hdfs.HdfsTarget(path, format=target.format) for path in parts]
+    else:
+        targets = [target]
+    for part in targets:
+        with open_target(part) as f:
+            for line in itertools.islice((line.rstrip('\n') for line in f if line.strip()), max(1, size // len(targets))):
+                sample.append(line)
+    return sample
+
+
+class MappedInput(object):
+    '''
+    The lines of an input file at the given offsets, or the lines that
+    contain all needles, read like a target by the job runners.
+    '''
+
+    def __init__(self, target, offsets=None, needles=()):
+        self.target = target
+        self.offsets = offsets
+        self.needles = needles
+
+    def open(self, mode='r'):
+        data = MappedTarget(self.target)
+        if self.offsets is not None:
+            lines = (data.line(offset) for offset in self.offsets)
         else:
-            rel1 = condition.inputs[0].inputs[0].rel
-            rel2 = condition.inputs[1].inputs[1].rel
-        solution = {}
-        solution_list = []
-        solution_list.append(solution)
-        ''' ...................... fill in your code below ........................'''
-
-        list_ = list(values)
-
-        cnt_list = []
-        # get numbber of producint records
-        for item in list_:
-            rel, dictionary = item
-            cnt_list.append(rel)
-        key_rel1 = [k for k in cnt_list if k == rel1]
-        key_rel2 = [k for k in cnt_list if k == rel2]
-        max_count = len(key_rel1)*len(key_rel2)
-        list_ = sorted(list_, key=lambda x: x[0])
-        cnt = 1
-        if not isinstance(key, list):
-            for v in list_:
-                r, d = v
-                solution.update(d)
-                for val in list_:
-                    relation, dic = val
-                    if r != relation and cnt <= max_count:
-                        solution.update(dic)
-                        cnt = cnt+1
-                        yield(r, json.dumps(solution))
+            lines = data.lines(self.needles)
+        return MappedReader(data, lines)
+
+
+class MappedReader(object):
+    '''
+    Reads the lines of a MappedInput like a text file: each line is only
+    copied out of the memory map and decoded when the job runner gets to
+    it, and the map is closed once all lines were read.
+    '''
+
+    def __init__(self, data, lines):
+        self.data = data
+        self.lines = lines
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line.decode('utf-8') + '\n'
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MappedJobRunner(luigi.contrib.hadoop.LocalJobRunner):
+    '''
+    Runs the job locally like the LocalJobRunner, but without copying
+    the input into a text buffer first: the lines of mapped inputs reach
+    the mappers as the bytes cut out of the memory map, and only the
+    tuple is decoded, once, for the JSON parser.
+    '''
+
+    def lines(self, target):
+        with target.open('r') as f:
+            if isinstance(f, MappedReader):
+                for line in f.lines:
+                    yield line + b'\n'
+            else:
+                for line in f:
+                    yield line if line.endswith('\n') else line + '\n'
+
+    def run_job(self, job):
+        map_input = itertools.chain.from_iterable(self.lines(target) for target in luigi.task.flatten(job.input_hadoop()))
+
+        if job.reducer == NotImplemented:
+            # Map only job; no combiner, no reducer
+            map_output = job.output().open('w')
+            job.run_mapper(map_input, map_output)
+            map_output.close()
+            return
+
+        map_output = io.StringIO()
+        job.run_mapper(map_input, map_output)
+        map_output.seek(0)
+
+        if job.combiner == NotImplemented:
+            reduce_input = self.group(map_output)
         else:
-            for v in list_:
-                r, d = v
-                solution.update(d)
-                for val in list_:
-                    relation, dic = val
-                    if r != relation and cnt <= max_count:
-                        solution.update(dic)
-                        cnt = cnt+1
-                        yield(r, json.dumps(solution))
-        ''' ...................... fill in your code above ........................'''
+            combine_output = io.StringIO()
+            job.run_combiner(self.group(map_output), combine_output)
+            combine_output.seek(0)
+            reduce_input = self.group(combine_output)
+
+        reduce_output = job.output().open('w')
+        job.run_reducer(reduce_input, reduce_output)
+        reduce_output.close()
 
 
-class SelectTask(RelAlgQueryTask):
+'''
+Returns byte strings that every line of an input relation satisfying
+the condition must contain: the JSON encodings of the strings that
+attributes are compared to for equality. Only strings that JSON writers
+do not escape are used, so their encoding in the file is known.
+'''
+
+
+def condition_needles(cond):
+    if not isinstance(cond, radb.ast.ValExprBinaryOp):
+        return []
+    if cond.op == radb.ast.sym.AND:
+        return condition_needles(cond.inputs[0]) + condition_needles(cond.inputs[1])
+    if cond.op != radb.ast.sym.EQ:
+        return []
+
+    needles = []
+    for attr, literal in [cond.inputs, reversed(cond.inputs)]:
+        if isinstance(attr, radb.ast.AttrRef) and isinstance(literal, radb.ast.RAString):
+            value = literal_value(literal)
+            if value and json.dumps(value) == '"' + value + '"':
+                needles.append(json.dumps(value).encode('utf-8'))
+    return needles
+
+
+class ScanMixin(object):
+    '''
+    For tasks whose input is an input relation, and whose (first) operator
+    is a selection on it: if there is an index on an attribute of an
+    equality in the selection's condition, the job only reads the tuples
+    the index points to. Otherwise, if the relation has a zone map, the
+    job only reads the blocks that can hold matching tuples. Outside of
+    HDFS, if the condition has equalities with strings, only the lines
+    that contain these strings are passed to the job. Either way, the
+    whole condition is still checked on the tuples read.
+    '''
+    offsets = None
+    blocks = None
+    needles = ()
+
+    def scanned_selection(self):
+        return None
+
+    def init_local(self):
+        super(ScanMixin, self).init_local()
+        self.offsets = None
+        self.blocks = None
+        self.needles = ()
+        raquery = self.scanned_selection()
+        if raquery is None:
+            return
+
+        relation = raquery.inputs[0].rel
+        equality = indexed_equality(raquery, self.exec_environment)
+        zonemap = zone_map(relation, self.exec_environment) if equality is None else None
+        if equality is not None:
+            attribute, value = equality
+            self.offsets = index_lookup(relation, attribute, value, self.exec_environment)
+            logger.info('%s: %d tuples with %s = %r from the index', self, len(self.offsets), attribute, value)
+        elif zonemap is not None:
+            blocks = [block["file"] for block in zonemap["blocks"] if block_may_match(raquery.cond, block, relation)]
+            # Hadoop needs at least one input file.
+            self.blocks = blocks or [block["file"] for block in zonemap["blocks"][:1]]
+            logger.info('%s: skipping %d of %d blocks', self, len(zonemap["blocks"]) - len(blocks),
+                        len(zonemap["blocks"]))
+        if equality is None and self.exec_environment != ExecEnv.HDFS:
+            self.needles = condition_needles(raquery.cond)
+
+    def input_hadoop(self):
+        if self.offsets is not None:
+            return [MappedInput(self.input()[0], offsets=self.offsets)]
+        if self.blocks is not None:
+            targets = [self.get_output(filename) for filename in self.blocks]
+        elif self.needles:
+            targets = luigi.task.flatten(self.input())
+        else:
+            return super(ScanMixin, self).input_hadoop()
+        return [MappedInput(target, needles=self.needles) if mappable(target) else target for target in targets]
+
+
+class SelectTask(ScanMixin, RelAlgQueryTask):
 
     def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Select))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment,
+                             distinct_above=self.distinct_above)]
+
+    def scanned_selection(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return raquery if isinstance(raquery.inputs[0], radb.ast.RelRef) else None
+
+    def compile(self):
+        super(SelectTask, self).compile()
+        self.predicates = {}
+
+    '''
+    The predicate is compiled once per relation name, since all tuples
+    of one relation in the input share the same attribute names.
+    '''
+
+    def predicate(self, relation, json_tuple):
+        predicate = self.predicates.get(relation)
+        if predicate is None:
+            predicate = compile_condition(self.raquery.cond, json_tuple)
+            self.predicates[relation] = predicate
+        return predicate
+
+    def attributes(self, keys):
+        if self.output_attrs is not None:
+            return None
+        return [resolve_attribute(attr, keys) for attr in condition_attributes(self.raquery.cond)]
 
     def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
-
-        condition = radb.parse.one_statement_from_string(self.querystring).cond
-        ''' ...................... fill in your code below ........................'''
-        if not isinstance(condition.inputs[0], radb.ast.AttrRef) and not isinstance(condition.inputs[0], radb.ast.ValExprBinaryOp) == 1:
-            tmp_ = condition.inputs[0]
-            condition.inputs[0] = condition.inputs[1]
-            condition.inputs[1] = tmp_
-        if isinstance(condition, radb.ast.ValExprBinaryOp) and not isinstance(condition.inputs[0], radb.ast.ValExprBinaryOp):
-            for k, v in json_tuple.items():
-                if isinstance(condition.inputs[0], radb.ast.AttrRef):
-                    if isinstance(condition.inputs[1], radb.ast.Literal):
-                        if str(condition.inputs[0].name) in str(k):
-                            condi = str(condition.inputs[1].val).replace('\'', '') #remove special characters
-                            condi = condi.replace('\'', '')
-                            if str(condi) == str(v):
-                                yield (relation, json.dumps(json_tuple))
-        else:
-            condi_1 = condition.inputs[0]
-            condi_2 = condition.inputs[1]
-            #for k, v in json_tuple.items():
-            if str(relation + "." + condi_1.inputs[0].name) in json_tuple.keys() and str(
-                    relation + "." + condi_2.inputs[0].name) in json_tuple.keys():
-                condi_1_val = str(condi_1.inputs[1].val).replace('\'', '')
-                condi_1_val = condi_1_val.replace('\'', '')
-                condi_2_val = str(condi_2.inputs[1].val).replace('\'', '')
-                condi_2_val = condi_2_val.replace('\'', '')
-                if condi_1_val in json_tuple.values() and float(condi_2_val) in json_tuple.values():
-                    yield (relation, json.dumps(json_tuple))
-        ''' ...................... fill in your code above ........................'''
+        relation, tuple = self.split_line(line)
+        json_tuple = self.read_attributes(relation, tuple, self.attributes)
+
+        if self.predicate(relation, json_tuple)(json_tuple):
+            # The input and output schemas are equal, so the tuple passes through unless it is packed.
+            yield (relation, tuple if self.output_attrs is None else self.encode_tuple(json_tuple))
 
 
 class RenameTask(RelAlgQueryTask):
@@ -274,62 +1828,159 @@ class RenameTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Rename))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment,
+                             distinct_above=self.distinct_above)]
+
+    def compile(self):
+        super(RenameTask, self).compile()
+        self.renamings = {}
 
     def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
-        raquery = radb.parse.one_statement_from_string(self.querystring)
-        ''' ...................... fill in your code below ........................'''
-        del parts[:]
-        dic_ = dict()
-        split_recursivee(raquery)
-        parts_list = remove_duplicates(parts)
-        rename = [x for x in parts_list if isinstance(x, radb.ast.Rename)]
-        for k, v in json_tuple.items():
-            dic_[str(k).replace(relation, rename[0].relname)] = v
-        tuple_ = (json_tuple)
-        solution_list = []
-        solution_list.append(dic_)
+        relation, tuple = self.split_line(line)
+        json_tuple = self.decode_tuple(relation, tuple)
+
+        renaming = self.renamings.get(relation)
+        if renaming is None:
+            renaming = compile_unary(self.raquery, relation, list(json_tuple))
+            self.renamings[relation] = renaming
+        relname, keys, rename = renaming
 
-        yield (rename[0].relname, json.dumps(dic_))
-        ''' ...................... fill in your code above ........................'''
+        yield (relname, self.encode_tuple(rename(json_tuple)))
 
 
-class ProjectTask(RelAlgQueryTask):
+'''
+A bounded set of the most recently seen keys, with least recently used
+eviction. Mappers use it to drop most duplicates before the shuffle.
+'''
+
+
+class DedupCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def add(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return False
+
+        self.entries[key] = None
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return True
+
+
+class DistinctTask(RelAlgQueryTask):
+    '''
+    Base class for tasks that eliminate duplicates. Each output tuple is
+    shuffled under its compact JSON encoding as the key, with the relation
+    name as the value. Duplicates are dropped by an in-mapper cache of
+    dedup_cache_size keys, then by the combiner, and finally by the reducer.
+    If an operator above eliminates duplicates, the task is map-only and
+    only the in-mapper cache drops some of them.
+    '''
+    dedup_cache_size = luigi.IntParameter(default=10000, significant=False)
+
+    def __init__(self, *args, **kwargs):
+        super(DistinctTask, self).__init__(*args, **kwargs)
+        if self.distinct_above:
+            self.combiner = NotImplemented
+            self.reducer = NotImplemented
+
+    def compile(self):
+        super(DistinctTask, self).compile()
+        self.seen = DedupCache(self.dedup_cache_size)
+
+    def distinct(self, relation, json_tuple):
+        key = self.encode_tuple(json_tuple, separators=(',', ':'))
+        if self.seen.add(key):
+            yield (key, relation) if self.reducer != NotImplemented else (relation, key)
+
+    def combiner(self, key, values):
+        yield (key, next(iter(values)))
+
+    def reducer(self, key, values):
+        yield (next(iter(values)), key)
+
+
+class ProjectTask(DistinctTask):
 
     def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Project))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, distinct_above=True)]
+
+    def compile(self):
+        super(ProjectTask, self).compile()
+        self.projections = {}
 
     def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_dic = json.loads(tuple)
-        attrs = radb.parse.one_statement_from_string(self.querystring).attrs
-        ''' ...................... fill in your code below ........................'''
-        for k in list(json_dic.keys()):
-            dic_ = dict()
-            for k in list(json_dic.keys()):
-                for attr in attrs:
-                    if (isinstance(attr, radb.ast.AttrRef)):
-                        if (str(attr.name) in str(k)) and str(
-                                k) not in dic_.keys():  # and str(v) not in dic_.values() and str(k) not in dic_.keys():
-                            dic_[k] = json_dic[k]
-            yield (json.dumps(dic_), json.dumps(dic_))
-
-        ''' ...................... fill in your code above ........................'''
+        relation, tuple = self.split_line(line)
+        json_tuple = self.read_attributes(relation, tuple, lambda keys: pipeline_attributes([self.raquery], keys))
 
-    def reducer(self, key, values):
+        projection = self.projections.get(relation)
+        if projection is None:
+            projection = compile_unary(self.raquery, relation, list(json_tuple))
+            self.projections[relation] = projection
+        relname, keys, project = projection
 
-        ''' ...................... fill in your code below ........................'''
-        seen = None
-        for item in values:
-            if item != seen:
-                seen = item
-                yield (key, [item])
-        ''' ...................... fill in your code above ........................'''
+        return self.distinct(relname, project(json_tuple))
+
+
+class FusedTask(ScanMixin, DistinctTask):
+    '''
+    Evaluates a chain of selections, projections and renamings in one
+    pipelined map phase, instead of one MapReduce job (and one temporary
+    file) per operator. A reduce phase is only needed to eliminate
+    duplicates, i.e. if the chain contains a projection and no operator
+    above eliminates them.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(FusedTask, self).__init__(*args, **kwargs)
+        operators, _ = unary_chain(radb.parse.one_statement_from_string(self.querystring))
+        if not any(isinstance(raquery, radb.ast.Project) for raquery in operators):
+            self.combiner = NotImplemented
+            self.reducer = NotImplemented
+
+    def requires(self):
+        operators, raquery = unary_chain(radb.parse.one_statement_from_string(self.querystring))
+        assert (len(operators) > 0)
+
+        distinct = any(isinstance(input, radb.ast.Project) for input in operators)
+        return [task_factory(raquery, step=self.step + len(operators), env=self.exec_environment,
+                             distinct_above=self.distinct_above or distinct)]
+
+    def scanned_selection(self):
+        operators, raquery = unary_chain(radb.parse.one_statement_from_string(self.querystring))
+        if isinstance(operators[0], radb.ast.Select) and isinstance(raquery, radb.ast.RelRef):
+            return operators[0]
+        return None
+
+    def compile(self):
+        super(FusedTask, self).compile()
+        self.operators, _ = unary_chain(self.raquery)
+        self.pipelines = {}
+
+    def mapper(self, line):
+        relation, tuple = self.split_line(line)
+        json_tuple = self.read_attributes(relation, tuple, lambda keys: pipeline_attributes(self.operators, keys))
+
+        pipeline = self.pipelines.get(relation)
+        if pipeline is None:
+            pipeline = compile_pipeline(self.operators, relation, list(json_tuple))
+            self.pipelines[relation] = pipeline
+        relname, keys, evaluate = pipeline
+
+        output = evaluate(json_tuple)
+        if output is None:
+            return ()
+        elif self.reducer == NotImplemented:
+            return [(relname, self.encode_tuple(output))]
+        else:
+            return self.distinct(relname, output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import json
+import radb
+import radb.ast
+import radb.parse
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+In-process evaluation of the physical query plans built by
+ra2mr.task_factory. Instead of launching one luigi / MapReduce job per
+operator, the plan is evaluated as a tree of Python iterators over
+(relation, tuple) pairs, reading the input relations from the same
+(local or mock) file system. Meant for interactive and test queries
+over small data.
+'''
+
+
+'''
+Local (and mock) input relations are read from a memory map of the
+file. Lines are split on the raw bytes and handed to the JSON parser
+without decoding them first. With needles (see
+ra2mr.condition_needles), only the lines containing them are parsed.
+'''
+
+
+def scan(target, needles=()):
+    if not ra2mr.mappable(target):
+        for line in ra2mr.read_target(target):
+            relation, tuple = line.split('\t')
+            yield relation, json.loads(tuple)
+        return
+
+    relations = {}
+    with ra2mr.MappedTarget(target) as data:
+        for line in data.lines(needles):
+            tab = line.find(b'\t')
+            relation = relations.get(line[:tab])
+            if relation is None:
+                relation = relations[line[:tab]] = line[:tab].decode('utf-8')
+            yield relation, json.loads(line[tab + 1:])
+
+
+'''
+Selection, projection and renaming are compiled once per relation name,
+like in the mappers of ra2mr.
+'''
+
+
+def unary(raquery, tuples):
+    compiled = {}
+    for relation, json_tuple in tuples:
+        operator = compiled.get(relation)
+        if operator is None:
+            operator = ra2mr.compile_unary(raquery, relation, list(json_tuple))
+            compiled[relation] = operator
+        relname, keys, function = operator
+
+        output = function(json_tuple)
+        if output is not None:
+            yield relname, output
+
+
+def select(raquery, tuples):
+    assert (isinstance(raquery, radb.ast.Select))
+    return unary(raquery, tuples)
+
+
+def project(raquery, tuples):
+    assert (isinstance(raquery, radb.ast.Project))
+    return distinct(unary(raquery, tuples))
+
+
+def rename(raquery, tuples):
+    assert (isinstance(raquery, radb.ast.Rename))
+    return unary(raquery, tuples)
+
+
+def distinct(tuples):
+    seen = set()
+    for relation, json_tuple in tuples:
+        key = tuple(json_tuple.items())
+        if key not in seen:
+            seen.add(key)
+            yield relation, json_tuple
+
+
+'''
+Hash join: the right input is loaded into a hash table on the join key,
+the left input is streamed past it. Output tuples carry the attributes
+of the left input first, like the joins in ra2mr.
+'''
+
+
+def hash_join(raquery, left, right):
+    assert (isinstance(raquery, radb.ast.Join))
+    pairs = ra2mr.join_attributes(raquery.cond)
+
+    table = {}
+    join_key = None
+    for relation, json_tuple in right:
+        if join_key is None:
+            join_key = ra2mr.compile_join_key(pairs, json_tuple)
+        table.setdefault(join_key(json_tuple), []).append(json_tuple)
+
+    join_key = None
+    for relation, json_tuple in left:
+        if join_key is None:
+            join_key = ra2mr.compile_join_key(pairs, json_tuple)
+        for match in table.get(join_key(json_tuple), ()):
+            solution = dict(json_tuple)
+            solution.update(match)
+            yield relation, solution
+
+
+OPERATORS = {
+    radb.ast.Select: select,
+    radb.ast.Project: project,
+    radb.ast.Rename: rename,
+}
+
+'''
+Translates the tree of luigi tasks into a tree of iterators.
+'''
+
+
+def evaluate(task):
+    if isinstance(task, ra2mr.InputData):
+        return scan(task.output())
+
+    raquery = radb.parse.one_statement_from_string(task.querystring)
+    inputs = [evaluate(child) for child in task.requires()]
+
+    selection = task.scanned_selection() if isinstance(task, ra2mr.ScanMixin) else None
+    if selection is not None:
+        inputs = [scan(task.requires()[0].output(), ra2mr.condition_needles(selection.cond))]
+
+    if isinstance(task, ra2mr.JoinTask):
+        projections, _ = task.join_inputs(raquery)
+        inputs = [project(projection, tuples) if projection is not None else tuples
+                  for projection, tuples in zip(projections, inputs)]
+        return hash_join(raquery, inputs[0], inputs[1])
+
+    elif isinstance(task, ra2mr.BucketJoinTask):
+        return hash_join(raquery, inputs[0], inputs[1])
+
+    elif isinstance(task, (ra2mr.SelectTask, ra2mr.ProjectTask, ra2mr.RenameTask, ra2mr.FusedTask)):
+        operators, _ = ra2mr.unary_chain(raquery)
+        tuples = inputs[0]
+        for operator in operators:
+            tuples = OPERATORS[type(operator)](operator, tuples)
+        return tuples
+
+    else:
+        raise Exception("evaluate: Cannot handle task " + str(type(task)) + ".")
+
+
+'''
+Evaluates a relational algebra query and returns the result lines,
+formatted like the output files of the MapReduce jobs.
+'''
+
+
+def execute(raquery, env=ExecEnv.LOCAL):
+    assert (isinstance(raquery, radb.ast.Node))
+    assert (env != ExecEnv.HDFS)
+
+    task = ra2mr.task_factory(raquery, env=env)
+    return [relation + '\t' + json.dumps(json_tuple) for relation, json_tuple in evaluate(task)]
@@ -1,3 +1,4 @@
+import time
 import radb.ast
 #Copyright: Martin Meier 
 
@@ -70,22 +71,6 @@ def push_down_selections(ra, dd):
 
     return build_pushed_down_selections_ra(first_cross_join, selections, dd)
 
-def push_down_projection(ra, dd):
-    selections = [ra]
-    first_cross_join = None
-
-    while selections[- 1].inputs is not None:
-        inputs = selections[- 1].inputs[0]
-        if isinstance(inputs, radb.ast.Project):
-            selections.append(inputs)
-        elif isinstance(inputs, radb.ast.Cross):
-            first_cross_join = inputs
-            break
-        else:
-            return ra
-
-    return build_pushed_down_projection_ra(first_cross_join, selections, dd)
-
 def build_pushed_down_selections_ra(first_cross_join, selections, dd):
     new_ra = first_cross_join
     for selection in selections:
@@ -127,48 +112,6 @@ def build_pushed_down_selections_ra(first_cross_join, selections, dd):
 
     return new_ra
 
-def build_pushed_down_projection_ra(first_cross_join, selections, dd):
-
-    new_ra = first_cross_join
-    for selection in selections:
-        insertion_point = new_ra
-        previous_statement = None
-        previous_index = None
-        while insertion_point is not None:
-            if isinstance(insertion_point, radb.ast.Cross):
-                for i in range(len(insertion_point.inputs)):
-                    if isinstance(insertion_point.inputs[i], radb.ast.Cross):
-                        continue
-                    else:
-                        insertion_index = get_selection_insertion_index(selection, insertion_point.inputs[i], dd, i)
-                        if insertion_index is None:
-                            # insertion point found
-                            if previous_statement is None:
-                                selection.inputs[0] = new_ra
-                                new_ra = selection
-                            else:
-                                selection.inputs[0] = previous_statement.inputs[previous_index]
-                                previous_statement.inputs[i] = selection
-                            insertion_point = None
-                        else:
-                            previous_statement = insertion_point
-                            previous_index = insertion_index
-                            insertion_point = insertion_point.inputs[insertion_index]
-
-                        break
-
-            elif isinstance(insertion_point, radb.ast.Project):
-                previous_statement = insertion_point
-                previous_index = 0
-                insertion_point = insertion_point.inputs[0]
-
-            else:
-                selection.inputs[0] = previous_statement.inputs[previous_index]
-                previous_statement.inputs[previous_index] = selection
-                break
-
-    return new_ra
-
 def get_selection_insertion_index(selection, relation, dd, index):
     relation = extract_relation(relation)
     relations = get_all_relations_of_cross(relation)
@@ -228,6 +171,147 @@ def get_possible_relations_of_attribute(attribute, dd):
         return possible_relations
 
 
+'''
+Projection pushdown: below every join and above every base relation, a
+projection keeps only the attributes that the operators above it use,
+i.e. the attributes of the final projection and of the selection and
+join conditions on the way up. Under set semantics, the projections can
+be inserted without changing the result. Queries without a projection
+on top return all attributes, so nothing is pruned for them. ra2mr
+evaluates the projections in the mappers of the joins above them (see
+ra2mr.JoinTask.join_inputs), so they add no jobs.
+
+Attributes are tracked as (relation name, attribute name) pairs, as in
+the schemas of the subexpressions computed from the data dictionary dd.
+'''
+
+
+def rule_push_down_projections(ra, dd):
+    return push_down_projections(ra, None, dd)
+
+
+def push_down_projections(ra, required, dd):
+    schema = get_schema(ra, dd)
+    if schema is None:
+        required = None
+
+    if isinstance(ra, radb.ast.Project):
+        needed = resolve_attributes(ra.attrs, get_schema(ra.inputs[0], dd))
+        statement = push_down_projections(ra.inputs[0], needed, dd)
+        if isinstance(statement, radb.ast.Project) and needed is not None and\
+                resolve_attributes(statement.attrs, get_schema(statement.inputs[0], dd)) == needed:
+            # Two projections on the same attributes.
+            statement = statement.inputs[0]
+        ra.inputs = [statement]
+
+    elif isinstance(ra, radb.ast.Select):
+        needed = add_condition_attributes(required, ra.cond, schema)
+        ra.inputs = [push_down_projections(ra.inputs[0], needed, dd)]
+
+    elif isinstance(ra, radb.ast.Rename):
+        needed = None
+        # Renamings of the attributes need all of them.
+        if required is not None and ra.attrnames is None:
+            input_schema = get_schema(ra.inputs[0], dd)
+            needed = set(input_schema[i] for i in range(len(schema)) if schema[i] in required)
+        ra.inputs = [push_down_projections(ra.inputs[0], needed, dd)]
+
+    elif isinstance(ra, radb.ast.Join) or isinstance(ra, radb.ast.Cross):
+        needed = required
+        if isinstance(ra, radb.ast.Join):
+            needed = add_condition_attributes(required, ra.cond, schema)
+
+        statement_inputs = []
+        for statement in ra.inputs:
+            input_schema = get_schema(statement, dd)
+            input_needed = None
+            if needed is not None and input_schema is not None:
+                input_needed = set(attribute for attribute in input_schema if attribute in needed)
+            statement_inputs.append(project_attributes(push_down_projections(statement, input_needed, dd),
+                                                       input_needed, input_schema))
+        ra.inputs = statement_inputs
+
+    elif isinstance(ra, radb.ast.RelRef):
+        return project_attributes(ra, required, schema)
+
+    elif ra.inputs is not None:
+        ra.inputs = [push_down_projections(statement, None, dd) for statement in ra.inputs]
+
+    return ra
+
+
+def project_attributes(ra, required, schema):
+    if required is None or schema is None or len(required) == len(schema) or len(required) == 0:
+        return ra
+    statement = ra
+    while isinstance(statement, radb.ast.Rename):
+        statement = statement.inputs[0]
+    if isinstance(statement, radb.ast.Project):
+        # Renamings keep all attributes, so the projection below is enough.
+        return ra
+    return radb.ast.Project([radb.ast.AttrRef(rel, name) for rel, name in schema if (rel, name) in required], ra)
+
+
+'''
+Returns the (relation name, attribute name) pairs of the result of ra,
+in order, or None if they cannot be derived from dd.
+'''
+
+
+def get_schema(ra, dd):
+    if isinstance(ra, radb.ast.RelRef):
+        if ra.rel not in dd:
+            return None
+        return [(ra.rel, name) for name in dd[ra.rel]]
+
+    elif isinstance(ra, radb.ast.Rename):
+        schema = get_schema(ra.inputs[0], dd)
+        if schema is None:
+            return None
+        names = ra.attrnames if ra.attrnames is not None else [name for _, name in schema]
+        return [(ra.relname if ra.relname is not None else rel, name) for (rel, _), name in zip(schema, names)]
+
+    elif isinstance(ra, radb.ast.Project):
+        schema = get_schema(ra.inputs[0], dd)
+        attributes = resolve_attributes(ra.attrs, schema)
+        if attributes is None:
+            return None
+        return [attribute for attribute in schema if attribute in attributes]
+
+    elif isinstance(ra, radb.ast.Select):
+        return get_schema(ra.inputs[0], dd)
+
+    elif isinstance(ra, radb.ast.Join) or isinstance(ra, radb.ast.Cross):
+        schemas = [get_schema(statement, dd) for statement in ra.inputs]
+        if None in schemas:
+            return None
+        return schemas[0] + schemas[1]
+
+    return None
+
+
+def resolve_attributes(attributes, schema):
+    if schema is None:
+        return None
+    result = set()
+    for attribute in attributes:
+        matches = [(rel, name) for rel, name in schema
+                   if name == attribute.name and (attribute.rel is None or attribute.rel == rel)]
+        if not matches:
+            return None
+        result.update(matches)
+    return result
+
+
+def add_condition_attributes(required, cond, schema):
+    if required is None:
+        return None
+    attributes = resolve_attributes(attribute_references(cond), schema)
+    if attributes is None:
+        return None
+    return required | attributes
+
+
 def rule_merge_selections(ra):
     statement_inputs = []
 
@@ -308,3 +392,563 @@ def get_rel_name(relation):
         return relation.rel
     else:
         return get_rel_name(relation.inputs[0])
+
+
+'''
+Cost-based join ordering.
+
+A tree of joins and cross products is flattened into its inputs (the
+leaves) and the conjuncts of all join conditions, and rebuilt as a
+left-deep tree in the order with the smallest sum of estimated
+intermediate result sizes.
+
+Sizes are estimated from the relation statistics stats, which map a
+relation name to its number of rows and its per-attribute distinct
+counts, e.g. {"Person": {"rows": 9, "distinct": {"name": 9, "age": 8}}}.
+An equality between two attributes has the selectivity
+1 / max(distinct(a), distinct(b)), other predicates 1 / 3. Relations
+without statistics are assumed to have DEFAULT_ROWS rows and one
+distinct value per row. The catalog of the stats module has this format,
+and adds the attribute statistics used to estimate the selectivity of
+the selections on the inputs.
+
+The cost of a plan is the sum of the sizes of its join results. Plans
+may be bushy: for star and snowflake queries, joining the dimension
+tables first, in parallel, and the fact table last can keep the
+intermediate results much smaller than any left-deep plan.
+
+Up to DP_JOIN_LIMIT inputs, the best plan is found by dynamic
+programming over the subsets of inputs, and their splits into two
+subsets. Only subsets that share a join predicate are joined: cross
+products only combine the connected components of the join graph.
+Beyond that, the plan is built greedily: the two subplans with the
+smallest join result are joined until one plan is left, avoiding cross
+products where possible. On ties, left-deep plans win, and inputs keep
+their original order.
+'''
+
+DEFAULT_ROWS = 1000
+RANGE_COMPARISONS = [radb.ast.sym.LT, radb.ast.sym.LE, radb.ast.sym.GT, radb.ast.sym.GE]
+MIRRORED_COMPARISONS = {
+    radb.ast.sym.LT: radb.ast.sym.GT,
+    radb.ast.sym.LE: radb.ast.sym.GE,
+    radb.ast.sym.GT: radb.ast.sym.LT,
+    radb.ast.sym.GE: radb.ast.sym.LE,
+}
+RANGE_COMPARISONS_HOLD = {
+    radb.ast.sym.LT: lambda x, y: x < y,
+    radb.ast.sym.LE: lambda x, y: x <= y,
+    radb.ast.sym.GT: lambda x, y: x > y,
+    radb.ast.sym.GE: lambda x, y: x >= y,
+}
+DEFAULT_SELECTIVITY = 1.0 / 3
+DP_JOIN_LIMIT = 10
+
+
+def rule_reorder_joins(ra, dd, stats):
+    if isinstance(ra, radb.ast.Join) or isinstance(ra, radb.ast.Cross):
+        return reorder_joins(ra, dd, stats)
+
+    statement_inputs = []
+    if ra.inputs is not None:
+        for i in range(0, len(ra.inputs)):
+            statement_inputs.append(rule_reorder_joins(ra.inputs[i], dd, stats))
+
+    ra.inputs = statement_inputs
+    return ra
+
+
+def reorder_joins(ra, dd, stats):
+    leaves = []
+    conditions = []
+    collect_join_inputs(ra, leaves, conditions, dd, stats)
+
+    infos = [JoinInput(leaf, dd, stats) for leaf in leaves]
+    predicates = [JoinPredicate(condition, infos, dd) for condition in conditions]
+
+    if len(infos) <= DP_JOIN_LIMIT:
+        plan = dp_join_plan(infos, predicates)
+    else:
+        plan = greedy_join_plan(infos, predicates)
+
+    return build_join_tree(plan, leaves, predicates)
+
+
+def collect_join_inputs(ra, leaves, conditions, dd, stats):
+    if isinstance(ra, radb.ast.Join):
+        conditions.extend(split_conjunction(ra.cond))
+    if isinstance(ra, radb.ast.Join) or isinstance(ra, radb.ast.Cross):
+        for statement in ra.inputs:
+            collect_join_inputs(statement, leaves, conditions, dd, stats)
+    else:
+        leaves.append(rule_reorder_joins(ra, dd, stats))
+
+
+def split_conjunction(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.AND:
+        return split_conjunction(cond.inputs[0]) + split_conjunction(cond.inputs[1])
+    return [cond]
+
+
+def join_conjunction(conditions):
+    cond = conditions[0]
+    for condition in conditions[1:]:
+        cond = radb.ast.ValExprBinaryOp(cond, radb.ast.sym.AND, condition)
+    return cond
+
+
+def literal_value(literal):
+    if isinstance(literal, radb.ast.RAString):
+        return radb.ast.sqlstr_to_str(literal.val)
+    try:
+        return int(literal.val)
+    except ValueError:
+        return float(literal.val)
+
+
+'''
+sql2ra translates the literals of a query to attribute references that
+are printed like them: 'Amy' and 16 to AttrRef(None, "'Amy'") and
+AttrRef(None, '16'), and 7.75 to AttrRef('7', '75'). Returns the literal
+that an attribute reference stands for, or the value itself.
+'''
+
+
+def sql_literal(value, attributes):
+    if not isinstance(value, radb.ast.AttrRef):
+        return value
+    if value.rel is None and value.name.startswith("'"):
+        return radb.ast.RAString(value.name)
+    if value.rel is None and value.name in attributes:
+        return value
+    text = value.name if value.rel is None else value.rel + "." + value.name
+    try:
+        float(text)
+    except ValueError:
+        return value
+    return radb.ast.RANumber(text)
+
+
+def attribute_references(cond):
+    if isinstance(cond, radb.ast.AttrRef):
+        return [cond]
+    result = []
+    for value in cond.inputs or []:
+        result.extend(attribute_references(value))
+    return result
+
+
+class JoinInput(object):
+    '''
+    An input of a join tree, with the name its attributes are qualified
+    with, the relation it reads, and its estimated number of rows after
+    the selections on it.
+    '''
+
+    def __init__(self, ra, dd, stats):
+        self.name = None
+        self.relation = None
+        selections = []
+
+        while self.relation is None:
+            if isinstance(ra, radb.ast.Rename):
+                self.name = self.name or ra.relname
+            elif isinstance(ra, radb.ast.Select):
+                selections.extend(split_conjunction(ra.cond))
+            elif isinstance(ra, radb.ast.RelRef):
+                self.relation = ra.rel
+                break
+            if not ra.inputs:
+                break
+            ra = ra.inputs[0]
+
+        self.name = self.name or self.relation
+        self.attributes = dd.get(self.relation, {})
+        self.stats = stats.get(self.relation, {})
+        self.table_rows = self.stats.get("rows", DEFAULT_ROWS)
+
+        self.rows = float(self.table_rows)
+        for cond in selections:
+            self.rows *= self.selectivity(cond)
+        self.rows = max(self.rows, 1.0)
+
+    def distinct(self, attribute):
+        return min(self.stats.get("distinct", {}).get(attribute, self.table_rows), self.rows)
+
+    '''
+    The selectivity of a comparison between an attribute and a literal.
+    With the attribute statistics of the stats module, an equality with a
+    frequent value uses its frequency, and a range comparison the fraction
+    of the range between the minimum and maximum value it covers.
+    '''
+
+    def selectivity(self, cond):
+        if not isinstance(cond, radb.ast.ValExprBinaryOp) or cond.op not in RANGE_COMPARISONS + [radb.ast.sym.EQ]:
+            return DEFAULT_SELECTIVITY
+        attribute, literal = [sql_literal(value, self.attributes) for value in cond.inputs]
+        op = cond.op
+        if isinstance(attribute, radb.ast.Literal):
+            attribute, literal, op = literal, attribute, MIRRORED_COMPARISONS.get(op, op)
+        if not isinstance(attribute, radb.ast.AttrRef) or not isinstance(literal, (radb.ast.RAString, radb.ast.RANumber)):
+            return DEFAULT_SELECTIVITY
+
+        value = literal_value(literal)
+        statistics = self.stats.get("attributes", {}).get(attribute.name, {})
+        if op == radb.ast.sym.EQ:
+            for frequent, count in statistics.get("top", []):
+                if frequent == value:
+                    return float(count) / max(self.table_rows, 1)
+            return 1.0 / max(self.stats.get("distinct", {}).get(attribute.name, self.table_rows), 1)
+
+        low, high = statistics.get("min"), statistics.get("max")
+        if not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in (low, high, value)):
+            return DEFAULT_SELECTIVITY
+        if high == low:
+            fraction = 1.0 if RANGE_COMPARISONS_HOLD[op](low, value) else 0.0
+        elif op in (radb.ast.sym.LT, radb.ast.sym.LE):
+            fraction = (value - low) / float(high - low)
+        else:
+            fraction = (high - value) / float(high - low)
+        return min(max(fraction, 1.0 / max(self.table_rows, 1)), 1.0)
+
+    def provides(self, attribute):
+        if attribute.rel is not None:
+            return attribute.rel == self.name
+        return attribute.name in self.attributes
+
+
+class JoinPredicate(object):
+    '''
+    A conjunct of a join condition, with the bit mask of the inputs it
+    refers to and its estimated selectivity.
+    '''
+
+    def __init__(self, cond, infos, dd):
+        self.cond = cond
+        self.mask = 0
+        sides = []
+        for attribute in attribute_references(cond):
+            matches = [i for i in range(len(infos)) if infos[i].provides(attribute)]
+            if len(matches) != 1:
+                # Cannot tell where the attribute comes from, evaluate the predicate last.
+                self.mask = (1 << len(infos)) - 1
+                self.selectivity = 1.0
+                return
+            self.mask |= 1 << matches[0]
+            sides.append((matches[0], attribute.name))
+
+        if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.EQ and\
+                len(sides) == 2 and sides[0][0] != sides[1][0]:
+            distinct = max(infos[i].distinct(name) for i, name in sides)
+            self.selectivity = 1.0 / max(distinct, 1)
+        else:
+            self.selectivity = DEFAULT_SELECTIVITY
+
+
+def estimate_rows(mask, infos, predicates):
+    rows = 1.0
+    for i in range(len(infos)):
+        if mask & (1 << i):
+            rows *= infos[i].rows
+    for predicate in predicates:
+        if predicate.mask & mask == predicate.mask:
+            rows *= predicate.selectivity
+    return max(rows, 1.0)
+
+
+def connected(left, right, predicates):
+    for predicate in predicates:
+        if predicate.mask & left and predicate.mask & right and predicate.mask & ~(left | right) == 0:
+            return True
+    return False
+
+
+'''
+A join plan is either the index of an input, or a pair of join plans.
+'''
+
+
+def dp_join_plan(infos, predicates):
+    n = len(infos)
+    best = dp_join_subplans(n, infos, predicates, (1 << n) - 1, False)
+
+    # Cross products only join the components of the join graph, in their original order.
+    plan = None
+    for component in join_components(n, predicates):
+        if component not in best:
+            # Predicates over more than two inputs do not connect any two of them.
+            best.update(dp_join_subplans(n, infos, predicates, component, True))
+        plan = best[component][1] if plan is None else (plan, best[component][1])
+    return plan
+
+
+def dp_join_subplans(n, infos, predicates, inputs, cross):
+    '''
+    Returns the cheapest plans for the subsets of inputs, by their bit
+    masks. Unless cross is set, inputs are only joined by a join predicate,
+    and subsets that cannot be joined that way have no plan.
+    '''
+    best = {}
+    for i in range(n):
+        if inputs & (1 << i):
+            best[1 << i] = (0.0, i)
+
+    for mask in range(1, 1 << n):
+        if mask in best or mask & ~inputs:
+            continue
+        rows = estimate_rows(mask, infos, predicates)
+
+        # Left-deep plans first: on ties, keep the inputs in their original order.
+        for i in reversed(range(n)):
+            rest = mask & ~(1 << i)
+            if mask & (1 << i) and rest in best and (cross or connected(rest, 1 << i, predicates)):
+                cost, plan = best[rest]
+                if mask not in best or cost + rows < best[mask][0]:
+                    best[mask] = (cost + rows, (plan, i))
+
+        # Bushy plans, joining the results of two joins.
+        left = (mask - 1) & mask
+        while left:
+            right = mask & ~left
+            if left & (left - 1) and right & (right - 1) and left in best and right in best and\
+                    (cross or connected(left, right, predicates)):
+                cost = best[left][0] + best[right][0] + rows
+                if mask not in best or cost < best[mask][0]:
+                    best[mask] = (cost, (best[left][1], best[right][1]))
+            left = (left - 1) & mask
+
+    return best
+
+
+def join_components(n, predicates):
+    '''
+    Returns the bit masks of the connected components of the join graph,
+    ordered by their first input.
+    '''
+    components = [1 << i for i in range(n)]
+    for predicate in predicates:
+        linked = [component for component in components if component & predicate.mask]
+        if len(linked) > 1:
+            components = [component for component in components if not component & predicate.mask]
+            merged = 0
+            for component in linked:
+                merged |= component
+            components.append(merged)
+    return sorted(components, key=lambda component: component & -component)
+
+
+def greedy_join_plan(infos, predicates):
+    # Start with one plan per input, and join the two plans with the smallest join result
+    # until one plan is left, avoiding cross products where possible.
+    plans = [(1 << i, i) for i in range(len(infos))]
+
+    while len(plans) > 1:
+        pairs = [(i, j) for i in range(len(plans)) for j in range(i + 1, len(plans))]
+        pairs = [(i, j) for i, j in pairs if connected(plans[i][0], plans[j][0], predicates)] or pairs
+        i, j = min(pairs, key=lambda pair: estimate_rows(plans[pair[0]][0] | plans[pair[1]][0], infos, predicates))
+        left, right = plans[i], plans.pop(j)
+        if bin(right[0]).count('1') > bin(left[0]).count('1'):
+            # Keep the larger plan on the left, like in left-deep plans.
+            left, right = right, left
+        plans[i] = (left[0] | right[0], (left[1], right[1]))
+
+    return plans[0][1]
+
+
+def build_join_tree(plan, leaves, predicates):
+    pending = list(predicates)
+
+    def build(plan):
+        if not isinstance(plan, tuple):
+            return leaves[plan], 1 << plan
+
+        left, left_mask = build(plan[0])
+        right, right_mask = build(plan[1])
+        mask = left_mask | right_mask
+        conditions = [predicate.cond for predicate in pending if predicate.mask & mask == predicate.mask]
+        pending[:] = [predicate for predicate in pending if predicate.mask & mask != predicate.mask]
+
+        if conditions:
+            return radb.ast.Join(left, join_conjunction(conditions), right), mask
+        else:
+            return radb.ast.Cross(left, right), mask
+
+    return build(plan)[0]
+
+
+'''
+Optimizer driver: applies a set of rules until the query does not change
+any more (a fixpoint), or the iteration or time budget is used up.
+
+Subtrees are hash-consed: every structurally distinct subtree gets a
+small integer id, computed bottom-up from the ids of its inputs, so equal
+subtrees (e.g. a relation joined with itself) get equal ids. Rewrite
+results are cached by rule and id:
+
+- Local rules rewrite a single operator, given its rewritten inputs, and
+  return a new operator instead of changing it. They are applied
+  bottom-up, and subtrees that were rewritten before, in an earlier pass
+  or elsewhere in the query, are taken from the cache.
+- Global rules need the context of the whole query. They are applied to
+  a copy of the operators of the whole query, and not run again on a
+  query they have seen before.
+
+Nodes are never changed once they are built, so the cached results are
+shared by the query and the cache, not copied. A rule is skipped if the
+query did not change since it was last applied.
+
+All rules return valid queries, so the query is valid whenever the budget
+runs out.
+'''
+
+
+class Rule(object):
+
+    def __init__(self, name, function, local=False):
+        self.name = name
+        self.function = function
+        self.local = local
+
+
+def local_break_up_selections(ra):
+    if isinstance(ra, radb.ast.Select):
+        return select_conversion(ra)
+    return ra
+
+
+def local_merge_selections(ra):
+    if isinstance(ra, radb.ast.Select) and isinstance(ra.inputs[0], radb.ast.Select):
+        return merge_selections(radb.ast.Select(ra.cond, ra.inputs[0]))
+    return ra
+
+
+def local_introduce_joins(ra):
+    if isinstance(ra, radb.ast.Select) and check_join_conversion(ra):
+        return radb.ast.Join(ra.inputs[0].inputs[0], ra.cond, ra.inputs[0].inputs[1])
+    return ra
+
+
+def global_reorder_joins(ra, dd, stats):
+    # Without statistics, keep the join order of the query.
+    if stats is None:
+        return ra
+    return rule_reorder_joins(ra, dd, stats)
+
+
+RULES = [
+    Rule("break_up_selections", local_break_up_selections, local=True),
+    Rule("push_down_selections", lambda ra, dd, stats: rule_push_down_selections(ra, dd)),
+    Rule("merge_selections", local_merge_selections, local=True),
+    Rule("introduce_joins", local_introduce_joins, local=True),
+    Rule("reorder_joins", global_reorder_joins),
+    Rule("push_down_projections", lambda ra, dd, stats: rule_push_down_projections(ra, dd)),
+]
+
+
+def copy_operators(ra):
+    '''
+    Returns a copy of the operators of the query, for rules that change
+    their inputs. Conditions and attributes are never changed, and shared.
+    '''
+    node = copy_operator(ra)
+    if ra.inputs:
+        node.inputs = [copy_operators(statement) for statement in ra.inputs]
+    return node
+
+
+def copy_operator(ra):
+    # A shallow copy, sharing the inputs, conditions and attributes.
+    node = ra.__class__.__new__(ra.__class__)
+    node.__dict__.update(ra.__dict__)
+    return node
+
+
+class Optimizer(object):
+
+    def __init__(self, dd, stats=None, rules=None, max_iterations=10, time_budget=None):
+        self.dd = dd
+        self.stats = stats
+        self.rules = rules if rules is not None else RULES
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.ids = {}
+        self.nodes = {}
+        self.cache = {}
+        self.applied = {}
+
+    def subtree_id(self, ra):
+        # Nodes are never changed while the query is optimized, so their ids are kept.
+        known = self.nodes.get(id(ra))
+        if known is not None:
+            return known[1]
+
+        inputs = tuple([self.subtree_id(statement) for statement in ra.inputs]) if ra.inputs else ()
+        if isinstance(ra, radb.ast.RelRef):
+            local = ra.rel
+        elif isinstance(ra, radb.ast.Rename):
+            local = (ra.relname, tuple(ra.attrnames) if ra.attrnames is not None else None)
+        elif isinstance(ra, radb.ast.Project):
+            local = self.condition_id(ra.attrs)
+        elif isinstance(ra, radb.ast.Select) or isinstance(ra, radb.ast.Join):
+            local = self.condition_id(ra.cond)
+        else:
+            local = None
+
+        key = (type(ra).__name__, local, inputs)
+        known = self.nodes[id(ra)] = (ra, self.ids.setdefault(key, len(self.ids)))
+        return known[1]
+
+    def condition_id(self, cond):
+        # Rules split and merge conjunctions, but share the conditions (and attribute lists) in them.
+        known = self.nodes.get(id(cond))
+        if known is None:
+            if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.AND:
+                key = (self.condition_id(cond.inputs[0]), self.condition_id(cond.inputs[1]))
+            elif isinstance(cond, list):
+                key = tuple(str(attr) for attr in cond)
+            else:
+                key = str(cond)
+            known = self.nodes[id(cond)] = (cond, self.ids.setdefault(key, len(self.ids)))
+        return known[1]
+
+    def apply_local(self, rule, ra):
+        key = (rule.name, self.subtree_id(ra))
+        if key not in self.cache:
+            node = ra
+            if ra.inputs:
+                inputs = [self.apply_local(rule, statement) for statement in ra.inputs]
+                if any(new is not old for new, old in zip(inputs, ra.inputs)):
+                    node = copy_operator(ra)
+                    node.inputs = inputs
+            self.cache[key] = rule.function(node)
+        return self.cache[key]
+
+    def apply(self, rule, ra):
+        if rule.local:
+            return self.apply_local(rule, ra)
+
+        key = (rule.name, self.subtree_id(ra))
+        if key not in self.cache:
+            # Global rules change the query in place, results in the cache are shared.
+            self.cache[key] = rule.function(copy_operators(ra), self.dd, self.stats)
+        return self.cache[key]
+
+    def optimize(self, ra):
+        deadline = time.time() + self.time_budget if self.time_budget is not None else None
+        for iteration in range(self.max_iterations):
+            before = current = self.subtree_id(ra)
+            for rule in self.rules:
+                if deadline is not None and time.time() > deadline:
+                    return ra
+                # Skip the rule if the query did not change since it was last applied.
+                if self.applied.get(rule.name) != current:
+                    self.applied[rule.name] = current
+                    ra = self.apply(rule, ra)
+                    current = self.subtree_id(ra)
+            if current == before:
+                break
+        return ra
+
+
+def optimize(ra, dd, stats=None, rules=None, max_iterations=10, time_budget=None):
+    return Optimizer(dd, stats, rules, max_iterations, time_budget).optimize(ra)
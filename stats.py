@@ -0,0 +1,265 @@
+import base64
+import hashlib
+import json
+import math
+import sys
+import zlib
+import luigi
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+Statistics on the input relations, for cost-based optimization.
+
+For every input file <Relation>.json, the catalog records the number of
+rows and bytes, and for every attribute the number of NULLs, the minimum
+and maximum value, an estimate of the number of distinct values (from a
+HyperLogLog sketch) and the most frequent values (from a space-saving
+sketch). The catalog is stored as a JSON file next to the input relations,
+in the same execution environment.
+
+The catalog is refreshed incrementally: files that did not change are not
+read, and of files that were appended to, only the new lines are scanned
+and merged into the sketches.
+
+The entry of a relation has the "rows" and "distinct" fields that
+raopt.rule_reorder_joins expects, so relation_statistics() can be passed
+to it directly.
+'''
+
+
+class statistics(luigi.Config):
+    catalog = luigi.Parameter(default="catalog.json", description='Name of the catalog file')
+    top_k = luigi.IntParameter(default=10, description='Number of most frequent values per attribute')
+    precision = luigi.IntParameter(default=12, description='Precision of the HyperLogLog sketches')
+
+
+def hash_value(value):
+    digest = hashlib.blake2b(json.dumps(value, sort_keys=True).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class HyperLogLog(object):
+    '''
+    Estimates the number of distinct values with 2^precision registers,
+    with a standard error of about 1.04 / sqrt(2^precision).
+    '''
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        h = hash_value(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i in range(len(self.registers)):
+            self.registers[i] = max(self.registers[i], other.registers[i])
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting for small cardinalities.
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_json(self):
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @staticmethod
+    def from_json(data):
+        return HyperLogLog(data["precision"], base64.b64decode(data["registers"]))
+
+
+class SpaceSaving(object):
+    '''
+    Finds the most frequent values with a bounded number of counters. When
+    all counters are taken, a new value replaces the least frequent one and
+    inherits its count, so counts are upper bounds.
+    '''
+
+    def __init__(self, size, counters=None):
+        self.size = size
+        self.counters = dict(counters or {})
+
+    def add(self, value):
+        if value in self.counters:
+            self.counters[value] += 1
+        elif len(self.counters) < self.size:
+            self.counters[value] = 1
+        else:
+            victim = min(self.counters, key=self.counters.get)
+            self.counters[value] = self.counters.pop(victim) + 1
+
+    def top(self, k):
+        return sorted(self.counters.items(), key=lambda item: (-item[1], str(item[0])))[:k]
+
+    def to_json(self):
+        return [[value, count] for value, count in self.counters.items()]
+
+    @staticmethod
+    def from_json(size, data):
+        return SpaceSaving(size, [(value, count) for value, count in data])
+
+
+class AttributeStatistics(object):
+
+    def __init__(self, precision, top_k, data=None):
+        self.top_k = top_k
+        data = data or {}
+        self.nulls = data.get("nulls", 0)
+        self.min = data.get("min")
+        self.max = data.get("max")
+        self.ordered = data.get("ordered", True)
+        self.hll = HyperLogLog.from_json(data["hll"]) if "hll" in data else HyperLogLog(precision)
+        # Keep more counters than reported, for more accurate counts of the top values.
+        self.frequent = SpaceSaving.from_json(4 * top_k, data.get("counters", []))
+
+    def add(self, value):
+        if value is None:
+            self.nulls += 1
+            return
+
+        self.hll.add(value)
+        if isinstance(value, (dict, list)):
+            return
+        self.frequent.add(value)
+
+        if self.ordered:
+            try:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+            except TypeError:
+                # Values of mixed types have no order.
+                self.ordered = False
+                self.min = self.max = None
+
+    def to_json(self):
+        return {
+            "distinct": self.hll.count(),
+            "nulls": self.nulls,
+            "min": self.min,
+            "max": self.max,
+            "ordered": self.ordered,
+            "top": [[value, count] for value, count in self.frequent.top(self.top_k)],
+            "hll": self.hll.to_json(),
+            "counters": self.frequent.to_json(),
+        }
+
+
+def scan_relation(relation, env, entry=None):
+    '''
+    Scans <relation>.json and returns its catalog entry. If the previous
+    entry is given and the file starts with the bytes scanned before, only
+    the lines after them are scanned.
+    '''
+    config = statistics()
+    target = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+
+    attributes = {}
+    rows = 0
+    offset = 0
+    checksum = 0
+    resume = entry is not None and entry.get("precision") == config.precision
+    if resume:
+        attributes = dict((name, AttributeStatistics(config.precision, config.top_k, data))
+                          for name, data in entry["attributes"].items())
+        rows = entry["rows"]
+
+    for line in ra2mr.read_target(target):
+        data = (line + '\n').encode('utf-8')
+        if resume and offset < entry["scanned"]:
+            offset += len(data)
+            checksum = zlib.crc32(data, checksum)
+            if offset >= entry["scanned"] and (offset != entry["scanned"] or checksum != entry["checksum"]):
+                # The file was rewritten, not appended to.
+                return scan_relation(relation, env)
+            continue
+
+        offset += len(data)
+        checksum = zlib.crc32(data, checksum)
+        rows += 1
+        for key, value in json.loads(line.split('\t')[1]).items():
+            name = key.rsplit('.', 1)[-1]
+            if name not in attributes:
+                attributes[name] = AttributeStatistics(config.precision, config.top_k)
+                # The attribute was missing from all earlier rows.
+                attributes[name].nulls = rows - 1
+            attributes[name].add(value)
+
+    if resume and offset < entry["scanned"]:
+        return scan_relation(relation, env)
+
+    attributes = dict((name, attribute.to_json()) for name, attribute in attributes.items())
+    return {
+        "rows": rows,
+        "bytes": ra2mr.target_size(target),
+        "scanned": offset,
+        "checksum": checksum,
+        "precision": config.precision,
+        "fingerprint": ra2mr.target_version(target),
+        "distinct": dict((name, attribute["distinct"]) for name, attribute in attributes.items()),
+        "attributes": attributes,
+    }
+
+
+def catalog_target(env):
+    return ra2mr.InputData(filename=statistics().catalog, exec_environment=env).output()
+
+
+def load_catalog(env=ExecEnv.LOCAL):
+    target = catalog_target(env)
+    if not target.exists():
+        return {"relations": {}}
+    with target.open('r') as f:
+        return json.load(f)
+
+
+def save_catalog(catalog, env=ExecEnv.LOCAL):
+    with catalog_target(env).open('w') as f:
+        json.dump(catalog, f, sort_keys=True)
+
+
+'''
+Refreshes the statistics of the given relations in the catalog, and
+returns the catalog. Relations whose files did not change are skipped.
+'''
+
+
+def collect(relations, env=ExecEnv.LOCAL):
+    catalog = load_catalog(env)
+    changed = False
+
+    for relation in relations:
+        target = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+        entry = catalog["relations"].get(relation)
+        if entry is not None and entry["fingerprint"] == ra2mr.target_version(target):
+            continue
+        catalog["relations"][relation] = scan_relation(relation, env, entry)
+        changed = True
+
+    if changed:
+        save_catalog(catalog, env)
+    return catalog
+
+
+def relation_statistics(env=ExecEnv.LOCAL):
+    return load_catalog(env)["relations"]
+
+
+if __name__ == '__main__':
+    # python3 stats.py Person Eats Serves
+    for relation, entry in sorted(collect(sys.argv[1:]).get("relations").items()):
+        print(relation, entry["rows"], entry["bytes"], json.dumps(entry["distinct"], sort_keys=True))
@@ -0,0 +1,65 @@
+import bz2
+import gzip
+import luigi
+import pytest
+import blockcompress
+
+
+'''
+Checks the block framing of compressed files.
+
+python3 -m pytest test_blockcompress.py -p no:warnings --show-capture=no
+'''
+
+class TestBlockCompression(object):
+
+    def _write(self, codec, lines, block_size):
+        luigi.mock.MockFileSystem().clear()
+        format = luigi.format.Text >> blockcompress.BlockCompressionFormat(codec, block_size)
+        with luigi.mock.MockTarget('out', format=format).open('w') as f:
+            for line in lines:
+                f.write(line)
+        return luigi.mock.MockTarget('out', format=format), luigi.mock.MockFileSystem().get_data('out')
+
+    def test_gzip_blocks_end_on_lines(self):
+        lines = ['R\t{"R.a": %d}\n' % i for i in range(100)]
+        target, data = self._write("gzip", lines, 64)
+
+        # Every gzip member starts with the magic bytes, and decompresses to whole lines.
+        members = data.split(b'\x1f\x8b\x08')[1:]
+        assert len(members) > 10
+        for member in members:
+            block = gzip.decompress(b'\x1f\x8b\x08' + member)
+            assert block.endswith(b'\n')
+
+        assert gzip.decompress(data).decode('utf-8') == ''.join(lines)
+        with target.open('r') as f:
+            assert list(f) == lines
+
+    def test_bzip2_roundtrip(self):
+        lines = ['R\t{"R.a": "%s"}\n' % ('x' * i) for i in range(50)]
+        target, data = self._write("bzip2", lines, 256)
+        assert data.count(b'BZh') > 1
+        assert bz2.decompress(data).decode('utf-8') == ''.join(lines)
+        with target.open('r') as f:
+            assert list(f) == lines
+
+    def test_codec_for_path(self):
+        assert blockcompress.codec_for_path('Person.json.gz') == "gzip"
+        assert blockcompress.codec_for_path('tmp3.tmp.bz2') == "bzip2"
+        assert blockcompress.codec_for_path('Person.json') is None
+
+    def test_hadoop_jobconfs(self):
+        assert blockcompress.hadoop_jobconfs(None, None) == []
+        assert blockcompress.hadoop_jobconfs("bzip2", "lz4") == [
+            'mapreduce.output.fileoutputformat.compress=true',
+            'mapreduce.output.fileoutputformat.compress.codec=org.apache.hadoop.io.compress.BZip2Codec',
+            'mapreduce.map.output.compress=true',
+            'mapreduce.map.output.compress.codec=org.apache.hadoop.io.compress.Lz4Codec',
+        ]
+
+    def test_hdfs_codecs_are_splittable(self):
+        # Hadoop cannot split gzip files, so each would be read by a single mapper.
+        assert blockcompress.compression.hdfs.normalize("bzip2") == "bzip2"
+        with pytest.raises(ValueError):
+            blockcompress.compression.hdfs.normalize("gzip")
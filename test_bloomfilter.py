@@ -0,0 +1,28 @@
+import bloomfilter
+
+
+'''
+Checks the Bloom filter of the semi-join reduction.
+
+python3 -m pytest test_bloomfilter.py -p no:warnings --show-capture=no
+'''
+
+class TestBloomFilter(object):
+
+    def test_no_false_negatives(self):
+        keys = ["key" + str(i) for i in range(1000)] + [i for i in range(1000)] + [("Amy", 16)]
+        bloom = bloomfilter.BloomFilter.for_keys(keys)
+        assert all(key in bloom for key in keys)
+
+    def test_error_rate(self):
+        bloom = bloomfilter.BloomFilter.for_keys(range(1000), error_rate=0.01)
+        assert bloom.bits == bloomfilter.optimal_bits(1000, 0.01)
+        assert bloom.hashes == 7
+        false_positives = sum(1 for i in range(1000, 11000) if i in bloom)
+        assert false_positives < 200
+
+    def test_fixed_size(self):
+        bloom = bloomfilter.BloomFilter.for_keys(range(100), bits=64)
+        assert bloom.bits == 64 and len(bloom.array) == 8
+        assert bloom.hashes == 1
+        assert all(i in bloom for i in range(100))
@@ -0,0 +1,73 @@
+import json
+import luigi
+import radb
+import ra2mr
+import buckets
+
+import test_ra2mr
+
+
+'''
+Checks the bucketed storage of relations, and joins of bucketed relations.
+
+python3 -m pytest test_buckets.py -p no:warnings --show-capture=no
+'''
+
+class TestBuckets(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _evaluate(self, querystring):
+        task, ok = ra2mr.run_query(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        assert ok
+        with task.output().open('r') as f:
+            return task, sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True) for line in f)
+
+    def test_write_buckets(self):
+        manifest = buckets.write_buckets("Eats", "name", 4, env=ra2mr.ExecEnv.MOCK)
+        assert manifest["key"] == "Eats.name"
+        assert manifest["files"] == ["Eats.bucket-0000%d.json" % i for i in range(4)]
+
+        names = set()
+        total = 0
+        for bucket, filename in enumerate(manifest["files"]):
+            lines = luigi.mock.MockTarget(filename).open('r').read().splitlines()
+            keys = [json.loads(line.split('\t')[1])["Eats.name"] for line in lines]
+            assert keys == sorted(keys)
+            assert all(ra2mr.bucket_of(key, 4) == bucket for key in keys)
+            names |= set(keys)
+            total += len(lines)
+        assert total == 20
+        assert len(names) == 9
+
+    def test_bucket_join(self):
+        querystring = "Person \join_{Person.name = Eats.name} Eats;"
+        _, expected = self._evaluate(querystring)
+
+        buckets.write_buckets("Person", "name", 4, env=ra2mr.ExecEnv.MOCK)
+        buckets.write_buckets("Eats", "Eats.name", 4, env=ra2mr.ExecEnv.MOCK)
+        task, computed = self._evaluate("Eats \join_{Person.name = Eats.name} Person;")
+        assert isinstance(task, ra2mr.BucketJoinTask)
+        assert len(computed) == 20
+        assert computed == expected
+        assert not luigi.mock.MockTarget(task.output().path + ".buckets").exists()
+
+    def test_mismatched_buckets(self):
+        buckets.write_buckets("Person", "name", 4, env=ra2mr.ExecEnv.MOCK)
+        buckets.write_buckets("Eats", "pizza", 4, env=ra2mr.ExecEnv.MOCK)
+        raquery = radb.parse.one_statement_from_string("Person \join_{Person.name = Eats.name} Eats;")
+        assert isinstance(ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK), ra2mr.JoinTask)
+
+        buckets.write_buckets("Eats", "name", 2, env=ra2mr.ExecEnv.MOCK)
+        assert isinstance(ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK), ra2mr.JoinTask)
+
+    def test_stale_buckets(self):
+        buckets.write_buckets("Person", "name", 4, env=ra2mr.ExecEnv.MOCK)
+        buckets.write_buckets("Eats", "name", 4, env=ra2mr.ExecEnv.MOCK)
+        raquery = radb.parse.one_statement_from_string("Person \join_{Person.name = Eats.name} Eats;")
+        assert isinstance(ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK), ra2mr.BucketJoinTask)
+
+        with luigi.mock.MockTarget('Eats.json').open('w') as f:
+            f.write('Eats\t{"Eats.name": "Amy", "Eats.pizza": "mushroom"}\n')
+        assert isinstance(ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK), ra2mr.JoinTask)
@@ -0,0 +1,94 @@
+import json
+import luigi
+import pytest
+import radb
+import ra2mr
+import ra2py
+
+import test_ra2mr
+
+columnar = pytest.importorskip('columnar')
+
+
+'''
+Checks the vectorized evaluation against the in-process evaluation.
+Skipped if NumPy is not installed.
+
+python3 -m pytest test_columnar.py -p no:warnings --show-capture=no
+'''
+
+class TestColumnarEvaluation(object):
+    dd = {
+        "Person": {"name": "string", "age": "integer", "gender": "string"},
+        "Eats": {"name": "string", "pizza": "string"},
+        "Frequents": {"name": "string", "pizzeria": "string"},
+        "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"},
+    }
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _tuples(self, lines):
+        # Numeric columns holding both integers and floats come back as floats.
+        def canonical(value):
+            return float(value) if isinstance(value, (int, float)) else value
+
+        return sorted((sorted((k, canonical(v)) for k, v in json.loads(line.split('\t')[1]).items())
+                       for line in lines), key=json.dumps)
+
+    def _check(self, querystring, expected_count):
+        raquery = radb.parse.one_statement_from_string(querystring)
+        computed = columnar.execute(raquery, self.dd, env=ra2mr.ExecEnv.MOCK)
+        expected = ra2py.execute(raquery, env=ra2mr.ExecEnv.MOCK)
+
+        assert len(computed) == expected_count
+        assert self._tuples(computed) == self._tuples(expected)
+
+    def test_select_person(self):
+        self._check("\select_{gender='female' and age=16}(Person);", 1)
+
+    def test_select_range_serves(self):
+        self._check("\select_{price < 8 or not pizzeria <> 'Dominos'}(Serves);", 5)
+
+    def test_select_null_attribute(self):
+        data = luigi.mock.MockFileSystem().get_data('Person.json').decode('utf-8')
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write(data + 'Person\t{"Person.name": null, "Person.age": null, "Person.gender": "male"}\n')
+        self._check("\select_{age > 10}(Person);", 9)
+        self._check("\select_{age * 2 <= 40 or name < 'C'}(Person);", 4)
+        self._check("\select_{age > 'x'}(Person);", 0)
+        self._check("\project_{age} Person;", 9)
+
+    def test_project_gender(self):
+        self._check("\project_{gender} Person;", 2)
+
+    def test_project_select_rename(self):
+        self._check("\project_{P.name} \select_{P.age > 20} \\rename_{P:*} Person;", 6)
+
+    def test_join_rename(self):
+        self._check("(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);", 94)
+
+    def test_join_conjunction(self):
+        self._check("(\\rename_{P:*} Person) \join_{P.gender = Q.gender and P.age = Q.age} (\\rename_{Q:*} Person);", 9)
+
+    def test_join_join_serves(self):
+        self._check("Person \join_{Person.name = Eats.name} Eats "
+                    "\join_{Eats.pizza = Serves.pizza} \select_{price=8}Serves;", 8)
+
+    def test_empty_join(self):
+        self._check("Person \join_{Person.name = Serves.pizzeria} Serves;", 0)
+
+    def test_reload_changed_relation(self):
+        self._check("\select_{name = 'Amy'} Eats;", 2)
+        # Same size as before, but another name.
+        data = luigi.mock.MockFileSystem().get_data('Eats.json')
+        with luigi.mock.MockTarget('Eats.json').open('w') as f:
+            f.write(data.decode('utf-8').replace('"Amy"', '"Ann"'))
+        self._check("\select_{name = 'Amy'} Eats;", 0)
+        self._check("\select_{name = 'Ann'} Eats;", 2)
+
+    def test_reload_changed_schema(self):
+        relation = columnar.load("Eats", self.dd, env=ra2mr.ExecEnv.MOCK)
+        assert relation.attrs == ["Eats.name", "Eats.pizza"]
+        relation = columnar.load("Eats", {"Eats": {"name": "string"}}, env=ra2mr.ExecEnv.MOCK)
+        assert relation.attrs == ["Eats.name"]
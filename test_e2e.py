@@ -1,6 +1,5 @@
 
 import json
-import luigi
 import radb
 import sqlparse
 import unittest
@@ -30,14 +29,10 @@ class End2EndUnitTests(unittest.TestCase):
         stmt = sqlparse.parse(sqlstring)[0]
         ra0 = sql2ra.translate(stmt)
         
-        ra1 = raopt.rule_break_up_selections(ra0)
-        ra2 = raopt.rule_push_down_selections(ra1, dd)
+        ra1 = raopt.optimize(ra0, dd)
 
-        ra3 = raopt.rule_merge_selections(ra2)
-        ra4 = raopt.rule_introduce_joins(ra3)
-
-        task = ra2mr.task_factory(ra4, env=ra2mr.ExecEnv.MOCK)
-        luigi.build([task], local_scheduler=True)
+        task, ok = ra2mr.run_query(ra1, env=ra2mr.ExecEnv.MOCK)
+        assert ok
 
         f = task.output().open('r')
         lines = []
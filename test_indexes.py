@@ -0,0 +1,78 @@
+import json
+import luigi
+import radb
+import ra2mr
+import ra2py
+import indexes
+
+import test_ra2mr
+
+
+'''
+Checks the secondary indexes, and selections that use them.
+
+python3 -m pytest test_indexes.py -p no:warnings --show-capture=no
+'''
+
+class TestIndexes(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _check(self, querystring, expected_count, task_class):
+        raquery = radb.parse.one_statement_from_string(querystring)
+        task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert ok
+        assert isinstance(task, task_class)
+
+        with task.output().open('r') as f:
+            computed = sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True) for line in f)
+        expected = sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True)
+                          for line in ra2py.execute(raquery, env=ra2mr.ExecEnv.MOCK))
+        assert len(computed) == expected_count
+        assert computed == expected
+        return task
+
+    def test_index_lookup(self):
+        header = indexes.build_index("Eats", "name", env=ra2mr.ExecEnv.MOCK)
+        assert header["key"] == "Eats.name"
+
+        data = luigi.mock.MockFileSystem().get_data('Eats.json')
+        for name, count in [("Amy", 2), ("Dan", 5), ("Ian", 2), ("Zoe", 0), ("", 0)]:
+            offsets = ra2mr.index_lookup("Eats", "Eats.name", name, ra2mr.ExecEnv.MOCK)
+            assert len(offsets) == count
+            for offset in offsets:
+                assert data[offset:].startswith(b'Eats\t{"Eats.name" : "' + name.encode('utf-8') + b'"')
+
+    def test_index_scan(self):
+        indexes.build_index("Person", "Person.name", env=ra2mr.ExecEnv.MOCK)
+        task = self._check("\select_{name = 'Amy'} Person;", 1, ra2mr.SelectTask)
+        assert task.offsets == [0]
+        task = self._check("\select_{'Fay' = Person.name and age > 30} Person;", 0, ra2mr.SelectTask)
+        assert len(task.offsets) == 1
+
+    def test_index_scan_integers(self):
+        indexes.build_index("Person", "age", env=ra2mr.ExecEnv.MOCK)
+        task = self._check("\project_{name} \select_{age = 21} Person;", 2, ra2mr.FusedTask)
+        assert len(task.offsets) == 2
+
+    def test_index_scan_numbers(self):
+        # Prices are stored as integers (7) and floats (7.75), and compared to either.
+        indexes.build_index("Serves", "price", env=ra2mr.ExecEnv.MOCK)
+        for price, count in [("7.0", 2), ("7", 2), ("7.75", 1)]:
+            task = self._check("\select_{price = " + price + "} Serves;", count, ra2mr.SelectTask)
+            assert len(task.offsets) == count
+
+    def test_no_index(self):
+        indexes.build_index("Person", "name", env=ra2mr.ExecEnv.MOCK)
+        task = self._check("\select_{gender = 'female'} Person;", 3, ra2mr.SelectTask)
+        assert task.offsets is None
+        task = self._check("\select_{name = 'Amy' or age = 21} Person;", 3, ra2mr.SelectTask)
+        assert task.offsets is None
+
+    def test_stale_index(self):
+        indexes.build_index("Person", "name", env=ra2mr.ExecEnv.MOCK)
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write('Person\t{"Person.name": "Amy", "Person.age": 26, "Person.gender": "female"}\n')
+        task = self._check("\select_{name = 'Amy'} Person;", 1, ra2mr.SelectTask)
+        assert task.offsets is None
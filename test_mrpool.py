@@ -0,0 +1,71 @@
+import json
+import luigi
+import radb
+import ra2mr
+import ra2py
+
+import test_ra2mr
+
+
+'''
+Runs queries with the map and reduce tasks spread over a local process
+pool, on local copies of the test relations, and compares the results
+with the in-process evaluation.
+
+python3 -m pytest test_mrpool.py -p no:warnings --show-capture=no
+'''
+
+class TestPoolEvaluation(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _check(self, querystring, expected_count, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        for relation in ['Person', 'Eats', 'Frequents', 'Serves']:
+            with open(relation + '.json', 'w') as f:
+                f.write(luigi.mock.MockTarget(relation + '.json').open('r').read())
+
+        raquery = radb.parse.one_statement_from_string(querystring)
+        task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.PARALLEL)
+        assert luigi.build([task], local_scheduler=True)
+
+        with task.output().open('r') as f:
+            computed = [json.loads(line.split('\t')[1]) for line in f]
+        expected = [json.loads(line.split('\t')[1]) for line in ra2py.execute(raquery, env=ra2mr.ExecEnv.LOCAL)]
+
+        assert len(computed) == expected_count
+        assert sorted(computed, key=lambda t: json.dumps(t, sort_keys=True)) ==\
+            sorted(expected, key=lambda t: json.dumps(t, sort_keys=True))
+
+    def test_select_person(self, tmp_path, monkeypatch):
+        self._check("\select_{gender='female'}(Person);", 3, tmp_path, monkeypatch)
+
+    def test_project_gender(self, tmp_path, monkeypatch):
+        self._check("\project_{gender} Person;", 2, tmp_path, monkeypatch)
+
+    def test_join_rename(self, tmp_path, monkeypatch):
+        self._check("(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);", 94, tmp_path, monkeypatch)
+
+    def test_repartition_join(self, tmp_path, monkeypatch):
+        luigi.configuration.get_config().set('JoinTask', 'join_strategy', 'repartition')
+        try:
+            self._check("(Person \join_{Person.name = Eats.name} Eats) \join_{Eats.name = Frequents.name} Frequents;",
+                        42, tmp_path, monkeypatch)
+        finally:
+            luigi.configuration.get_config().remove_option('JoinTask', 'join_strategy')
+
+    def test_projected_join_inputs(self, tmp_path, monkeypatch):
+        self._check("\project_{Person.name} ((\select_{Person.age > 20} \project_{Person.name, Person.age} Person) "
+                    "\join_{Person.name = Eats.name} (\project_{Eats.name} Eats));", 6, tmp_path, monkeypatch)
+
+    def test_compressed_join(self, tmp_path, monkeypatch):
+        luigi.configuration.get_config().set('compression', 'local', 'gzip')
+        try:
+            self._check("\project_{Person.name, Eats.pizza} (Person \join_{Person.name = Eats.name} Eats);",
+                        20, tmp_path, monkeypatch)
+            results = sorted(tmp_path.glob('tmp*.tmp.gz'))
+            assert len(results) == 2
+            assert all(path.read_bytes()[:2] == b'\x1f\x8b' for path in results)
+        finally:
+            luigi.configuration.get_config().remove_option('compression', 'local')
@@ -0,0 +1,91 @@
+import json
+import luigi
+import radb
+import sqlparse
+import ra2mr
+import raopt
+import sql2ra
+import plancache
+
+import test_ra2mr
+
+
+'''
+Checks that queries of the same shape share one cached plan, and that
+the cached plans compute the same results as freshly optimized ones.
+
+python3 -m pytest test_plancache.py -p no:warnings --show-capture=no
+'''
+
+class TestPlanCache(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+        self.dd = {}
+        self.dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        self.dd["Eats"] = {"name": "string", "pizza": "string"}
+        self.dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+
+    def _evaluate(self, task):
+        luigi.build([task], local_scheduler=True)
+        with task.output().open('r') as f:
+            return sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True) for line in f)
+
+    def test_normalize(self):
+        template, literals = plancache.normalize(
+            "SELECT  distinct Person.name\n  from Person where Person.age = 16 And Person.name='O''Neil';")
+        assert template == "select distinct Person.name from Person where Person.age = " + plancache.parameter(0) + \
+            " and Person.name=" + plancache.parameter(1)
+        assert literals == ["16", "'O''Neil'"]
+
+    def test_same_shape_hits(self):
+        cache = plancache.PlanCache()
+        sql = "select distinct Person.name, Serves.pizzeria from Person, Eats, Serves " \
+              "where Person.name = Eats.name and Eats.pizza = Serves.pizza and Eats.pizza = '%s'"
+        mushroom = cache.optimize(sql % "mushroom", self.dd)
+        cheese = cache.optimize("SELECT DISTINCT Person.name, Serves.pizzeria\n  FROM Person, Eats, Serves\n"
+                                "  WHERE Person.name = Eats.name AND Eats.pizza = Serves.pizza AND Eats.pizza = 'cheese';",
+                                self.dd)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert str(mushroom).replace("'mushroom'", "'cheese'") == str(cheese)
+
+    def test_cached_plans_compute_the_same_results(self):
+        cache = plancache.PlanCache()
+        sql = "select distinct Person.name, Serves.pizza from Person, Eats, Serves " \
+              "where Person.name = Eats.name and Eats.pizza = Serves.pizza and Person.age = %d"
+        for age in [16, 21, 16]:
+            computed = self._evaluate(cache.plan(sql % age, self.dd, env=ra2mr.ExecEnv.MOCK))
+
+            ra = raopt.optimize(sql2ra.translate(sqlparse.parse(sql % age)[0]), self.dd)
+            expected = self._evaluate(ra2mr.task_factory(ra, env=ra2mr.ExecEnv.MOCK))
+            assert computed == expected
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_lru_eviction(self):
+        cache = plancache.PlanCache(size=2)
+        cache.optimize("select distinct * from Person where age = 16", self.dd)
+        cache.optimize("select distinct * from Eats where pizza = 'cheese'", self.dd)
+        cache.optimize("select distinct * from Person where age = 21", self.dd)
+        cache.optimize("select distinct * from Serves where price = 7", self.dd)
+        assert len(cache) == 2
+
+        cache.optimize("select distinct * from Person where age = 30", self.dd)
+        cache.optimize("select distinct * from Eats where pizza = 'supreme'", self.dd)
+        assert (cache.hits, cache.misses) == (2, 4)
+
+    def test_invalidation(self):
+        cache = plancache.PlanCache()
+        sql = "select distinct * from Person, Eats, Serves where Person.name = Eats.name and Eats.pizza = Serves.pizza"
+        stats = {"Person": {"rows": 9, "fingerprint": [663, 1]}, "Eats": {"rows": 20, "fingerprint": [1047, 1]},
+                 "Serves": {"rows": 18, "fingerprint": [1673, 1]}}
+        cache.optimize(sql, self.dd, stats)
+        cache.optimize(sql, self.dd, stats)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        stats["Serves"] = {"rows": 1, "fingerprint": [90, 2]}
+        cache.optimize(sql, self.dd, stats)
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        self.dd["Person"]["city"] = "string"
+        cache.optimize(sql, self.dd, stats)
+        assert (cache.hits, cache.misses) == (1, 3)
@@ -1,4 +1,6 @@
 
+import gzip
+import itertools
 import json
 import luigi
 import radb
@@ -120,8 +122,8 @@ class TestMREvaluation(object):
     def _evaluate(self, querystring):
         raquery = radb.parse.one_statement_from_string(querystring)
 
-        task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK)
-        luigi.build([task], local_scheduler=True)
+        task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert ok
 
         f = task.output().open('r')
         lines = []
@@ -200,6 +202,32 @@ class TestMREvaluation(object):
         querystring = "\select_{age=3}(Person);"
         self._check(querystring, [])
 
+    def test_select_person_age_range_not_male(self):
+        querystring = "\select_{age > 20 and not gender = 'male'}(Person);"
+        result = [self.person_fay, self.person_hil]
+        self._check(querystring, result)
+
+    def test_select_person_age_or(self):
+        querystring = "\select_{age < 14 or age >= 45}(Person);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 2
+
+    def test_select_price_le_7_serves(self):
+        querystring = "\select_{price <= 7 and pizzeria <> 'Dominos'}(Serves);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 2
+
+    def test_select_null_attribute(self):
+        # Comparisons with NULL do not hold, so the NULL tuple is never selected.
+        data = luigi.mock.MockFileSystem().get_data('Person.json').decode('utf-8')
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write(data + 'Person\t{"Person.name": null, "Person.age": null, "Person.gender": "male"}\n')
+
+        assert len(self._evaluate("\select_{age > 10}(Person);")) == 9
+        assert len(self._evaluate("\select_{age * 2 <= 40}(Person);")) == 3
+        assert len(self._evaluate("\select_{name < 'C'}(Person);")) == 2
+        assert len(self._evaluate("\select_{age > 'x'}(Person);")) == 0
+
     def test_select_pizza_mushroom(self):
         querystring = "\project_{pizza} \select_{pizza='mushroom'} Eats;"
         computed = self._evaluate(querystring)
@@ -282,3 +310,430 @@ class TestMREvaluation(object):
         querystring = "(\\rename_{P:*} Person) \join_{P.gender = Q.gender and P.age = Q.age} (\\rename_{Q:*} Person);"
         computed = self._evaluate(querystring)
         assert len(computed) == 9
+
+    def test_select_parses_query_once_per_task(self):
+        task = ra2mr.SelectTask(querystring="\select_{gender='female'}(Person);", exec_environment=ra2mr.ExecEnv.MOCK)
+        lines = luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+
+        parse = radb.parse.one_statement_from_string
+        calls = []
+
+        def counting_parse(querystring):
+            calls.append(querystring)
+            return parse(querystring)
+
+        radb.parse.one_statement_from_string = counting_parse
+        try:
+            task.init_mapper()
+            computed = [output for line in lines for output in task.mapper(line)]
+        finally:
+            radb.parse.one_statement_from_string = parse
+
+        assert len(calls) == 1
+        assert len(computed) == 3
+
+    def test_fused_project_select_rename(self):
+        querystring = "\project_{P.name} \select_{P.age > 20} \\rename_{P:*} Person;"
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        assert isinstance(task, ra2mr.FusedTask)
+        assert isinstance(task.requires()[0], ra2mr.InputData)
+
+        computed = self._evaluate(querystring)
+        assert len(computed) == 6
+        for line in computed:
+            relation, tuple = line.split('\t')
+            assert relation == 'P'
+            assert list(json.loads(tuple).keys()) == ['P.name']
+
+    def test_fused_select_rename_is_map_only(self):
+        querystring = "\select_{P.gender='female'} \\rename_{P:*} (Person);"
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        assert isinstance(task, ra2mr.FusedTask)
+        assert task.reducer == NotImplemented
+
+    def _evaluate_join(self, querystring, join_strategy):
+        task = ra2mr.JoinTask(querystring=querystring, join_strategy=join_strategy, exec_environment=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+
+        f = task.output().open('r')
+        lines = [line for line in f]
+        f.close()
+        return task, lines
+
+    def test_broadcast_join(self):
+        querystring = "Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        task, computed = self._evaluate_join(querystring, "broadcast")
+        assert task.broadcast == 1
+        assert task.reducer == NotImplemented
+        assert len(computed) == 4
+
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            assert relation == 'Person'
+            assert list(json_tuple.keys()) == ['Person.name', 'Person.age', 'Person.gender', 'Eats.name', 'Eats.pizza']
+
+    def test_repartition_join(self):
+        querystring = "Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        task, computed = self._evaluate_join(querystring, "repartition")
+        assert task.broadcast is None
+        assert len(computed) == 4
+
+    def test_repartition_join_bloom_filter(self):
+        querystring = "Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        task = ra2mr.JoinTask(querystring=querystring, join_strategy="repartition", bloom_filter=True,
+                              exec_environment=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+        assert task.build == 1
+        assert "Amy" in task.bloom and "Ben" not in task.bloom
+
+        f = task.output().open('r')
+        computed = [line for line in f]
+        f.close()
+        assert len(computed) == 4
+
+        # Only the Person tuples of Amy, Dan, Fay and Gus pass the filter, the other 5 are dropped.
+        lines = luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+        task.init_mapper()
+        assert len(lines) == 9
+        assert len([output for line in lines for output in task.mapper(line)]) == 4
+
+    def test_condition_needles(self):
+        def needles(condition):
+            return ra2mr.condition_needles(radb.parse.one_statement_from_string("\\select_{" + condition + "} Eats;").cond)
+
+        assert needles("name = 'Amy' and (pizza = 'cheese' or pizza = 'supreme')") == [b'"Amy"']
+        assert needles("'Amy' = Eats.name and pizza = 'cheese'") == [b'"Amy"', b'"cheese"']
+        assert needles("name = 'Dan \"D\"' and name > 'Amy'") == []
+
+    def test_select_needles(self):
+        querystring = "\\select_{name = 'Dan' and age < 20} Person;"
+        task = ra2mr.SelectTask(querystring=querystring, exec_environment=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+        assert task.needles == [b'"Dan"']
+        assert [line.rstrip('\n') for line in task.input_hadoop()[0].open('r')] ==\
+            ['Person\t{"Person.name": "Dan", "Person.age": 13, "Person.gender": "male"}']
+
+        f = task.output().open('r')
+        computed = [line for line in f]
+        f.close()
+        assert len(computed) == 1
+
+    def test_mapped_inputs(self):
+        # Input relations are read through the memory map, intermediate results as text.
+        querystring = "Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        task = ra2mr.JoinTask(querystring=querystring, join_strategy="repartition",
+                              exec_environment=ra2mr.ExecEnv.MOCK)
+        inputs = task.input_hadoop()
+        assert isinstance(inputs[0], ra2mr.MappedInput)
+        assert not isinstance(inputs[1], ra2mr.MappedInput)
+
+        with inputs[0].open('r') as f:
+            lines = [line for line in f]
+        assert lines == luigi.mock.MockTarget('Person.json').open('r').readlines()
+
+    def test_mappers_parse_needed_attributes(self):
+        # The first tuple is parsed as a whole, later ones only in the attributes read.
+        task = ra2mr.SelectTask(querystring="\select_{age > 20} Person;", exec_environment=ra2mr.ExecEnv.MOCK)
+        assert isinstance(task.job_runner(), ra2mr.MappedJobRunner)
+        task.init_mapper()
+        line = 'Person\t{"Person.name": "Fay \\"Person.age\\": 5", "Person.age": 21, "Person.gender": "female"}'
+        assert list(task.mapper(line.encode('utf-8'))) == [('Person', line.split('\t')[1])]
+        assert list(task.mapper(line.encode('utf-8'))) == [('Person', line.split('\t')[1])]
+        assert task.parsers['Person'](line.split('\t')[1]) == {"Person.age": 21}
+
+        def attributes(querystring, keys):
+            operators, _ = ra2mr.unary_chain(radb.parse.one_statement_from_string(querystring))
+            return ra2mr.pipeline_attributes(operators, keys)
+
+        keys = ["Person.name", "Person.age", "Person.gender"]
+        assert attributes("\project_{name} \select_{age > 20} Person;", keys) == ["Person.name", "Person.age"]
+        assert attributes("\select_{age > 20} Person;", keys) is None
+        assert attributes("\project_{P.name} \\rename_{P:*} Person;", keys) is None
+
+        self._check("\project_{name} \select_{age > 20 and gender = 'male'} Person;",
+                    ['{"Person.name": "Ben"}', '{"Person.name": "Cal"}', '{"Person.name": "Eli"}', '{"Person.name": "Gus"}'])
+
+    def test_repartition_join_heavy_keys(self):
+        querystring = "(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);"
+        task, computed = self._evaluate_join(querystring, "repartition")
+        assert len(computed) == 94
+
+        pairs = set()
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            assert relation == 'A'
+            assert json_tuple["A.pizza"] == json_tuple["B.pizza"]
+            pairs.add((json_tuple["A.name"], json_tuple["B.name"], json_tuple["A.pizza"]))
+        assert len(pairs) == 94
+
+    def test_repartition_join_skewed_keys(self):
+        querystring = "(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);"
+        task = ra2mr.JoinTask(querystring=querystring, join_strategy="repartition", skew_threshold=0.25,
+                              skew_partitions=3, exec_environment=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+        assert task.skewed_keys == ["cheese", "supreme"]
+
+        f = task.output().open('r')
+        computed = [line for line in f]
+        f.close()
+        assert len(computed) == 94
+
+    def test_skewed_keys_sampled_from_whole_input(self):
+        # The heavy key only appears after the first skew_sample_size lines.
+        with luigi.mock.MockTarget('Eats.json').open('w') as f:
+            for i in range(100):
+                f.write('Eats\t{"Eats.name": "P%d", "Eats.pizza": "p%d"}\n' % (i, i))
+            for i in range(100):
+                f.write('Eats\t{"Eats.name": "Q%d", "Eats.pizza": "cheese"}\n' % i)
+        lines = luigi.mock.MockTarget('Eats.json').open('r').read().splitlines()
+        sample = ra2mr.sample_target(luigi.mock.MockTarget('Eats.json'), 50, 10)
+        assert len(sample) == 50 and len(set(sample)) == 50
+        assert set(sample) <= set(lines)
+        assert sorted(ra2mr.sample_target(luigi.mock.MockTarget('Eats.json'), 1000, 4)) == sorted(lines)
+
+        querystring = "(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);"
+        task = ra2mr.JoinTask(querystring=querystring, join_strategy="repartition", skew_sample_size=50,
+                              exec_environment=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+        assert task.skewed_keys == ["cheese"]
+
+    def test_join_evaluates_projections_of_inputs(self):
+        querystring = "\\project_{Person.name} ((\\project_{Person.name} Person) \\join_{Person.name = Eats.name} " \
+                      "(\\project_{Eats.name} \\select_{pizza='mushroom'} Eats));"
+        join = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK).requires()[0]
+        assert [type(task) for task in join.requires()] == [ra2mr.InputData, ra2mr.SelectTask]
+
+        config = luigi.configuration.get_config()
+        for strategy in ["broadcast", "repartition"]:
+            config.set('JoinTask', 'join_strategy', strategy)
+            try:
+                prepareMockFileSystem()
+                assert sorted(self._evaluate(querystring)) == sorted(self._evaluate_packed(querystring))
+                prepareMockFileSystem()
+                assert self._tuples(self._evaluate_packed(querystring)) == \
+                    [[("Person.name", name)] for name in ["Amy", "Dan", "Fay", "Gus"]]
+            finally:
+                config.remove_option('JoinTask', 'join_strategy')
+        prepareMockFileSystem()
+        self._evaluate(querystring)
+        with join.output().open('r') as f:
+            assert all(set(json.loads(line.split('\t')[1])) == {"Person.name", "Eats.name"} for line in f)
+
+        # Projections further down are map-only, and their results are not shared with those that are not.
+        querystring = "\\project_{Person.name} ((\\select_{Person.age > 20} \\project_{Person.name, Person.age} Person) " \
+                      "\\join_{Person.name = Eats.name} Eats);"
+        fused = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring),
+                                   env=ra2mr.ExecEnv.MOCK).requires()[0].requires()[0]
+        assert isinstance(fused, ra2mr.FusedTask) and fused.reducer == NotImplemented
+        prepareMockFileSystem()
+        assert len(self._evaluate(querystring)) == 6
+        alone = ra2mr.task_factory(radb.parse.one_statement_from_string(fused.querystring), env=ra2mr.ExecEnv.MOCK)
+        assert alone.reducer != NotImplemented
+        assert alone.output().path != fused.output().path
+
+        # Without an operator above that eliminates duplicates, the projection must.
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(
+            "(\\project_{Eats.pizza} Eats) \\join_{Eats.pizza = Serves.pizza} Serves;"), env=ra2mr.ExecEnv.MOCK)
+        assert isinstance(task.requires()[0], ra2mr.ProjectTask)
+        assert task.requires()[0].reducer != NotImplemented
+
+    def test_project_dedups_in_mapper(self):
+        task = ra2mr.ProjectTask(querystring="\project_{gender} Person;", exec_environment=ra2mr.ExecEnv.MOCK)
+        lines = luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+
+        task.init_mapper()
+        computed = [output for line in lines for output in task.mapper(line)]
+        assert computed == [('{"Person.gender":"female"}', 'Person'), ('{"Person.gender":"male"}', 'Person')]
+
+    def test_project_dedup_cache_eviction(self):
+        task = ra2mr.ProjectTask(querystring="\project_{gender} Person;", dedup_cache_size=1,
+                                 exec_environment=ra2mr.ExecEnv.MOCK)
+        lines = luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+
+        task.init_mapper()
+        computed = [output for line in lines for output in task.mapper(line)]
+        # female, male, male, male, male, female, male, female, male
+        assert len(computed) == 6
+
+        task.init_combiner()
+        combined = [output for key, values in itertools.groupby(sorted(computed), key=lambda x: x[0])
+                    for output in task.combiner(key, (v[1] for v in values))]
+        assert len(combined) == 2
+
+    def _evaluate_packed(self, querystring):
+        config = luigi.configuration.get_config()
+        config.set('intermediate', 'format', 'packed')
+        try:
+            return self._evaluate(querystring)
+        finally:
+            config.remove_option('intermediate', 'format')
+
+    def _input_path(self, querystring):
+        # The path of the result of the subquery that the root of the query reads.
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        return task.requires()[0].output().path
+
+    def _tuples(self, lines):
+        return sorted(sorted(json.loads(line.split('\t')[1]).items()) for line in lines)
+
+    def test_packed_intermediate_results(self):
+        querystring = "\\project_{Person.name, Eats.pizza} ((\\select_{age > 20} Person) \join_{Person.name = Eats.name} Eats);"
+        expected = self._evaluate(querystring)
+
+        prepareMockFileSystem()
+        computed = self._evaluate_packed(querystring)
+        assert self._tuples(computed) == self._tuples(expected)
+
+        # The join result (step 2) is packed, with its schema in a sidecar file.
+        luigi.configuration.get_config().set('intermediate', 'format', 'packed')
+        try:
+            path = self._input_path(querystring)
+        finally:
+            luigi.configuration.get_config().remove_option('intermediate', 'format')
+        relation, tuple = luigi.mock.MockTarget(path).open('r').readline().rstrip('\n').split('\t')
+        assert relation == 'Person'
+        assert isinstance(json.loads(tuple), list)
+        schema = json.loads(luigi.mock.MockTarget(path + '.schema').open('r').read())
+        assert schema == {"relation": "Person", "attrs": ["Person.name", "Person.age", "Person.gender",
+                                                          "Eats.name", "Eats.pizza"]}
+
+    def test_packed_self_join(self):
+        querystring = "(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} (\select_{name='Dan'} Eats));"
+        expected = self._evaluate(querystring)
+
+        prepareMockFileSystem()
+        computed = self._evaluate_packed(querystring)
+        assert len(computed) == len(expected) == 20
+        assert self._tuples(computed) == self._tuples(expected)
+
+    def test_compressed_intermediate_results(self):
+        querystring = "\\project_{Person.name, Eats.pizza} ((\\select_{age > 20} Person) \\join_{Person.name = Eats.name} Eats);"
+        expected = self._evaluate(querystring)
+
+        prepareMockFileSystem()
+        config = luigi.configuration.get_config()
+        config.set('compression', 'mock', 'bzip2')
+        try:
+            computed = self._evaluate(querystring)
+            path = self._input_path(querystring)
+        finally:
+            config.remove_option('compression', 'mock')
+        assert self._tuples(computed) == self._tuples(expected)
+        assert path.endswith('.tmp.bz2')
+        assert luigi.mock.MockFileSystem().get_data(path)[:3] == b'BZh'
+
+    def test_compressed_input_data(self):
+        data = luigi.mock.MockFileSystem().get_data('Person.json')
+        luigi.mock.MockFileSystem().get_all_data()['People.json.gz'] = gzip.compress(data)
+        task = ra2mr.InputData(filename='People.json.gz', exec_environment=ra2mr.ExecEnv.MOCK)
+        assert list(ra2mr.read_target(task.output())) == data.decode('utf-8').splitlines()
+
+
+class TestRunQuery(object):
+
+    def setup_method(self, method):
+        prepareMockFileSystem()
+
+    def test_count_parallel_steps(self):
+        def count(querystring):
+            return ra2mr.count_parallel_steps(radb.parse.one_statement_from_string(querystring))
+
+        assert count("Person;") == 0
+        assert count("\project_{name} (\select_{age > 20} Person);") == 1
+        assert count("Person \join_{Person.name = Eats.name} Eats;") == 1
+        assert count("(\select_{age > 20} Person) \join_{Person.name = Eats.name} (\select_{pizza = 'cheese'} Eats);") == 2
+        assert count("((\select_{age > 20} Person) \join_{Person.name = Eats.name} Eats) \join_{Eats.pizza = Serves.pizza} "
+                     "((\select_{price > 8} Serves) \join_{Serves.pizzeria = Frequents.pizzeria} Frequents);") == 2
+
+    def test_bushy_join(self):
+        querystring = "((\select_{age > 20} Person) \join_{Person.name = Eats.name} (\select_{pizza = 'cheese'} Eats)) " \
+                      "\join_{Eats.pizza = Serves.pizza} " \
+                      "((\select_{price > 8} Serves) \join_{Serves.pizzeria = Frequents.pizzeria} Frequents);"
+        raquery = radb.parse.one_statement_from_string(querystring)
+        task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert ok
+        with task.output().open('r') as f:
+            computed = [line for line in f]
+
+        prepareMockFileSystem()
+        sequential, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK, workers=1)
+        assert ok
+        with sequential.output().open('r') as f:
+            expected = [line for line in f]
+
+        assert len(computed) > 0
+        assert sorted(computed) == sorted(expected)
+
+    def test_failed_query(self):
+        raquery = radb.parse.one_statement_from_string("\select_{name = 'Amy'} Customer;")
+        task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert not ok
+        assert not task.output().exists()
+
+
+class TestResultCache(object):
+
+    def setup_method(self, method):
+        prepareMockFileSystem()
+
+    def _task(self, querystring):
+        return ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+
+    def _results(self):
+        return sorted(path for path in luigi.mock.MockFileSystem().get_all_data().keys()
+                      if ra2mr.RESULT_NAME.match(path))
+
+    def test_shared_subquery(self):
+        task = self._task("\project_{Person.name} (\select_{age > 20} Person);")
+        assert luigi.build([task], local_scheduler=True)
+
+        other = self._task("\project_{Person.gender} (\select_{age > 20} Person);")
+        assert other.requires()[0].output().path == task.requires()[0].output().path
+        assert other.requires()[0].complete()
+        assert not other.complete()
+
+    def test_changed_input(self):
+        path = self._task("\select_{age > 20} Person;").output().path
+        assert path == self._task("\select_{age > 20} Person;").output().path
+
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write('Person\t{"Person.name": "Amy", "Person.age": 26, "Person.gender": "female"}\n')
+        assert path != self._task("\select_{age > 20} Person;").output().path
+
+    def test_hdfs_version_changes_with_rewrite(self, monkeypatch):
+        # The rewritten file has the same size and number of files, but a later modification time.
+        class FakeClient(object):
+            def exists(self, path):
+                return True
+
+            def isdir(self, path):
+                return False
+
+            def count(self, path):
+                return {'content_size': '16', 'file_count': '1', 'dir_count': '0'}
+
+        stats = iter(["1700000000000\n", "1700000004000\n"])
+        monkeypatch.setattr(luigi.contrib.hdfs.hadoopcli_clients.HdfsClient, "call_check",
+                            staticmethod(lambda cmd: next(stats)))
+        target = luigi.contrib.hdfs.HdfsTarget("Person.json", fs=FakeClient())
+        ra2mr.versions.clear()
+        before = ra2mr.target_version(target)
+        ra2mr.versions.clear()
+        assert ra2mr.target_version(target) != before
+
+    def test_eviction(self):
+        first = self._task("\project_{Person.name} (Person \join_{Person.name = Eats.name} Eats);")
+        assert luigi.build([first], local_scheduler=True)
+        assert len(self._results()) == 2
+
+        luigi.configuration.get_config().set('resultcache', 'max_size', '1')
+        try:
+            second = self._task("\project_{Person.gender} (Person \join_{Person.name = Frequents.name} Frequents);")
+            assert luigi.build([second], local_scheduler=True)
+        finally:
+            luigi.configuration.get_config().remove_option('resultcache', 'max_size')
+
+        # Only the result of the query that just ran is kept.
+        assert self._results() == [second.output().path]
@@ -0,0 +1,106 @@
+import json
+import luigi
+import radb
+import ra2mr
+import ra2py
+import raopt
+
+import test_ra2mr
+
+
+'''
+Checks that the in-process evaluation of a query plan yields the same
+tuples as running the plan as MapReduce jobs.
+
+python3 -m pytest test_ra2py.py -p no:warnings --show-capture=no
+'''
+
+class TestInProcessEvaluation(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _tuples(self, lines):
+        return sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True) for line in lines)
+
+    def _check(self, querystring, expected_count):
+        raquery = radb.parse.one_statement_from_string(querystring)
+        computed = ra2py.execute(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert len(computed) == expected_count
+
+        task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+        f = task.output().open('r')
+        expected = [line for line in f]
+        f.close()
+
+        assert self._tuples(computed) == self._tuples(expected)
+
+    def test_select_person(self):
+        self._check("\select_{gender='female' and age=16}(Person);", 1)
+
+    def test_select_null_attribute(self):
+        data = luigi.mock.MockFileSystem().get_data('Person.json').decode('utf-8')
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write(data + 'Person\t{"Person.name": null, "Person.age": null, "Person.gender": "male"}\n')
+        self._check("\select_{age > 10}(Person);", 9)
+        self._check("\select_{age * 2 <= 40 or name < 'C'}(Person);", 4)
+        self._check("\select_{age > 'x'}(Person);", 0)
+
+    def test_project_gender(self):
+        self._check("\project_{gender} Person;", 2)
+
+    def test_fused_project_select_rename(self):
+        self._check("\project_{P.name} \select_{P.age > 20} \\rename_{P:*} Person;", 6)
+
+    def test_person_join_eats_join_serves(self):
+        self._check("Person \join_{Person.name = Eats.name} Eats "
+                    "\join_{Eats.pizza = Serves.pizza} \select_{price=8}Serves;", 8)
+
+    def test_rename_self_join(self):
+        self._check("(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);", 94)
+
+    def test_project_person_join_eats(self):
+        self._check("\project_{Person.name, Eats.pizza} (Person \join_{Person.name = Eats.name} Eats);", 20)
+
+    def test_reordered_joins(self):
+        querystring = "\project_{Person.name, Serves.pizzeria} ((Person \join_{Person.name = Eats.name} Eats) " \
+                      "\join_{Eats.pizza = Serves.pizza} (\select_{price=8} Serves));"
+        dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+              "Eats": {"name": "string", "pizza": "string"},
+              "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+        stats = {"Person": {"rows": 9}, "Eats": {"rows": 20, "distinct": {"name": 9, "pizza": 5}},
+                 "Serves": {"rows": 18, "distinct": {"pizza": 5, "price": 8}}}
+
+        raquery = radb.parse.one_statement_from_string(querystring)
+        reordered = raopt.rule_reorder_joins(radb.parse.one_statement_from_string(querystring), dd, stats)
+        assert str(reordered) != str(raquery)
+        assert self._tuples(ra2py.execute(reordered, env=ra2mr.ExecEnv.MOCK)) ==\
+            self._tuples(ra2py.execute(raquery, env=ra2mr.ExecEnv.MOCK))
+
+    def test_pushed_down_projections(self):
+        dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+              "Eats": {"name": "string", "pizza": "string"},
+              "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+        querystring = "\project_{P.name, Serves.pizzeria} (((\\rename_{P:*} Person) \join_{P.name = Eats.name} Eats) " \
+                      "\join_{Eats.pizza = Serves.pizza} (\select_{price < 10} Serves));"
+
+        pushed = raopt.rule_push_down_projections(radb.parse.one_statement_from_string(querystring), dd)
+        assert str(pushed).count('\project') > 1
+        self._check(str(pushed) + ";", len(ra2py.execute(radb.parse.one_statement_from_string(querystring),
+                                                         env=ra2mr.ExecEnv.MOCK)))
+
+    def test_mapped_scan(self, tmp_path):
+        data = luigi.mock.MockFileSystem().get_data('Eats.json')
+        (tmp_path / 'Eats.json').write_bytes(data)
+        expected = [(relation, json.loads(tuple)) for relation, tuple in
+                    (line.split('\t') for line in data.decode('utf-8').splitlines())]
+
+        assert list(ra2py.scan(luigi.LocalTarget(str(tmp_path / 'Eats.json')))) == expected
+        assert list(ra2py.scan(luigi.mock.MockTarget('Eats.json'))) == expected
+        dan = list(ra2py.scan(luigi.LocalTarget(str(tmp_path / 'Eats.json')), [b'"Dan"', b'"cheese"']))
+        assert dan == [('Eats', {"Eats.name": "Dan", "Eats.pizza": "cheese"})]
+
+    def test_selection_needles(self):
+        self._check("\select_{name = 'Dan' and 'mushroom' = pizza} Eats;", 1)
+        self._check("\project_{pizza} \select_{Eats.name = 'Amy'} Eats;", 2)
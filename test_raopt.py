@@ -1,5 +1,8 @@
+import collections
 import radb
 import raopt
+import sql2ra
+import sqlparse
 import unittest
 
 '''
@@ -219,6 +222,298 @@ class TestAllSteps(unittest.TestCase):
                        (\\rename_{E: *} Eats));""")
 
 
+
+
+'''
+Tests the pushdown of projections.
+'''
+class TestPushDownProjections(unittest.TestCase):
+
+    def _check(self, input, expected):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+
+        computed_expr = raopt.rule_push_down_projections(radb.parse.one_statement_from_string(input), dd)
+        expected_expr = radb.parse.one_statement_from_string(expected)
+        self.assertEqual(str(computed_expr), str(expected_expr))
+
+    def test_project_person(self):
+        self._check("\project_{name} Person;",
+                    "\project_{name} Person;")
+
+    def test_project_select_person(self):
+        self._check("\project_{name} \select_{age > 20} Person;",
+                    "\project_{name} \select_{age > 20} \project_{Person.name, Person.age} Person;")
+
+    def test_no_projection(self):
+        self._check("Person \join_{Person.name = Eats.name} Eats;",
+                    "Person \join_{Person.name = Eats.name} Eats;")
+
+    def test_project_join(self):
+        self._check("""\project_{Person.name} ((Person \join_{Person.name = Eats.name} Eats)
+                       \join_{Eats.pizza = Serves.pizza} (\select_{pizzeria = 'Dominos'} Serves));""",
+                    """\project_{Person.name} ((\project_{Person.name, Eats.pizza}
+                       ((\project_{Person.name} Person) \join_{Person.name = Eats.name} Eats))
+                       \join_{Eats.pizza = Serves.pizza} (\project_{Serves.pizza} (\select_{pizzeria = 'Dominos'}
+                       (\project_{Serves.pizzeria, Serves.pizza} Serves))));""")
+
+    def test_renamings(self):
+        self._check("""\project_{P.name, E.pizza} ((\\rename_{P: *} Person) \join_{P.name = E.name}
+                       (\\rename_{E: *} Eats));""",
+                    """\project_{P.name, E.pizza} ((\\rename_{P: *} (\project_{Person.name} Person))
+                       \join_{P.name = E.name} (\\rename_{E: *} Eats));""")
+
+    def test_renamed_attributes(self):
+        self._check("""\project_{X.n} \select_{X.n = Serves.pizzeria}
+                       ((\\rename_{X: n, a, g} Person) \cross Serves);""",
+                    """\project_{X.n} \select_{X.n = Serves.pizzeria}
+                       ((\project_{X.n} \\rename_{X: n, a, g} Person) \cross (\project_{Serves.pizzeria} Serves));""")
+
+
+'''
+Tests the cost-based ordering of joins.
+'''
+class TestReorderJoins(unittest.TestCase):
+
+    dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+          "Eats": {"name": "string", "pizza": "string"},
+          "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+
+    stats = {"Person": {"rows": 1000000, "distinct": {"name": 1000000, "age": 100, "gender": 2}},
+             "Eats": {"rows": 2000000, "distinct": {"name": 1000000, "pizza": 50}},
+             "Serves": {"rows": 100, "distinct": {"pizzeria": 10, "pizza": 50, "price": 20}}}
+
+    def _check(self, input, expected, stats=None):
+        computed_expr = raopt.rule_reorder_joins(radb.parse.one_statement_from_string(input), self.dd,
+                                                 self.stats if stats is None else stats)
+        expected_expr = radb.parse.one_statement_from_string(expected)
+        self.assertEqual(str(computed_expr), str(expected_expr))
+
+    def test_selective_relation_first(self):
+        self._check("""\project_{Person.name} ((Person \join_{Person.name = Eats.name} Eats)
+                       \join_{Eats.pizza = Serves.pizza} (\select_{pizzeria = 'Dominos'} Serves));""",
+                    """\project_{Person.name} ((Eats \join_{Eats.pizza = Serves.pizza}
+                       (\select_{pizzeria = 'Dominos'} Serves)) \join_{Person.name = Eats.name} Person);""")
+
+    def test_avoids_cross_products(self):
+        # Person and Serves are the smallest inputs, but share no join predicate.
+        self._check("""((\select_{Person.name = 'Amy'} Person) \join_{Person.name = Eats.name} Eats)
+                       \join_{Eats.pizza = Serves.pizza} Serves;""",
+                    """((\select_{Person.name = 'Amy'} Person) \join_{Person.name = Eats.name} Eats)
+                       \join_{Eats.pizza = Serves.pizza} Serves;""")
+
+    def test_renamed_self_join(self):
+        self._check("""((\\rename_{A: *} Eats) \join_{A.pizza = B.pizza} (\\rename_{B: *} Eats))
+                       \join_{B.name = P.name} (\select_{P.age = 16} (\\rename_{P: *} Person));""",
+                    """((\\rename_{B: *} Eats) \join_{B.name = P.name} (\select_{P.age = 16} (\\rename_{P: *} Person)))
+                       \join_{A.pizza = B.pizza} (\\rename_{A: *} Eats);""")
+
+    def test_single_cross_product(self):
+        self._check("Person \cross (\select_{pizzeria = 'Dominos'} Serves);",
+                    "Person \cross (\select_{pizzeria = 'Dominos'} Serves);")
+
+    def test_cross_product_last(self):
+        self._check("(Person \cross Serves) \join_{Person.name = Eats.name} Eats;",
+                    "(Person \join_{Person.name = Eats.name} Eats) \cross Serves;")
+
+    def test_no_cross_product_between_selective_inputs(self):
+        # The selections on Person and Serves are tiny, but only Eats joins them.
+        stats = {"Person": {"rows": 9, "distinct": {"name": 9, "age": 8, "gender": 2}},
+                 "Eats": {"rows": 2000, "distinct": {"name": 9, "pizza": 5}},
+                 "Serves": {"rows": 18, "distinct": {"pizzeria": 6, "pizza": 5, "price": 8}}}
+        computed_expr = raopt.optimize(radb.parse.one_statement_from_string(
+            """\select_{Person.name = Eats.name and Eats.pizza = Serves.pizza and Person.name = 'Amy'
+               and Serves.pizzeria = 'Dominos'} ((Person \cross Eats) \cross Serves);"""), self.dd, stats)
+        self.assertNotIn('\\cross', str(computed_expr))
+        self.assertEqual(str(computed_expr).count('\\join'), 2)
+
+    def test_no_bushy_cross_product(self):
+        # Both pairs join, but no join predicate connects the two pairs.
+        ra = radb.parse.one_statement_from_string(
+            """((\\rename_{A: *} Eats) \join_{A.pizza = B.pizza} (\\rename_{B: *} Eats))
+               \cross ((\\rename_{C: *} Eats) \join_{C.name = D.name} (\\rename_{D: *} Eats));""")
+        leaves = []
+        conditions = []
+        raopt.collect_join_inputs(ra, leaves, conditions, self.dd, self.stats)
+        infos = [raopt.JoinInput(leaf, self.dd, self.stats) for leaf in leaves]
+        predicates = [raopt.JoinPredicate(condition, infos, self.dd) for condition in conditions]
+        best = raopt.dp_join_subplans(len(infos), infos, predicates, (1 << len(infos)) - 1, False)
+        self.assertNotIn((1 << len(infos)) - 1, best)
+
+    def test_without_statistics(self):
+        self._check("(Person \join_{Person.name = Eats.name} Eats) \join_{Eats.pizza = Serves.pizza} Serves;",
+                    "(Person \join_{Person.name = Eats.name} Eats) \join_{Eats.pizza = Serves.pizza} Serves;",
+                    stats={})
+
+    def test_bushy_snowflake(self):
+        # Sales is the fact table, the dimensions Customer and Product are joined with City and Brand first.
+        dd = {"Sales": {"cust": "string", "prod": "string", "qty": "integer"},
+              "Customer": {"cust": "string", "city": "string"},
+              "Product": {"prod": "string", "brand": "string"},
+              "City": {"city": "string", "country": "string"},
+              "Brand": {"brand": "string", "owner": "string"}}
+        stats = {"Sales": {"rows": 10000000, "distinct": {"cust": 100000, "prod": 10000, "qty": 10}},
+                 "Customer": {"rows": 100000, "distinct": {"cust": 100000, "city": 1000}},
+                 "Product": {"rows": 10000, "distinct": {"prod": 10000, "brand": 100}},
+                 "City": {"rows": 1000, "distinct": {"city": 1000, "country": 10}},
+                 "Brand": {"rows": 100, "distinct": {"brand": 100, "owner": 50}}}
+        input = """(((Sales \join_{Sales.cust = Customer.cust} Customer) \join_{Customer.city = City.city}
+                   (\select_{country = 'NZ'} City)) \join_{Sales.prod = Product.prod} Product)
+                   \join_{Product.brand = Brand.brand} (\select_{owner = 'Acme'} Brand);"""
+        expected = """((Product \join_{Product.brand = Brand.brand} (\select_{owner = 'Acme'} Brand))
+                      \join_{Sales.prod = Product.prod} Sales) \join_{Sales.cust = Customer.cust}
+                      (Customer \join_{Customer.city = City.city} (\select_{country = 'NZ'} City));"""
+        computed_expr = raopt.rule_reorder_joins(radb.parse.one_statement_from_string(input), dd, stats)
+        self.assertEqual(str(computed_expr), str(radb.parse.one_statement_from_string(expected)))
+
+    def test_greedy_order(self):
+        limit = raopt.DP_JOIN_LIMIT
+        raopt.DP_JOIN_LIMIT = 1
+        try:
+            self.test_selective_relation_first()
+            self.test_renamed_self_join()
+            self.test_bushy_snowflake()
+        finally:
+            raopt.DP_JOIN_LIMIT = limit
+
+
+
+'''
+Tests the optimizer driver.
+'''
+class TestOptimizer(unittest.TestCase):
+
+    dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+          "Eats": {"name": "string", "pizza": "string"},
+          "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+
+    def _check(self, input, expected, **kwargs):
+        computed_expr = raopt.optimize(radb.parse.one_statement_from_string(input), self.dd, **kwargs)
+        expected_expr = radb.parse.one_statement_from_string(expected)
+        self.assertEqual(str(computed_expr), str(expected_expr))
+
+    def test_project_select_person(self):
+        self._check("\project_{name}(\select_{gender='f' and age=16} Person);",
+                    "\project_{name}(\select_{gender = 'f' and age = 16} Person);")
+
+    def test_cross_cross(self):
+        self._check("""\project_{Person.name} \select_{Eats.pizza = Serves.pizza and Person.name = Eats.name}
+                       ((Person \cross Eats) \cross Serves);""",
+                    """\project_{Person.name} ((\project_{Person.name, Eats.pizza} ((\project_{Person.name} Person)
+                       \join_{Person.name = Eats.name} Eats)) \join_{Eats.pizza = Serves.pizza}
+                       (\project_{Serves.pizza} Serves));""")
+
+    def test_select_star(self):
+        self._check("\select_{Person.name = Eats.name and age = 16} (Person \cross Eats);",
+                    "(\select_{age = 16} Person) \join_{Person.name = Eats.name} Eats;")
+
+    def test_reorder_joins_with_statistics(self):
+        stats = {"Person": {"rows": 1000000}, "Eats": {"rows": 2000000, "distinct": {"pizza": 50}},
+                 "Serves": {"rows": 10, "distinct": {"pizza": 50}}}
+        self._check("""\select_{Eats.pizza = Serves.pizza and Person.name = Eats.name}
+                       ((Person \cross Eats) \cross Serves);""",
+                    """(Eats \join_{Eats.pizza = Serves.pizza} Serves) \join_{Person.name = Eats.name} Person;""",
+                    stats=stats)
+
+    def test_estimates_of_sql_literals(self):
+        # sql2ra translates literals to attribute references, such as AttrRef('90').
+        dd = {"Person": {"name": "string", "age": "integer"}, "Serves": {"pizza": "string", "price": "float"}}
+        stats = {"Person": {"rows": 1000, "distinct": {"name": 1000, "age": 100},
+                            "attributes": {"age": {"min": 10, "max": 90, "top": [[90, 10]]}}},
+                 "Serves": {"rows": 100, "distinct": {"pizza": 10, "price": 20},
+                            "attributes": {"price": {"min": 7, "max": 12, "top": [[7.75, 50]]}}}}
+        for sql, rows in [("select distinct * from Person where Person.age = 90", 10.0),
+                          ("select distinct * from Person where age = 90", 10.0),
+                          ("select distinct * from Person where Person.name = 'Amy'", 1.0),
+                          ("select distinct * from Serves where Serves.price = 7.75", 50.0)]:
+            ra = sql2ra.translate(sqlparse.parse(sql)[0])
+            self.assertEqual(raopt.JoinInput(ra, dd, stats).rows, rows)
+            parsed = radb.parse.one_statement_from_string(str(ra) + ";")
+            self.assertEqual(raopt.JoinInput(parsed, dd, stats).rows, rows)
+
+    def test_fixpoint(self):
+        input = radb.parse.one_statement_from_string("""\project_{P.name, E.pizza} (\select_{P.name = E.name}
+                       ((\\rename_{P: *} Person) \cross (\\rename_{E: *} Eats)));""")
+        once = raopt.optimize(input, self.dd)
+        twice = raopt.optimize(radb.parse.one_statement_from_string(str(once) + ";"), self.dd)
+        self.assertEqual(str(once), str(twice))
+
+    def test_shared_subtrees_are_rewritten_once(self):
+        calls = []
+
+        def count_selections(ra):
+            if isinstance(ra, radb.ast.Select):
+                calls.append(str(ra))
+            return raopt.local_break_up_selections(ra)
+
+        rules = [raopt.Rule("break_up_selections", count_selections, local=True)]
+        self._check("""(\\rename_{A: *} \select_{pizza = 'cheese' and name = 'Amy'} Eats) \cross
+                       (\\rename_{B: *} \select_{pizza = 'cheese' and name = 'Amy'} Eats);""",
+                    """(\\rename_{A: *} \select_{pizza = 'cheese'} \select_{name = 'Amy'} Eats) \cross
+                       (\\rename_{B: *} \select_{pizza = 'cheese'} \select_{name = 'Amy'} Eats);""",
+                    rules=rules)
+        # The second copy of each selection is taken from the cache: one rewrite in the first pass,
+        # and one for each of the two new selections in the second pass, which reaches the fixpoint.
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(set(calls)), 3)
+
+    def test_less_work_than_rule_chain(self):
+        # The rules of the manual chain in test_e2e, repeated until the query stops changing.
+        names = ["R%d" % i for i in range(8)]
+        dd = dict((name, {"a": "integer", "b": "integer"}) for name in names)
+        input = "\project_{R0.a} \select_{%s} (%s);" % (
+            " and ".join(["%s.b = %s.a" % (names[i], names[i + 1]) for i in range(len(names) - 1)] +
+                         ["%s.a = %d" % (name, i) for i, name in enumerate(names)]),
+            " \cross ".join(names))
+
+        # The chain applies each local rule to every node of the query, and each global rule to the query.
+        def size(ra):
+            return 1 + sum(size(statement) for statement in ra.inputs or [])
+
+        chain_work = 0
+        ra = radb.parse.one_statement_from_string(input)
+        while True:
+            before = str(ra)
+            chain_work += size(ra)
+            ra = raopt.rule_break_up_selections(ra)
+            chain_work += 1
+            ra = raopt.rule_push_down_selections(ra, dd)
+            chain_work += size(ra)
+            ra = raopt.rule_merge_selections(ra)
+            chain_work += size(ra)
+            ra = raopt.rule_introduce_joins(ra)
+            if str(ra) == before:
+                break
+
+        calls = collections.Counter()
+
+        def counted(rule):
+            def function(*args):
+                calls[rule.name] += 1
+                return rule.function(*args)
+            return raopt.Rule(rule.name, function, local=rule.local)
+
+        rules = [counted(rule) for rule in raopt.RULES
+                 if rule.name in ("break_up_selections", "push_down_selections", "merge_selections", "introduce_joins")]
+        optimizer = raopt.Optimizer(dd, rules=rules)
+        result = optimizer.optimize(radb.parse.one_statement_from_string(input))
+
+        # Both join all relations; conjunctions may associate differently.
+        self.assertEqual(str(result).count("\\join"), len(names) - 1)
+        self.assertEqual(str(ra).count("\\join"), len(names) - 1)
+        # Each rule is applied at most once to each subtree, later applications are cache hits.
+        for rule in rules:
+            self.assertEqual(calls[rule.name], len([key for key in optimizer.cache if key[0] == rule.name]))
+        self.assertLess(sum(calls.values()), chain_work)
+
+    def test_budget(self):
+        input = "\select_{Person.name = Eats.name} (Person \cross Eats);"
+        self._check(input, input, time_budget=0)
+        self._check(input, "Person \join_{Person.name = Eats.name} Eats;", max_iterations=1)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,103 @@
+import json
+import luigi
+import radb
+import ra2mr
+import raopt
+import stats
+
+import test_ra2mr
+
+
+'''
+Checks the sketches, and the collection and incremental refresh of the
+statistics catalog on the mock file system.
+
+python3 -m pytest test_stats.py -p no:warnings --show-capture=no
+'''
+
+class TestSketches(object):
+
+    def test_hyperloglog(self):
+        hll = stats.HyperLogLog(12)
+        for i in range(20000):
+            hll.add(i % 10000)
+        assert abs(hll.count() - 10000) < 500
+
+    def test_hyperloglog_merge_and_serialization(self):
+        left, right = stats.HyperLogLog(10), stats.HyperLogLog(10)
+        for i in range(500):
+            left.add("a" + str(i))
+            right.add("b" + str(i))
+        left.merge(stats.HyperLogLog.from_json(json.loads(json.dumps(right.to_json()))))
+        assert abs(left.count() - 1000) < 100
+
+    def test_space_saving(self):
+        sketch = stats.SpaceSaving(3)
+        for value in ["a"] * 10 + ["b"] * 5 + list("cdefgh") + ["b"] * 2:
+            sketch.add(value)
+        assert [value for value, count in sketch.top(2)] == ["a", "b"]
+
+
+class TestCatalog(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+
+    def _collect(self, *relations):
+        return stats.collect(list(relations), env=ra2mr.ExecEnv.MOCK)["relations"]
+
+    def test_collect(self):
+        relations = self._collect("Person", "Eats")
+        person = relations["Person"]
+        assert person["rows"] == 9
+        assert person["bytes"] == len(luigi.mock.MockFileSystem().get_data('Person.json'))
+        assert person["distinct"] == {"name": 9, "age": 8, "gender": 2}
+        assert (person["attributes"]["age"]["min"], person["attributes"]["age"]["max"]) == (13, 45)
+        assert person["attributes"]["gender"]["top"] == [["male", 6], ["female", 3]]
+        assert relations["Eats"]["attributes"]["name"]["top"][0] == ["Dan", 5]
+
+        # The catalog is persisted.
+        assert stats.relation_statistics(ra2mr.ExecEnv.MOCK) == relations
+
+    def test_unchanged_files_are_not_scanned(self, monkeypatch):
+        self._collect("Person", "Eats")
+        scanned = []
+        scan_relation = stats.scan_relation
+        monkeypatch.setattr(stats, "scan_relation", lambda relation, *args: scanned.append(relation) or
+                            scan_relation(relation, *args))
+        self._collect("Person", "Eats", "Serves")
+        assert scanned == ["Serves"]
+
+    def test_appended_lines_are_merged(self):
+        self._collect("Person")
+        luigi.mock.MockFileSystem().get_all_data()['Person.json'] += \
+            b'Person\t{"Person.name": "Jon", "Person.age": 61, "Person.gender": "male", "Person.city": "Bonn"}\n'
+
+        person = self._collect("Person")["Person"]
+        assert person["rows"] == 10
+        assert person["distinct"]["name"] == 10
+        assert person["attributes"]["age"]["max"] == 61
+        assert person["attributes"]["gender"]["top"] == [["male", 7], ["female", 3]]
+        assert person["attributes"]["city"]["nulls"] == 9
+
+    def test_rewritten_files_are_rescanned(self):
+        self._collect("Person")
+        data = luigi.mock.MockFileSystem().get_data('Person.json')
+        luigi.mock.MockFileSystem().get_all_data()['Person.json'] = data.replace(b'"Amy"', b'"Ann"')
+
+        person = self._collect("Person")["Person"]
+        assert person["rows"] == 9
+        assert person["attributes"]["name"]["min"] == "Ann"
+
+    def test_join_ordering_with_catalog(self):
+        relations = self._collect("Person", "Eats", "Serves")
+        dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+              "Eats": {"name": "string", "pizza": "string"},
+              "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+
+        # Few people are older than 40, so Person is joined first.
+        querystring = "(Eats \join_{Eats.pizza = Serves.pizza} Serves) " \
+                      "\join_{Person.name = Eats.name} (\select_{age > 40} Person);"
+        reordered = raopt.rule_reorder_joins(radb.parse.one_statement_from_string(querystring), dd, relations)
+        assert str(reordered) == str(radb.parse.one_statement_from_string(
+            "(Eats \join_{Person.name = Eats.name} (\select_{age > 40} Person)) \join_{Eats.pizza = Serves.pizza} Serves;"))
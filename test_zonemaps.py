@@ -0,0 +1,70 @@
+import json
+import luigi
+import radb
+import ra2mr
+import ra2py
+import zonemaps
+
+import test_ra2mr
+
+
+'''
+Checks the zone maps, and selections that skip blocks with them.
+
+python3 -m pytest test_zonemaps.py -p no:warnings --show-capture=no
+'''
+
+class TestZoneMaps(object):
+
+    def setup_method(self, method):
+        test_ra2mr.prepareMockFileSystem()
+        # Sort Person by age, so that the blocks hold ranges of ages.
+        lines = luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            for line in sorted(lines, key=lambda line: json.loads(line.split('\t')[1])["Person.age"]):
+                f.write(line + '\n')
+        # Three tuples per block.
+        self.zonemap = zonemaps.build_zone_map("Person", 3 * 70, env=ra2mr.ExecEnv.MOCK)
+
+    def _check(self, querystring, expected_count, expected_blocks):
+        raquery = radb.parse.one_statement_from_string(querystring)
+        task, ok = ra2mr.run_query(raquery, env=ra2mr.ExecEnv.MOCK)
+        assert ok
+        assert task.blocks == expected_blocks
+
+        with task.output().open('r') as f:
+            computed = sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True) for line in f)
+        expected = sorted(json.dumps(json.loads(line.split('\t')[1]), sort_keys=True)
+                          for line in ra2py.execute(raquery, env=ra2mr.ExecEnv.MOCK))
+        assert len(computed) == expected_count
+        assert computed == expected
+
+    def test_build_zone_map(self):
+        blocks = self.zonemap["blocks"]
+        assert [block["rows"] for block in blocks] == [3, 3, 3]
+        assert [block["attributes"]["Person.age"]["min"] for block in blocks] == [13, 21, 30]
+        assert [block["attributes"]["Person.age"]["max"] for block in blocks] == [18, 24, 45]
+        assert blocks[0]["attributes"]["Person.name"] == {"min": "Amy", "max": "Ian", "nulls": 0}
+
+        lines = [line for block in blocks for line in luigi.mock.MockTarget(block["file"]).open('r').read().splitlines()]
+        assert lines == luigi.mock.MockTarget('Person.json').open('r').read().splitlines()
+
+    def test_range_selection(self):
+        self._check("\select_{age > 25} Person;", 3, ["Person.block-00002.json"])
+        self._check("\select_{21 >= age} Person;", 5, ["Person.block-00000.json", "Person.block-00001.json"])
+        self._check("\select_{age >= 20 and age < 30} Person;", 3, ["Person.block-00001.json"])
+
+    def test_fused_range_selection(self):
+        self._check("\project_{name} \select_{age = 33} Person;", 1, ["Person.block-00002.json"])
+
+    def test_no_matching_block(self):
+        self._check("\select_{age > 50} Person;", 0, ["Person.block-00000.json"])
+
+    def test_no_skipping(self):
+        self._check("\select_{gender = 'female'} Person;", 3,
+                    ["Person.block-00000.json", "Person.block-00001.json", "Person.block-00002.json"])
+
+    def test_stale_zone_map(self):
+        with luigi.mock.MockTarget('Person.json').open('w') as f:
+            f.write('Person\t{"Person.name": "Amy", "Person.age": 26, "Person.gender": "female"}\n')
+        self._check("\select_{age > 25} Person;", 1, None)
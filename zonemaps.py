@@ -0,0 +1,114 @@
+import json
+import sys
+import luigi
+
+import ra2mr
+from ra2mr import ExecEnv
+
+'''
+Builds zone maps for input relations, for range selections like
+age > 30 or price < 8.
+
+The tuples of <Relation>.json are copied, in order, into blocks of about
+block_size bytes, <Relation>.block-00000.json, ..., and the sidecar
+<Relation>.zonemap.json records for every block its file, its number of
+rows, and the minimum, maximum and number of NULLs of every attribute.
+<Relation>.json itself is kept. A selection on the relation (see
+ra2mr.ScanMixin) then only reads the blocks that can hold matching
+tuples, which skips the most blocks if the relation is sorted or
+clustered on the attributes compared, e.g. a time stamp or an id.
+Once <Relation>.json changes, the zone map is ignored until it is built
+again.
+'''
+
+
+class zonemap(luigi.Config):
+    block_size = luigi.IntParameter(default=64 * 1024 * 1024, description='Size of a block in bytes')
+
+
+def block_filename(relation, block):
+    return "%s.block-%05d.json" % (relation, block)
+
+
+class ZoneStatistics(object):
+
+    def __init__(self):
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.ordered = True
+
+    def add(self, value):
+        if value is None:
+            self.nulls += 1
+        elif self.ordered and not isinstance(value, (dict, list)):
+            try:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+            except TypeError:
+                # Values of mixed types have no order.
+                self.ordered = False
+                self.min = self.max = None
+        else:
+            self.ordered = False
+            self.min = self.max = None
+
+    def to_json(self):
+        return {"min": self.min, "max": self.max, "nulls": self.nulls}
+
+
+def build_zone_map(relation, block_size=None, env=ExecEnv.LOCAL):
+    '''
+    Writes the blocks of <relation>.json and their zone map, and returns
+    the zone map.
+    '''
+    block_size = block_size or zonemap().block_size
+    source = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+
+    blocks = []
+    lines = []
+    size = 0
+    for line in ra2mr.read_target(source):
+        lines.append(line)
+        size += len(line.encode('utf-8')) + 1
+        if size >= block_size:
+            blocks.append(write_block(relation, len(blocks), lines, env))
+            lines = []
+            size = 0
+    if lines or not blocks:
+        blocks.append(write_block(relation, len(blocks), lines, env))
+
+    result = {"relation": relation, "version": ra2mr.target_version(source), "blocks": blocks}
+    with ra2mr.InputData(filename=relation + ".zonemap.json", exec_environment=env).output().open('w') as f:
+        json.dump(result, f)
+    return result
+
+
+def write_block(relation, block, lines, env):
+    attributes = {}
+    with ra2mr.InputData(filename=block_filename(relation, block), exec_environment=env).output().open('w') as f:
+        for row, line in enumerate(lines):
+            f.write(line + '\n')
+            json_tuple = json.loads(line.split('\t')[1])
+            for name in attributes.keys() - json_tuple.keys():
+                attributes[name].add(None)
+            for name, value in json_tuple.items():
+                if name not in attributes:
+                    attributes[name] = ZoneStatistics()
+                    # The attribute was missing from all earlier rows.
+                    attributes[name].nulls = row
+                attributes[name].add(value)
+
+    return {
+        "file": block_filename(relation, block),
+        "rows": len(lines),
+        "attributes": dict((name, attribute.to_json()) for name, attribute in attributes.items()),
+    }
+
+
+if __name__ == '__main__':
+    # python3 zonemaps.py Person 1048576
+    result = build_zone_map(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print(result["relation"], len(result["blocks"]))